@@ -0,0 +1,141 @@
+"""
+Throughput of concurrent generations: sync view under gunicorn vs async view under uvicorn.
+
+Both servers run the real project against a local stub API that answers after
+a fixed delay, standing in for the model's generation time. The sync ``/``
+view holds a gunicorn worker for the whole upstream call; ``/generate/async/``
+waits on the event loop instead.
+
+    python benchmarks/asgi_vs_wsgi.py --requests 100 --delay 0.5
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARK_SETTINGS = """
+import os
+from text2image.settings import *
+
+DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": os.environ["BENCHMARK_DB"],
+                         "OPTIONS": {"timeout": 30}}}
+MEDIA_ROOT = os.environ["BENCHMARK_MEDIA"]
+ALLOWED_HOSTS = ["*"]
+DEBUG = False
+MIDDLEWARE = [m for m in MIDDLEWARE if "Csrf" not in m]
+STABILITY_API_HOST = os.environ["BENCHMARK_API"]
+GENERATION_JOBS_EAGER = True
+GENERATION_CACHE_ENABLED = False
+# Only the upstream wait is being compared, not variant encoding
+GENERATION_VARIANT_WIDTHS = ()
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def load(base_url, path, total):
+    import httpx
+
+    limits = httpx.Limits(max_connections=total)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        await client.post("/accounts/login/", data={"username": "bench", "password": "bench-password"})
+
+        async def one(index):
+            started = time.perf_counter()
+            response = await client.post(path, data={"prompt": f"A benchmark prompt {index}"})
+            return response.status_code, time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one(index) for index in range(total)))
+        return time.perf_counter() - started, results
+
+
+def run_server(name, command, env, port, path, total):
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        elapsed, results = asyncio.run(load(f"http://127.0.0.1:{port}", path, total))
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = [latency for status, latency in results]
+    ok = sum(1 for status, latency in results if status == 302)
+    print(f"{name:>24}: {ok}/{total} ok in {elapsed:6.2f}s ({total / elapsed:6.1f} req/s), "
+          f"p50 {percentile(latencies, 50):6.2f}s, p99 {percentile(latencies, 99):6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--delay", type=float, default=0.5, help="Simulated generation time in seconds")
+    parser.add_argument("--sync-workers", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from generator.testing import StubStabilityServer
+
+    with tempfile.TemporaryDirectory() as workdir, StubStabilityServer(delay=args.delay) as api:
+        with open(os.path.join(workdir, "benchmark_settings.py"), "w") as f:
+            f.write(BENCHMARK_SETTINGS)
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([workdir, ROOT]),
+            DJANGO_SETTINGS_MODULE="benchmark_settings",
+            BENCHMARK_DB=os.path.join(workdir, "db.sqlite3"),
+            BENCHMARK_MEDIA=os.path.join(workdir, "media"),
+            BENCHMARK_API=api.url,
+            STABILITY_API_KEY=os.environ.get("STABILITY_API_KEY", "benchmark"),
+        )
+        subprocess.run([sys.executable, "manage.py", "migrate", "-v", "0"], cwd=ROOT, env=env, check=True)
+        subprocess.run(
+            [sys.executable, "manage.py", "shell", "-v", "0", "-c",
+             "from django.contrib.auth.models import User; User.objects.create_user('bench', password='bench-password')"],
+            cwd=ROOT, env=env, check=True,
+        )
+
+        print(f"{args.requests} concurrent generations, {args.delay}s simulated upstream latency")
+        port = free_port()
+        run_server(
+            f"gunicorn ({args.sync_workers} sync workers)",
+            [sys.executable, "-m", "gunicorn", "text2image.wsgi:application",
+             "--bind", f"127.0.0.1:{port}", "--workers", str(args.sync_workers)],
+            env, port, "/", args.requests,
+        )
+        port = free_port()
+        run_server(
+            "uvicorn (1 async worker)",
+            [sys.executable, "-m", "uvicorn", "text2image.asgi:application",
+             "--host", "127.0.0.1", "--port", str(port), "--workers", "1"],
+            env, port, "/generate/async/", args.requests,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Load benchmarks of the generation flow, run with pytest:
+
+    pytest benchmarks/bench_generation_flow.py
+    BENCHMARK_RESULTS_DIR=benchmarks/results pytest benchmarks/bench_generation_flow.py
+
+Each case drives login -> generate -> result -> gallery through
+``generator.benchmarking`` and fails when a view goes over its query budget or
+a request errors. With ``BENCHMARK_RESULTS_DIR`` set, every case writes its
+JSON report there so runs can be diffed between releases.
+"""
+import json
+import os
+
+import pytest
+from django.db import connection
+
+from generator.benchmarking import run_benchmark
+
+pytestmark = [pytest.mark.slow, pytest.mark.django_db(transaction=True)]
+
+# Queries per request; a regression here usually means an N+1
+QUERY_BUDGETS = {"login": 8, "generate": 9, "result": 4, "gallery": 5}
+
+
+def save_report(name, report):
+    results_dir = os.environ.get("BENCHMARK_RESULTS_DIR")
+    if results_dir:
+        os.makedirs(results_dir, exist_ok=True)
+        with open(os.path.join(results_dir, f"{name}.json"), "w") as f:
+            json.dump(report, f, indent=2)
+
+
+@pytest.mark.parametrize("backend", ["stub", "local"])
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_generation_flow(backend, concurrency):
+    if concurrency > 1 and connection.vendor == "sqlite":
+        pytest.skip("SQLite test databases cannot take concurrent writers")
+
+    report = run_benchmark(concurrency=concurrency, flows=3, delay=0.1, backend=backend,
+                           label=f"{backend}-c{concurrency}")
+    save_report(f"generation_flow_{backend}_c{concurrency}", report)
+
+    assert report["errors"] == 0
+    for view, budget in QUERY_BUDGETS.items():
+        assert report["views"][view]["queries"]["max"] <= budget, view
@@ -0,0 +1,88 @@
+"""
+Cost of a revalidated result or gallery page: full render vs 304.
+
+Creates a user with ``--generations`` generations in a throwaway test
+database, then requests the result page and the first gallery page through
+Django's test client, once without and once with the ``If-None-Match`` the
+browser would send. Both paths run the same queries; the 304 skips template
+rendering and sends no body.
+
+    python benchmarks/conditional_pages.py --generations 500 --repeat 200
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django():
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "text2image.settings")
+    os.environ.setdefault("STABILITY_API_KEY", "benchmark")
+    import django
+    django.setup()
+
+
+def create_generations(user, count):
+    from generator.models import Generation
+    widths = (320, 640, 1024)
+    Generation.objects.bulk_create(
+        Generation(
+            user=user,
+            prompt=f"Benchmark prompt {i}",
+            image=f"generated_images/{i:064x}.png",
+            variants={
+                fmt: {str(width): f"variants/00/00/{i:064x}_{width}.{fmt}" for width in widths}
+                for fmt in ("webp", "avif")
+            },
+        )
+        for i in range(count)
+    )
+    return Generation.objects.filter(user=user).latest("created_at")
+
+
+def timed(client, url, repeat, **headers):
+    """Mean seconds per request, and the last response"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(url, headers=headers)
+        timings.append(time.perf_counter() - started)
+    return sum(timings) / len(timings), response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--generations", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    from django.urls import reverse
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+    user = User.objects.create_user(username="benchmark", password="benchmark-password")
+    latest = create_generations(user, args.generations)
+    client = Client()
+    client.force_login(user)
+
+    print(f"{'page':>8} {'full ms':>9} {'304 ms':>9} {'speedup':>8} {'full bytes':>11}")
+    for page, url in (("result", reverse("generation_result", kwargs={"pk": latest.pk})),
+                      ("gallery", reverse("user_gallery"))):
+        mean_full, response = timed(client, url, args.repeat)
+        etag = response["ETag"]
+        mean_304, revalidated = timed(client, url, args.repeat, if_none_match=etag)
+        assert revalidated.status_code == 304, revalidated.status_code
+        print(f"{page:>8} {mean_full * 1000:>9.2f} {mean_304 * 1000:>9.2f} "
+              f"{mean_full / mean_304:>7.1f}x {len(response.content):>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Memory and throughput of the streaming gallery export.
+
+Fills a throwaway test database with ``--images`` generations of one user,
+all pointing at the same ``--image-mb`` file (content-addressed storage shares
+identical images), so a multi-GB archive needs little disk. Then reads
+``generator.export.archive`` to the end, like a client downloading it, and
+reports the archive size, the throughput and how much the process's peak RSS
+grew meanwhile. Exits non-zero when it grew by more than ``--budget-mb``.
+
+``--output`` also writes the archive and checks it with ``zipfile``.
+
+    python benchmarks/gallery_export.py --images 1200 --image-mb 4
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django(media_root):
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "text2image.settings")
+    os.environ.setdefault("STABILITY_API_KEY", "benchmark")
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.MEDIA_ROOT = media_root
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=1200)
+    parser.add_argument("--image-mb", type=float, default=4)
+    parser.add_argument("--budget-mb", type=float, default=64, help="allowed growth of the peak RSS")
+    parser.add_argument("--output", help="also write the archive here and verify it")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as media_root:
+        setup_django(media_root)
+        from django.contrib.auth.models import User
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        from django.db import connection
+        from django.test.utils import setup_test_environment
+        from generator.export import archive
+        from generator.models import Generation
+
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0)
+        user = User.objects.create(username="export-user")
+        name = default_storage.save("generated_images/benchmark.png",
+                                    ContentFile(os.urandom(int(args.image_mb * 1024 * 1024))))
+        Generation.objects.bulk_create(
+            Generation(user=user, prompt=f"Benchmark image {index}", image=name) for index in range(args.images)
+        )
+
+        output = open(args.output, "wb") if args.output else None
+        rss_before = current_rss_mb()
+        size = 0
+        started = time.perf_counter()
+        for chunk in archive(user):
+            size += len(chunk)
+            if output:
+                output.write(chunk)
+        elapsed = time.perf_counter() - started
+        growth = peak_rss_mb() - rss_before
+
+    print(f"{args.images} images of {args.image_mb:g} MB: {size / 1024 ** 3:.2f} GiB archive "
+          f"in {elapsed:.1f}s ({size / 1024 ** 2 / elapsed:.0f} MiB/s)")
+    print(f"RSS before {rss_before:.0f} MB, peak RSS growth {growth:.1f} MB")
+
+    if output:
+        output.close()
+        with zipfile.ZipFile(args.output) as written:
+            entries = written.infolist()
+            print(f"{args.output}: {len(entries)} entries, zip64 {'yes' if size >= zipfile.ZIP64_LIMIT else 'no'}")
+    if growth > args.budget_mb:
+        print(f"peak RSS grew by more than {args.budget_mb:g} MB")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Peak memory of one generation: buffered JSON decode vs streaming decode.
+
+Each mode runs in a fresh subprocess against a local stub API served by the
+parent process, so the peak RSS reported by the kernel belongs to that mode
+alone.
+
+    python benchmarks/memory_streaming.py --image-mb 3
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django(media_root):
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "text2image.settings")
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.MEDIA_ROOT = media_root
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_buffered(client, prompt):
+    """The pre-streaming code path: whole body, then base64 string, then bytes"""
+    import base64
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import default_storage
+    from generator.backends.stability import TEXT_TO_IMAGE_PATH
+
+    response = client.post(TEXT_TO_IMAGE_PATH, json={"text_prompts": [{"text": prompt}], "samples": 1})
+    data = response.json()
+    image_data = base64.b64decode(data["artifacts"][0]["base64"])
+    return default_storage.save("generated_images/generated.png", ContentFile(image_data))
+
+
+def run_streaming(client, prompt):
+    from unittest.mock import patch
+    from django.core.files.storage import default_storage
+
+    with patch("generator.backends.stability.get_client", return_value=client), \
+            patch("generator.backends.stability.STABILITY_API_KEY", "benchmark"):
+        from generator.services import generate_image_from_prompt
+        image_file = generate_image_from_prompt(prompt)
+    try:
+        return default_storage.save("generated_images/generated.png", image_file)
+    finally:
+        image_file.close()
+
+
+def child(mode, server_url):
+    with tempfile.TemporaryDirectory() as media_root:
+        setup_django(media_root)
+        from generator.client import StabilityClient
+
+        client = StabilityClient(base_url=server_url)
+        # Warm up imports and the connection so only the generation is measured
+        client.post("/warmup", json={"samples": 0}).content
+        baseline = peak_rss_mb()
+
+        tracemalloc.start()
+        runner = run_buffered if mode == "buffered" else run_streaming
+        runner(client, "A benchmark prompt")
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(json.dumps({
+            "mode": mode,
+            "peak_rss_growth_mb": round(peak_rss_mb() - baseline, 2),
+            "peak_python_alloc_mb": round(traced_peak / 1024 / 1024, 2),
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--image-mb", type=float, default=3.0)
+    parser.add_argument("--child", choices=["buffered", "streaming"])
+    parser.add_argument("--server-url")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.server_url)
+        return
+
+    sys.path.insert(0, ROOT)
+    from generator.testing import StubStabilityServer
+
+    # Random bytes compress as poorly as real PNG output
+    image = os.urandom(int(args.image_mb * 1024 * 1024))
+    print(f"Image size: {args.image_mb} MB")
+    with StubStabilityServer(image=image) as server:
+        for mode in ("buffered", "streaming"):
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", mode, "--server-url", server.url],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:>10}: peak RSS growth {result['peak_rss_growth_mb']:>7} MB, "
+                  f"peak Python allocations {result['peak_python_alloc_mb']:>7} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Prompt moderation cost as the term lists grow.
+
+Compiles lists of 10 to 100,000 random terms and phrases and times checking
+prompts of several lengths against them, next to the substring loop that
+``validate_prompt`` used to run over its word list. The automaton's time
+follows the prompt's length and stays flat as terms are added; the loop's
+grows with the list.
+
+    python benchmarks/moderation_scaling.py --terms 10 1000 100000 --lengths 100 1000
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django():
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "text2image.settings")
+    import django
+    django.setup()
+
+
+def random_word(rng):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+
+
+def random_terms(rng, count):
+    """Single words, prefixes and two or three word phrases"""
+    terms = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.6:
+            terms.append(random_word(rng))
+        elif kind < 0.8:
+            terms.append(random_word(rng) + "*")
+        else:
+            terms.append(" ".join(random_word(rng) for _ in range(rng.randint(2, 3))))
+    return terms
+
+
+def random_prompt(rng, length):
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(random_word(rng))
+    return " ".join(words)[:length]
+
+
+def substring_loop(terms, prompt):
+    """The original check: one substring search per term"""
+    prompt_lower = prompt.lower()
+    return any(term.rstrip("*") in prompt_lower for term in terms)
+
+
+def best_of(repeat, call, *args):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--terms", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from generator.moderation import Moderator
+
+    rng = random.Random(0)
+    prompts = {length: random_prompt(rng, length) for length in args.lengths}
+    print(f"{'terms':>8} {'compile s':>10} " + " ".join(
+        f"{f'aho {length}ch us':>14} {f'loop {length}ch us':>15}" for length in args.lengths
+    ))
+    for count in args.terms:
+        terms = random_terms(rng, count)
+        started = time.perf_counter()
+        moderator = Moderator(terms)
+        compiled = time.perf_counter() - started
+        row = f"{count:>8} {compiled:>10.3f} "
+        for length in args.lengths:
+            automaton = best_of(args.repeat, moderator.blocked_terms, prompts[length]) * 1e6
+            loop = best_of(args.repeat, substring_loop, terms, prompts[length]) * 1e6
+            row += f"{automaton:>14.1f} {loop:>15.1f} "
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Latency of prompt search at scale.
+
+Fills a throwaway test database with ``--rows`` generations spread over
+``--users`` users, their prompts drawn from a Zipf-distributed vocabulary so
+some words are in most prompts and others in few, then times
+``generator.search.search`` for common, rare, partial-word and multi-word queries
+(first pages and the page after). Exits non-zero when the p95 of any kind
+of query goes over ``--budget-ms``.
+
+Uses the database of ``DJANGO_SETTINGS_MODULE``: the SQLite FTS5 index by
+default, or PostgreSQL's GIN indexes with ``text2image.settings_production``.
+
+    python benchmarks/prompt_search.py --rows 1000000 --users 100
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BATCH_SIZE = 5000
+
+
+def setup_django():
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "text2image.settings")
+    os.environ.setdefault("STABILITY_API_KEY", "benchmark")
+    import django
+    django.setup()
+
+
+def vocabulary(rng, size):
+    return ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 9))) for _ in range(size)]
+
+
+def fill(rng, users, rows, words):
+    """Insert ``rows`` generations round-robin over ``users``"""
+    from generator.models import Generation
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    started = time.perf_counter()
+    for start in range(0, rows, BATCH_SIZE):
+        Generation.objects.bulk_create(
+            Generation(
+                user=users[index % len(users)],
+                prompt=" ".join(rng.choices(words, weights, k=rng.randint(6, 12)))[:255],
+                image="generated_images/benchmark.png",
+            )
+            for index in range(start, min(start + BATCH_SIZE, rows))
+        )
+    return time.perf_counter() - started
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--vocabulary", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=50, help="queries of each kind")
+    parser.add_argument("--budget-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from generator.search import search
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+    rng = random.Random(0)
+    words = vocabulary(rng, args.vocabulary)
+    users = User.objects.bulk_create(User(username=f"search-user-{index}") for index in range(args.users))
+    users = list(User.objects.filter(username__startswith="search-user-"))
+    elapsed = fill(rng, users, args.rows, words)
+    print(f"{connection.vendor}: {args.rows} rows for {args.users} users inserted in {elapsed:.1f}s")
+
+    kinds = {
+        "common": lambda: rng.choice(words[:10]),
+        "rare": lambda: rng.choice(words[len(words) // 2:]),
+        "partial": lambda: rng.choice(words[:200])[:3],
+        "two words": lambda: f"{rng.choice(words[:50])} {rng.choice(words[:500])}",
+    }
+    print(f"{'query':>10} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'next p95':>9}")
+    over_budget = False
+    for kind, make_query in kinds.items():
+        first, following = [], []
+        for _ in range(args.queries):
+            user, query = rng.choice(users), make_query()
+            started = time.perf_counter()
+            _, cursor = search(user, query)
+            first.append((time.perf_counter() - started) * 1000)
+            if cursor:
+                started = time.perf_counter()
+                search(user, query, cursor)
+                following.append((time.perf_counter() - started) * 1000)
+        p95 = percentile(first, 95)
+        next_p95 = percentile(following, 95) if following else 0
+        over_budget |= max(p95, next_p95) > args.budget_ms
+        print(f"{kind:>10} {percentile(first, 50):>8.1f} {p95:>8.1f} {max(first):>8.1f} {next_p95:>9.1f}")
+
+    if over_budget:
+        print(f"p95 over the {args.budget_ms:g} ms budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,52 @@
-from django.contrib import admin
-from .models import Generation
+from django.contrib import admin, messages
+from .models import CircuitTransition, Generation, GenerationJob, ResultCacheEntry, ModerationTerm
+from . import circuit_breaker
 
 admin.site.register(Generation)
+
+
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ("pk", "user", "status", "created_at", "started_at", "finished_at")
+    list_filter = ("status",)
+
+
+@admin.register(ResultCacheEntry)
+class ResultCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ("key", "image", "size", "hits", "created_at", "last_used_at")
+
+
+@admin.register(ModerationTerm)
+class ModerationTermAdmin(admin.ModelAdmin):
+    list_display = ("term", "kind", "updated_at")
+    list_filter = ("kind",)
+    search_fields = ("term",)
+
+
+@admin.register(CircuitTransition)
+class CircuitTransitionAdmin(admin.ModelAdmin):
+    list_display = ("circuit", "from_state", "to_state", "failures", "created_at")
+    list_filter = ("circuit", "to_state")
+    actions = ["close_circuits"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        # The current state lives in the cache; show it above the history
+        breaker = circuit_breaker.stability
+        state, _ = breaker.state()
+        retry_after = breaker.retry_after()
+        suffix = f", calls resume in {retry_after:.0f}s" if retry_after else ""
+        level = messages.INFO if state == CircuitTransition.State.CLOSED else messages.WARNING
+        self.message_user(request, f"The {breaker.name} circuit is {state}{suffix}.", level)
+        return super().changelist_view(request, extra_context)
+
+    @admin.action(description="Close the circuits of the selected transitions")
+    def close_circuits(self, request, queryset):
+        for name in set(queryset.values_list("circuit", flat=True)):
+            circuit_breaker.CircuitBreaker(name).reset()
+        self.message_user(request, "Circuits closed.")
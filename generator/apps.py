@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class GeneratorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'generator'
+
+    def ready(self):
+        # Connects the receivers that reload the moderation lists, count
+        # references to stored images and invalidate cached galleries
+        from . import gallery_cache, moderation, storage  # noqa: F401
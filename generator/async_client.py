@@ -0,0 +1,51 @@
+"""
+Non-blocking HTTP client for the Stability AI API, for async views under ASGI.
+
+One ``httpx.AsyncClient`` is kept per event loop. Under uvicorn or daphne a
+process runs a single loop, so every in-flight generation shares one
+keep-alive pool and none of them holds a thread while waiting on the API.
+"""
+import asyncio
+import weakref
+
+from django.conf import settings
+import httpx
+
+from .client import DEFAULT_BASE_URL
+
+
+class AsyncStabilityClient:
+    """Keep-alive ``httpx`` connection pool to the Stability API"""
+
+    def __init__(self, base_url=None, max_connections=None, connect_timeout=None, read_timeout=None):
+        self.base_url = (base_url or getattr(settings, "STABILITY_API_HOST", DEFAULT_BASE_URL)).rstrip("/")
+        self.max_connections = max_connections or getattr(settings, "STABILITY_ASYNC_MAX_CONNECTIONS", 200)
+        connect_timeout = connect_timeout or getattr(settings, "STABILITY_CONNECT_TIMEOUT", 5)
+        read_timeout = read_timeout or getattr(settings, "STABILITY_READ_TIMEOUT", 60)
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+        )
+
+    def stream(self, method, path, **kwargs):
+        """Send a request whose body is read incrementally; use as ``async with``"""
+        return self._client.stream(method, path, **kwargs)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """Return the ``AsyncStabilityClient`` of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncStabilityClient()
+    return client
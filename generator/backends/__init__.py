@@ -0,0 +1,40 @@
+"""
+Image generation engines.
+
+``GENERATION_BACKEND`` names the class to use by dotted path, and
+``GENERATION_BACKEND_OPTIONS`` is passed to it as keyword arguments:
+
+- ``generator.backends.stability.StabilityBackend`` calls the Stability AI API
+  (the default).
+- ``generator.backends.local.LocalBackend`` renders a deterministic image from
+  the prompt on the machine, for benchmarks and offline tests.
+"""
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .base import BaseBackend
+
+DEFAULT_BACKEND = "generator.backends.stability.StabilityBackend"
+
+_backend = None
+
+
+def get_backend():
+    """Return the process-wide instance of the configured backend"""
+    global _backend
+    if _backend is None:
+        backend_class = import_string(getattr(settings, "GENERATION_BACKEND", DEFAULT_BACKEND))
+        _backend = backend_class(**getattr(settings, "GENERATION_BACKEND_OPTIONS", {}))
+    return _backend
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting in ("GENERATION_BACKEND", "GENERATION_BACKEND_OPTIONS"):
+        _backend = None
+
+
+__all__ = ["BaseBackend", "DEFAULT_BACKEND", "get_backend"]
@@ -0,0 +1,23 @@
+from asgiref.sync import sync_to_async
+
+
+class BaseBackend:
+    """
+    Interface of an image generation engine.
+
+    ``generate`` returns ``samples`` images as open temporary files (see
+    ``streaming.temporary_image_file``) with their size set, each carrying an
+    ``artifact`` dict of metadata such as its ``seed``. Failures are raised as
+    ``ImageGenerationError``; ``RetryableError`` marks the ones worth retrying.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+    def generate(self, prompt, params, samples=1):
+        """Generate ``samples`` images for a validated ``prompt`` and payload ``params``"""
+        raise NotImplementedError("Generation backends must implement generate()")
+
+    async def agenerate(self, prompt, params, samples=1):
+        """Async counterpart of ``generate``; by default runs it on a worker thread"""
+        return await sync_to_async(self.generate, thread_sensitive=False)(prompt, params, samples)
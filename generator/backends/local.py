@@ -0,0 +1,74 @@
+"""
+Offline backend that renders images on the machine.
+
+Each image is an abstract composition drawn with Pillow from a SHA-256 of the
+prompt, seed and parameters, so the same request always yields the same PNG.
+A configurable delay stands in for the model's generation time, which makes
+this backend suitable for throughput benchmarks and for exercising the whole
+pipeline without network access or an API key.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import time
+
+from PIL import Image, ImageDraw, ImageOps
+
+from ..streaming import temporary_image_file
+from .base import BaseBackend
+
+
+class LocalBackend(BaseBackend):
+    """
+    Options: ``latency``, seconds slept per call to simulate generation time,
+    and ``size``, a ``(width, height)`` that overrides the requested size.
+    """
+
+    def __init__(self, latency=0, size=None, **options):
+        super().__init__(**options)
+        self.latency = latency
+        self.size = tuple(size) if size else None
+
+    def generate(self, prompt, params, samples=1):
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.render(prompt, params, index) for index in range(samples)]
+
+    async def agenerate(self, prompt, params, samples=1):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self.render(prompt, params, index) for index in range(samples)]
+
+    def seed_for(self, prompt, params, index):
+        """The request's seed, or one derived from the prompt for unseeded requests"""
+        if params.get("seed") is not None:
+            return int(params["seed"]) + index
+        digest = hashlib.sha256(f"{prompt}\0{index}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "big")
+
+    def render(self, prompt, params, index=0):
+        """Draw one deterministic PNG into a temporary file"""
+        seed = self.seed_for(prompt, params, index)
+        fingerprint = json.dumps([prompt, seed, sorted(params.items())], default=str)
+        rng = random.Random(hashlib.sha256(fingerprint.encode("utf-8")).digest())
+        width, height = self.size or (int(params.get("width", 1024)), int(params.get("height", 1024)))
+
+        def colour():
+            return tuple(rng.randrange(256) for _ in range(3))
+
+        image = ImageOps.colorize(Image.linear_gradient("L").resize((width, height)), colour(), colour())
+        image = image.rotate(rng.choice((0, 90, 180, 270)))
+        draw = ImageDraw.Draw(image, "RGBA")
+        for _ in range(rng.randint(6, 16)):
+            x, y = rng.randrange(width), rng.randrange(height)
+            w, h = rng.randint(width // 16, width // 2), rng.randint(height // 16, height // 2)
+            shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+            shape((x - w // 2, y - h // 2, x + w // 2, y + h // 2), fill=colour() + (rng.randint(80, 200),))
+
+        image_file = temporary_image_file()
+        image.save(image_file, format="PNG")
+        image_file.size = image_file.tell()
+        image_file.seek(0)
+        image_file.artifact = {"seed": seed, "finishReason": "SUCCESS"}
+        return image_file
@@ -0,0 +1,289 @@
+"""
+Stability AI text-to-image backend.
+
+Calls go through the process-wide keep-alive client (``client.get_client``, or
+the per-loop ``httpx`` pool for async callers), are paced by the shared rate
+limiter and retried with backoff on 429s, server errors and timeouts. Server
+errors, timeouts and connection failures also count towards the shared
+circuit breaker, which fails calls at once while the API is down. Response
+bodies are decoded as they stream in, straight to temporary files.
+"""
+import asyncio
+import itertools
+import os
+import time
+
+import httpx
+import requests
+
+from ..async_client import get_async_client
+from ..client import get_client
+from ..services import STAGE_METRIC, ImageGenerationError, RetryableError
+from ..streaming import ArtifactStreamDecoder, StreamDecodeError, decode_artifacts
+from .. import circuit_breaker, metrics, rate_limit
+from .base import BaseBackend
+import logging
+
+logger = logging.getLogger(__name__)
+
+STABILITY_API_KEY = os.environ.get("STABILITY_API_KEY")
+# Only raise error in production or if explicitly required
+if not STABILITY_API_KEY and os.environ.get("REQUIRE_STABILITY_API", "false").lower() == "true":
+    raise RuntimeError("STABILITY_API_KEY environment variable not set.")
+
+DEFAULT_ENGINE = "stable-diffusion-xl-1024-v1-0"
+TEXT_TO_IMAGE_PATH = f"/v1/generation/{DEFAULT_ENGINE}/text-to-image"
+# Bytes read from the response at a time; bounds the memory used per generation
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Failed calls by ``category``: the HTTP status, "timeout", "connection",
+# "network" or "invalid_response"
+ERROR_METRIC = "stability_errors_total"
+# Duration of whole API calls (headers and body) by response ``status``
+UPSTREAM_METRIC = "stability_request_seconds"
+
+
+def _status_error(status_code, read_text, retry_after):
+    if status_code == 401:
+        return ImageGenerationError("Invalid API key. Please check your configuration.")
+    elif status_code == 403:
+        return ImageGenerationError("API access denied. Please check your account status.")
+    elif status_code == 429:
+        return RetryableError("Rate limit exceeded. Please try again later.", "rate_limited", retry_after)
+    elif status_code == 500:
+        return RetryableError(
+            "Stability AI service is currently unavailable. Please try again later.", "server_error", retry_after
+        )
+    elif status_code in (502, 503, 504):
+        return RetryableError(f"API error: {status_code} - {read_text()}", "server_error", retry_after)
+    return ImageGenerationError(f"API error: {status_code} - {read_text()}")
+
+
+def _check_status(status_code, read_text, headers=None):
+    """
+    Map an API status code to an ``ImageGenerationError``; ``read_text`` returns the body.
+
+    The error's ``status_code`` records that the API answered.
+    """
+    if status_code == 200:
+        return
+    metrics.inc(ERROR_METRIC, category=str(status_code))
+    retry_after = rate_limit.parse_retry_after((headers or {}).get("Retry-After"))
+    error = _status_error(status_code, read_text, retry_after)
+    error.status_code = status_code
+    raise error
+
+
+def _invalid_response():
+    error = ImageGenerationError("Invalid response from API")
+    error.status_code = 200
+    return error
+
+
+def _is_outage(error):
+    """Whether a failed call suggests the API is down, rather than that we are calling it too often"""
+    return error.reason != "rate_limited"
+
+
+def _answered(error):
+    """Whether the API replied to the call that failed with ``error``, proving it reachable"""
+    return getattr(error, "status_code", None) is not None
+
+
+def _retry_or_raise(error, attempt, prompt):
+    """
+    Return the seconds to wait before retrying after ``error``, or re-raise it.
+
+    The caller then holds every other caller back for the error's
+    ``retry_after``, if any, with ``rate_limit.block_for``.
+    """
+    delay = rate_limit.retry_delay(attempt, error.retry_after)
+    if attempt >= rate_limit.max_retries() or delay > rate_limit.max_wait():
+        raise error
+    metrics.inc("stability_retries_total", reason=error.reason)
+    logger.warning(f"Retrying generation in {delay:.1f}s after {error.reason} for prompt: {prompt[:50]}...")
+    return delay
+
+
+class StabilityBackend(BaseBackend):
+    """
+    Options: ``api_key`` (defaults to the ``STABILITY_API_KEY`` environment
+    variable) and ``engine``, the Stability engine id.
+    """
+
+    def __init__(self, api_key=None, engine=None, **options):
+        super().__init__(**options)
+        self.api_key = api_key
+        self.path = f"/v1/generation/{engine}/text-to-image" if engine else TEXT_TO_IMAGE_PATH
+
+    def _build_request(self, prompt, params, samples):
+        """Return the headers and JSON payload of an API call"""
+        api_key = self.api_key or STABILITY_API_KEY
+        # Check if API key is available
+        if not api_key:
+            raise ImageGenerationError("Stability AI API key not configured. Please set STABILITY_API_KEY environment variable.")
+
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        payload = {
+            "text_prompts": [{"text": prompt}],
+            "samples": samples,
+            **params,
+        }
+        return headers, payload
+
+    def generate(self, prompt, params, samples=1):
+        # Whether this call holds the circuit's half-open trial; its retries
+        # are part of the trial rather than new callers
+        trial = False
+        try:
+            for attempt in itertools.count():
+                trial = trial or circuit_breaker.stability.check()
+                try:
+                    rate_limit.acquire()
+                except rate_limit.RateLimitTimeout:
+                    raise ImageGenerationError("Rate limit exceeded. Please try again later.")
+                try:
+                    images = self._request_images(prompt, params, samples)
+                except ImageGenerationError as e:
+                    if isinstance(e, RetryableError) and _is_outage(e):
+                        circuit_breaker.stability.record_failure()
+                        trial = False
+                    elif _answered(e):
+                        circuit_breaker.stability.record_success()
+                        trial = False
+                    if not isinstance(e, RetryableError):
+                        raise
+                    delay = _retry_or_raise(e, attempt, prompt)
+                    if e.retry_after is not None:
+                        rate_limit.block_for(e.retry_after)
+                    time.sleep(delay)
+                else:
+                    circuit_breaker.stability.record_success()
+                    trial = False
+                    return images
+        finally:
+            if trial:
+                # The trial proved nothing either way: let the next caller make it
+                circuit_breaker.stability.release_trial()
+
+    def _request_images(self, prompt, params, samples):
+        """Make one API call for ``samples`` images"""
+        response = None
+        started = time.perf_counter()
+        try:
+            headers, payload = self._build_request(prompt, params, samples)
+
+            # Make API request over the pooled keep-alive session
+            with metrics.timer(STAGE_METRIC, stage="upstream"):
+                response = get_client().post(self.path, headers=headers, json=payload, stream=True)
+
+            # Handle different HTTP status codes
+            _check_status(response.status_code, lambda: response.text, response.headers)
+            response.raise_for_status()
+
+            # Decode the base64 artifacts as the body streams in, straight to disk
+            with metrics.timer(STAGE_METRIC, stage="decode"):
+                return decode_artifacts(response.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+
+        except StreamDecodeError as e:
+            metrics.inc(ERROR_METRIC, category="invalid_response")
+            logger.error(f"Malformed response while generating image: {str(e)}")
+            raise _invalid_response()
+        except requests.exceptions.Timeout:
+            metrics.inc(ERROR_METRIC, category="timeout")
+            logger.error(f"Timeout while generating image for prompt: {prompt[:50]}...")
+            raise RetryableError("Request timed out. Please try again.", "timeout")
+        except requests.exceptions.ConnectionError:
+            metrics.inc(ERROR_METRIC, category="connection")
+            logger.error(f"Connection error while generating image for prompt: {prompt[:50]}...")
+            raise RetryableError("Network connection error. Please check your internet connection.", "connection_error")
+        except requests.exceptions.RequestException as e:
+            metrics.inc(ERROR_METRIC, category="network")
+            logger.error(f"Request error while generating image: {str(e)}")
+            raise ImageGenerationError(f"Network error: {str(e)}")
+        finally:
+            if response is not None:
+                metrics.observe(UPSTREAM_METRIC, time.perf_counter() - started, status=response.status_code)
+                response.close()
+
+    async def agenerate(self, prompt, params, samples=1):
+        """Wait on the event loop rather than a thread, so one ASGI process can keep many calls in flight"""
+        trial = False
+        try:
+            for attempt in itertools.count():
+                trial = trial or await circuit_breaker.stability.acheck()
+                try:
+                    await rate_limit.aacquire()
+                except rate_limit.RateLimitTimeout:
+                    raise ImageGenerationError("Rate limit exceeded. Please try again later.")
+                try:
+                    images = await self._arequest_images(prompt, params, samples)
+                except ImageGenerationError as e:
+                    if isinstance(e, RetryableError) and _is_outage(e):
+                        await circuit_breaker.stability.arecord_failure()
+                        trial = False
+                    elif _answered(e):
+                        await circuit_breaker.stability.arecord_success()
+                        trial = False
+                    if not isinstance(e, RetryableError):
+                        raise
+                    delay = _retry_or_raise(e, attempt, prompt)
+                    if e.retry_after is not None:
+                        await rate_limit.ablock_for(e.retry_after)
+                    await asyncio.sleep(delay)
+                else:
+                    await circuit_breaker.stability.arecord_success()
+                    trial = False
+                    return images
+        finally:
+            if trial:
+                await circuit_breaker.stability.arelease_trial()
+
+    async def _arequest_images(self, prompt, params, samples):
+        """Make one API call for ``samples`` images without blocking the event loop"""
+        started = time.perf_counter()
+        status = None
+        try:
+            headers, payload = self._build_request(prompt, params, samples)
+
+            async with get_async_client().stream("POST", self.path, headers=headers, json=payload) as response:
+                metrics.observe(STAGE_METRIC, time.perf_counter() - started, stage="upstream")
+                status = response.status_code
+                if response.status_code != 200:
+                    body = (await response.aread()).decode("utf-8", errors="replace")
+                    _check_status(response.status_code, lambda: body, response.headers)
+
+                # Decode the base64 artifacts as the body streams in, straight to disk
+                with metrics.timer(STAGE_METRIC, stage="decode"):
+                    decoder = ArtifactStreamDecoder()
+                    try:
+                        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                            decoder.feed(chunk)
+                    except BaseException:
+                        decoder.discard()
+                        raise
+                    return decoder.close()
+
+        except StreamDecodeError as e:
+            metrics.inc(ERROR_METRIC, category="invalid_response")
+            logger.error(f"Malformed response while generating image: {str(e)}")
+            raise _invalid_response()
+        except httpx.TimeoutException:
+            metrics.inc(ERROR_METRIC, category="timeout")
+            logger.error(f"Timeout while generating image for prompt: {prompt[:50]}...")
+            raise RetryableError("Request timed out. Please try again.", "timeout")
+        except httpx.NetworkError:
+            metrics.inc(ERROR_METRIC, category="connection")
+            logger.error(f"Connection error while generating image for prompt: {prompt[:50]}...")
+            raise RetryableError("Network connection error. Please check your internet connection.", "connection_error")
+        except httpx.HTTPError as e:
+            metrics.inc(ERROR_METRIC, category="network")
+            logger.error(f"Request error while generating image: {str(e)}")
+            raise ImageGenerationError(f"Network error: {str(e)}")
+        finally:
+            if status is not None:
+                metrics.observe(UPSTREAM_METRIC, time.perf_counter() - started, status=status)
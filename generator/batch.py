@@ -0,0 +1,251 @@
+"""
+Batch generation: many prompts, or many variations of one prompt, per request.
+
+A batch request only queues one ``GenerationJob`` per item, all sharing a
+batch id, and answers with their ids: generating 50 images takes far longer
+than a gunicorn worker may hold a request. The worker that claims one of the
+jobs runs the whole batch with ``run_batch()`` (see ``jobs.run_job``).
+
+Items are grouped into as few API calls as possible (unseeded variations of
+the same prompt share one call through the API's ``samples`` parameter), the
+calls are fanned out over a bounded thread pool, and every resulting row is
+written with a single ``bulk_create``. A failing call only fails its own items.
+Variants are built after the rows are saved, see
+``variants.generate_variants_later``.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import connection
+
+from .circuit_breaker import CircuitOpenError
+from .models import Generation, GenerationJob
+from . import gallery_cache, metrics, result_cache, scheduling, services, variants
+from .storage import image_storage
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The API accepts at most this many samples per call
+MAX_SAMPLES_PER_CALL = 10
+
+
+def batch_limit():
+    return getattr(settings, "BATCH_MAX_ITEMS", 50)
+
+
+def parse_batch_request(data):
+    """
+    Turn request data into a list of ``{"prompt", "seed"}`` items.
+
+    Accepts ``{"prompts": [...]}``, ``{"prompt": ..., "count": N}`` or
+    ``{"prompt": ..., "seeds": [...]}``.
+    """
+    if data.get("prompts"):
+        prompts = data["prompts"]
+        if isinstance(prompts, str):
+            prompts = prompts.splitlines()
+        if not isinstance(prompts, list):
+            raise services.ImageGenerationError("prompts must be a list")
+        items = [{"prompt": str(prompt).strip(), "seed": None} for prompt in prompts if str(prompt).strip()]
+    elif data.get("prompt"):
+        prompt = str(data["prompt"]).strip()
+        seeds = data.get("seeds")
+        if seeds:
+            if not isinstance(seeds, list):
+                raise services.ImageGenerationError("seeds must be a list")
+            items = [{"prompt": prompt, "seed": parse_seed(seed)} for seed in seeds]
+        else:
+            try:
+                count = int(data.get("count") or 1)
+            except (TypeError, ValueError):
+                raise services.ImageGenerationError("count must be a whole number")
+            items = [{"prompt": prompt, "seed": None} for _ in range(max(count, 0))]
+    else:
+        raise services.ImageGenerationError("Provide a list of prompts, or a prompt with a count or seeds")
+
+    if not items:
+        raise services.ImageGenerationError("The batch is empty")
+    if len(items) > batch_limit():
+        raise services.ImageGenerationError(f"A batch can contain at most {batch_limit()} images")
+    return items
+
+
+def enqueue_batch(user, items):
+    """
+    Queue a job for each item, all in one batch; returns ``(results, jobs)``.
+
+    ``results`` has one dict per item, in order: ``status`` "queued" and
+    ``job_id``, or "failed" and ``error`` for an invalid prompt, which is
+    not queued.
+    """
+    batch_id = uuid.uuid4()
+    results = [{"index": index, "prompt": item["prompt"], "seed": item["seed"]} for index, item in enumerate(items)]
+    queued = {}
+    for index, item in enumerate(items):
+        try:
+            prompt = services.validate_prompt(item["prompt"])
+        except ValidationError as e:
+            results[index].update(status="failed", error="; ".join(e.messages))
+            continue
+        params = {"seed": item["seed"]} if item["seed"] is not None else {}
+        queued[index] = GenerationJob(user=user, prompt=prompt, params=params, batch=batch_id)
+
+    jobs = GenerationJob.objects.bulk_create(queued.values())
+    for index, job in zip(queued, jobs):
+        results[index].update(status="queued", job_id=job.pk)
+    return results, jobs
+
+
+def update_results(results):
+    """Bring the ``status`` of each queued item of ``results`` up to date with its job"""
+    jobs = GenerationJob.objects.in_bulk([result["job_id"] for result in results if "job_id" in result])
+    for result in results:
+        job = jobs.get(result.get("job_id"))
+        if job is None:
+            continue
+        result["status"] = job.status
+        if job.status == GenerationJob.Status.SUCCEEDED:
+            result["generation_id"] = job.generation_id
+        elif job.status == GenerationJob.Status.FAILED:
+            result["error"] = job.error
+    return results
+
+
+def parse_seed(seed):
+    """``seed`` as a whole number of zero or more, as the generate form accepts it"""
+    text = str(seed).strip()
+    if isinstance(seed, bool) or not text.isdigit():
+        raise services.ImageGenerationError("Seeds must be positive whole numbers")
+    return int(text)
+
+
+def _plan_calls(pending):
+    """Group pending item indices into API calls, sharing calls for unseeded variations"""
+    calls = []
+    unseeded = {}
+    for index, item in pending:
+        if item["seed"] is not None:
+            calls.append((item["prompt"], {"seed": item["seed"]}, [index]))
+        else:
+            unseeded.setdefault(item["prompt"], []).append(index)
+    for prompt, indices in unseeded.items():
+        for start in range(0, len(indices), MAX_SAMPLES_PER_CALL):
+            calls.append((prompt, {}, indices[start:start + MAX_SAMPLES_PER_CALL]))
+    return calls
+
+
+def _execute_call(prompt, params, samples):
+    """Generate and store ``samples`` images; runs on a pool thread and creates no rows"""
+    try:
+        image_files = services.generate_images_from_prompt(prompt, params, samples)
+        stored = []
+        try:
+            for image_file in image_files:
+                with metrics.timer(services.STAGE_METRIC, stage="storage"):
+                    name = default_storage.save(services.image_upload_name(image_file.name), image_file)
+                stored.append({
+                    "name": name,
+                    "seed": getattr(image_file, "artifact", {}).get("seed"),
+                    "fields": services.image_fields(image_file),
+                })
+        finally:
+            for image_file in image_files:
+                image_file.close()
+        return stored
+    finally:
+        # Moderation, the rate limiter and the circuit breaker may have
+        # queried the database on this thread
+        connection.close()
+
+
+def run_batch(user, items, held_slots=0):
+    """
+    Generate every item and return one result dict per item, in order.
+
+    Each result has ``status`` ("succeeded" or "failed") and either
+    ``generation_id`` or ``error``; ``circuit_open`` marks items that failed
+    because the API was known to be down. The calls run in parallel on the
+    ``held_slots`` of the user's concurrency slots the caller holds and as
+    many more as are free, up to ``BATCH_CONCURRENCY``; raises
+    ``ConcurrencyLimitReached`` when the caller holds none and none is free.
+    """
+    results = [{"index": index, "prompt": item["prompt"], "seed": item["seed"]} for index, item in enumerate(items)]
+    rows = {}
+    cache_keys = {}
+
+    pending = []
+    for index, item in enumerate(items):
+        try:
+            item["prompt"] = services.validate_prompt(item["prompt"])
+        except ValidationError as e:
+            results[index].update(status="failed", error="; ".join(e.messages))
+            continue
+
+        # Seeded items are deterministic and can be answered from the result cache
+        params = services.generation_params({"seed": item["seed"]})
+        if result_cache.is_cacheable(params) and item["seed"] is not None:
+            key = result_cache.cache_key(item["prompt"], params)
+            cached = result_cache.lookup(key)
+            if cached:
+                rows[index] = Generation(user=user, prompt=item["prompt"], image=cached["name"], **cached["fields"])
+                continue
+            cache_keys[index] = key
+        pending.append((index, item))
+
+    calls = _plan_calls(pending)
+    concurrency = getattr(settings, "BATCH_CONCURRENCY", 4)
+    if calls:
+        with (
+            scheduling.generation_slots(user, min(concurrency, len(calls)), held_slots) as slots,
+            ThreadPoolExecutor(max_workers=slots) as pool,
+        ):
+            futures = [
+                (pool.submit(_execute_call, prompt, params, len(indices)), indices)
+                for prompt, params, indices in calls
+            ]
+            for future, indices in futures:
+                try:
+                    stored = future.result()
+                except services.ImageGenerationError as e:
+                    for index in indices:
+                        results[index].update(status="failed", error=str(e))
+                        if isinstance(e, CircuitOpenError):
+                            results[index]["circuit_open"] = True
+                    continue
+                except Exception as e:
+                    logger.error(f"Unexpected error in batch generation: {str(e)}")
+                    for index in indices:
+                        results[index].update(status="failed", error="An unexpected error occurred. Please try again.")
+                    continue
+
+                for index, image in zip(indices, stored):
+                    rows[index] = Generation(
+                        user=user,
+                        prompt=items[index]["prompt"],
+                        image=image["name"],
+                        **image["fields"],
+                    )
+                    if results[index]["seed"] is None:
+                        results[index]["seed"] = image["seed"]
+                    if index in cache_keys:
+                        result_cache.store(cache_keys[index], image["name"], image["fields"])
+                for index in indices[len(stored):]:
+                    results[index].update(status="failed", error="The API returned fewer images than requested")
+
+    # One INSERT for the whole batch
+    ordered = sorted(rows)
+    with metrics.timer(services.STAGE_METRIC, stage="db"):
+        created = Generation.objects.bulk_create([rows[index] for index in ordered])
+        # bulk_create sends no post_save signals; count the image references here
+        storage = image_storage()
+        if hasattr(storage, "retain"):
+            storage.retain([generation.image.name for generation in created])
+        gallery_cache.invalidate([generation.user_id for generation in created])
+    variants.generate_variants_later(created)
+    for index, generation in zip(ordered, created):
+        results[index].update(status="succeeded", generation_id=generation.pk)
+    return results
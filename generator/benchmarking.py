@@ -0,0 +1,242 @@
+"""
+End-to-end load harness for the generation flow.
+
+Every simulated user logs in, generates an image, opens the result page and
+then the gallery, through Django's test client against a local stub Stability
+API (``testing.StubStabilityServer``) or the offline ``LocalBackend``. Flows run
+on ``concurrency`` threads in each of ``processes`` forked worker processes,
+like gunicorn workers sharing one database.
+
+Each request's latency and database query count is recorded per view, and
+each worker reports its peak RSS. ``run_benchmark`` returns the summary as a
+JSON-serialisable dict so results can be diffed between releases.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from .testing import StubStabilityServer, make_png
+
+VIEWS = ("login", "generate", "result", "gallery")
+USERNAME_PREFIX = "benchmark-user-"
+PASSWORD = "benchmark-password"
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values``"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(values):
+    if not values:
+        return {"mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _QueryCounter:
+    """``connection.execute_wrapper`` that counts the queries of one request"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _timed(samples, view, expected_status, call, *args, **kwargs):
+    counter = _QueryCounter()
+    started = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        response = call(*args, **kwargs)
+    samples.append({
+        "view": view,
+        "seconds": time.perf_counter() - started,
+        "queries": counter.count,
+        "ok": response.status_code == expected_status,
+    })
+    return response
+
+
+def run_flow(client, username, prompt, samples):
+    """login -> generate -> result -> gallery; returns whether every step succeeded"""
+    response = _timed(samples, "login", 302, client.post, reverse("login"), {
+        "username": username,
+        "password": PASSWORD,
+    })
+    if response.status_code != 302:
+        return False
+    response = _timed(samples, "generate", 302, client.post, reverse("generate"), {"prompt": prompt})
+    if response.status_code != 302:
+        return False
+    result = _timed(samples, "result", 200, client.get, response["Location"])
+    gallery = _timed(samples, "gallery", 200, client.get, reverse("user_gallery"))
+    return result.status_code == 200 and gallery.status_code == 200
+
+
+def _run_thread(username, flows, worker_index):
+    client = Client(raise_request_exception=False)
+    samples = []
+    try:
+        for flow in range(flows):
+            run_flow(client, username, f"Benchmark prompt {worker_index} {username} {flow}", samples)
+    finally:
+        connection.close()
+    return samples
+
+
+def run_worker(usernames, flows, worker_index=0):
+    """Run ``flows`` flows for each user on its own thread; returns this worker's samples and peak RSS"""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(usernames)) as pool:
+        threads = [pool.submit(_run_thread, username, flows, worker_index) for username in usernames]
+        samples = [sample for thread in threads for sample in thread.result()]
+    return {
+        "pid": os.getpid(),
+        "seconds": time.perf_counter() - started,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "samples": samples,
+    }
+
+
+def _forked_worker(usernames, flows, worker_index, results):
+    connections.close_all()
+    try:
+        results.put(run_worker(usernames, flows, worker_index))
+    finally:
+        connections.close_all()
+
+
+def benchmark_settings(api_url, media_root, backend, latency):
+    """Settings for a run: inline jobs, no pacing or quotas, throwaway media"""
+    overrides = {
+        "ALLOWED_HOSTS": ["testserver"],
+        "MEDIA_ROOT": media_root,
+        "GENERATION_JOBS_EAGER": True,
+        "GENERATION_CACHE_ENABLED": False,
+        "GENERATION_USER_DAILY_QUOTA": None,
+        "GENERATION_USER_MONTHLY_QUOTA": None,
+        "STABILITY_RATE_LIMIT": 0,
+    }
+    if backend == "local":
+        overrides["GENERATION_BACKEND"] = "generator.backends.local.LocalBackend"
+        overrides["GENERATION_BACKEND_OPTIONS"] = {"latency": latency, "size": (512, 512)}
+    else:
+        overrides["GENERATION_BACKEND"] = "generator.backends.stability.StabilityBackend"
+        overrides["GENERATION_BACKEND_OPTIONS"] = {"api_key": "benchmark"}
+        overrides["STABILITY_API_HOST"] = api_url
+    return override_settings(**overrides)
+
+
+def build_report(workers, config, elapsed):
+    samples = [sample for worker in workers for sample in worker["samples"]]
+    flows = config["processes"] * config["concurrency"] * config["flows"]
+    views = {}
+    for view in VIEWS:
+        view_samples = [sample for sample in samples if sample["view"] == view]
+        latencies = [sample["seconds"] * 1000 for sample in view_samples]
+        queries = [sample["queries"] for sample in view_samples]
+        views[view] = {
+            "requests": len(view_samples),
+            "errors": sum(1 for sample in view_samples if not sample["ok"]),
+            "latency_ms": {name: round(value, 2) if value is not None else None
+                           for name, value in summarize(latencies).items()},
+            "queries": {"mean": round(sum(queries) / len(queries), 2) if queries else None,
+                        "max": max(queries) if queries else None},
+        }
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "cpu_count": os.cpu_count(),
+        },
+        "config": config,
+        "duration_s": round(elapsed, 3),
+        "flows": flows,
+        "throughput": {
+            "flows_per_s": round(flows / elapsed, 2),
+            "requests_per_s": round(len(samples) / elapsed, 2),
+        },
+        "errors": sum(1 for sample in samples if not sample["ok"]),
+        "views": views,
+        "workers": [{"pid": worker["pid"], "peak_rss_mb": worker["peak_rss_mb"]} for worker in workers],
+    }
+
+
+def run_benchmark(processes=1, concurrency=4, flows=5, delay=0.5, backend="stub", image_size=256, label=""):
+    """
+    Drive ``processes * concurrency`` simulated users through ``flows`` flows each.
+
+    ``delay`` is the upstream generation time in seconds (stub server or local
+    backend). Benchmark users are created up front and deleted, with their
+    generations and jobs, afterwards.
+    """
+    config = {
+        "label": label,
+        "processes": processes,
+        "concurrency": concurrency,
+        "flows": flows,
+        "delay": delay,
+        "backend": backend,
+        "image_size": image_size,
+    }
+    usernames = [f"{USERNAME_PREFIX}{index}" for index in range(processes * concurrency)]
+    User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+    for username in usernames:
+        User.objects.create_user(username=username, password=PASSWORD)
+
+    api = StubStabilityServer(image=make_png((image_size, image_size)), delay=delay)
+    try:
+        with api, tempfile.TemporaryDirectory() as media_root, \
+                benchmark_settings(api.url, media_root, backend, delay):
+            started = time.perf_counter()
+            if processes == 1:
+                workers = [run_worker(usernames, flows)]
+            else:
+                context = multiprocessing.get_context("fork")
+                results = context.Queue()
+                connections.close_all()
+                children = [
+                    context.Process(
+                        target=_forked_worker,
+                        args=(usernames[index::processes], flows, index, results),
+                    )
+                    for index in range(processes)
+                ]
+                for child in children:
+                    child.start()
+                workers = [results.get() for _ in children]
+                for child in children:
+                    child.join()
+            elapsed = time.perf_counter() - started
+    finally:
+        User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+    return build_report(workers, config, elapsed)
@@ -0,0 +1,197 @@
+"""
+Circuit breaker around calls to the image generation API.
+
+During an outage every call would otherwise wait out its timeout, tying up
+every worker until the site's other pages stop responding too. Instead, once
+``CIRCUIT_BREAKER_FAILURE_THRESHOLD`` calls have timed out, failed to connect
+or got a server error within ``CIRCUIT_BREAKER_WINDOW`` seconds, the circuit
+opens: for ``CIRCUIT_BREAKER_OPEN_SECONDS`` calls fail at once with
+``CircuitOpenError``, and the job worker leaves queued jobs queued. After that
+a single trial call is let through (half-open). Its success closes the
+circuit, and its failure opens it again. Any answer from the API other than
+an outage, a 400 or a 429 say, counts as success: the API is reachable. A
+trial that ends with no answer at all is released for the next caller, and
+retries within the trial do not compete for it.
+
+Like the rate limiter's counters, the state lives in the Django cache, so with a
+shared backend (Redis) every process sees the same circuit. Each transition is
+recorded as a ``CircuitTransition`` row, listed in the admin, and counted in
+the ``circuit_breaker_transitions_total`` metric.
+"""
+import math
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import CircuitTransition
+from .services import ImageGenerationError
+from . import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+State = CircuitTransition.State
+# Value of the ``circuit_breaker_state`` gauge for each state
+STATE_GAUGE = {State.CLOSED: 0, State.HALF_OPEN: 1, State.OPEN: 2}
+
+
+class CircuitOpenError(ImageGenerationError):
+    """Calls are not being made while the circuit is open"""
+
+    def __init__(self, retry_after):
+        super().__init__(
+            f"Image generation is temporarily unavailable. Please try again in {math.ceil(retry_after)} seconds."
+        )
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Coalesced requests get the leader's error through the cache
+        return type(self), (self.retry_after,), self.__dict__
+
+
+def _cache():
+    return caches[getattr(settings, "CIRCUIT_BREAKER_CACHE", "default")]
+
+
+def enabled():
+    return getattr(settings, "CIRCUIT_BREAKER_ENABLED", True)
+
+
+def open_seconds():
+    return getattr(settings, "CIRCUIT_BREAKER_OPEN_SECONDS", 30)
+
+
+class CircuitBreaker:
+    """The shared state of the circuit called ``name``"""
+
+    def __init__(self, name):
+        self.name = name
+        self.key_prefix = f"circuit-breaker:{name}"
+        self.state_key = f"{self.key_prefix}:state"
+        self.trial_key = f"{self.key_prefix}:trial"
+
+    def state(self):
+        """The current state and, unless closed, when the circuit opened until"""
+        current = _cache().get(self.state_key)
+        if current is None:
+            return State.CLOSED, None
+        return current["state"], current["until"]
+
+    def retry_after(self):
+        """Seconds until a call may be made: 0 when closed or ready for a trial call"""
+        state, until = self.state()
+        if state == State.CLOSED:
+            return 0
+        if _cache().get(self.trial_key):
+            # Another caller's trial call decides; look again shortly
+            return 1
+        return max(until - time.time(), 0)
+
+    def check(self):
+        """
+        Raise ``CircuitOpenError`` unless a call may be made now.
+
+        Returns True when the call is the half-open trial; the caller then
+        reports its outcome with ``record_success``/``record_failure``, or
+        gives the trial up with ``release_trial``.
+        """
+        if not enabled():
+            return False
+        cache = _cache()
+        current = cache.get(self.state_key)
+        if current is None:
+            return False
+
+        wait = current["until"] - time.time()
+        # The open period is over: one caller at a time makes a trial call.
+        # Its key expires, so a trial that never reports back is retried.
+        if wait <= 0 and cache.add(self.trial_key, True, timeout=self._trial_timeout()):
+            if current["state"] == State.OPEN:
+                cache.set(self.state_key, {"state": State.HALF_OPEN, "until": current["until"]}, timeout=None)
+                self._transition(State.OPEN, State.HALF_OPEN)
+            return True
+        metrics.inc("circuit_breaker_rejections_total", circuit=self.name)
+        raise CircuitOpenError(max(wait, 1))
+
+    def record_success(self):
+        if not enabled():
+            return
+        cache = _cache()
+        current = cache.get(self.state_key)
+        if current is not None:
+            cache.delete_many([self.state_key, self.trial_key])
+            self._transition(current["state"], State.CLOSED)
+
+    def release_trial(self):
+        """Let another caller make the trial call, after one that ended without an answer from the API"""
+        _cache().delete(self.trial_key)
+
+    def record_failure(self):
+        """Count a failed call, opening the circuit when the threshold is reached"""
+        if not enabled():
+            return
+        cache = _cache()
+        now = time.time()
+        current = cache.get(self.state_key)
+        if current is not None:
+            if current["state"] == State.HALF_OPEN:
+                cache.set(self.state_key, {"state": State.OPEN, "until": now + open_seconds()}, timeout=None)
+                cache.delete(self.trial_key)
+                self._transition(State.HALF_OPEN, State.OPEN)
+            return
+
+        window = getattr(settings, "CIRCUIT_BREAKER_WINDOW", 60)
+        key = f"{self.key_prefix}:failures:{int(now // window)}"
+        cache.add(key, 0, timeout=math.ceil(window) * 2)
+        try:
+            failures = cache.incr(key)
+        except ValueError:
+            # Evicted between add() and incr()
+            failures = 1
+            cache.set(key, failures, timeout=math.ceil(window) * 2)
+
+        threshold = getattr(settings, "CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5)
+        # add() lets exactly one process open the circuit
+        if failures >= threshold and cache.add(
+            self.state_key, {"state": State.OPEN, "until": now + open_seconds()}, timeout=None
+        ):
+            self._transition(State.CLOSED, State.OPEN, failures)
+
+    def reset(self):
+        """Close the circuit, e.g. from the admin once the API is known to be back"""
+        state, _ = self.state()
+        _cache().delete_many([self.state_key, self.trial_key])
+        if state != State.CLOSED:
+            self._transition(state, State.CLOSED)
+
+    def _trial_timeout(self):
+        # Longer than any one call can take
+        return math.ceil(getattr(settings, "STABILITY_READ_TIMEOUT", 60) * 2)
+
+    def _transition(self, from_state, to_state, failures=0):
+        log = logger.error if to_state == State.OPEN else logger.warning
+        log(f"Circuit {self.name} {from_state} -> {to_state}")
+        metrics.inc("circuit_breaker_transitions_total", circuit=self.name, to=to_state)
+        metrics.set_gauge("circuit_breaker_state", STATE_GAUGE[to_state], circuit=self.name)
+        CircuitTransition.objects.create(
+            circuit=self.name, from_state=from_state, to_state=to_state, failures=failures
+        )
+
+    # The cache and the transition log are synchronous
+    async def acheck(self):
+        return await sync_to_async(self.check)()
+
+    async def arecord_success(self):
+        await sync_to_async(self.record_success)()
+
+    async def arecord_failure(self):
+        await sync_to_async(self.record_failure)()
+
+    async def arelease_trial(self):
+        await sync_to_async(self.release_trial)()
+
+
+# Shared by every call to the Stability API
+stability = CircuitBreaker("stability")
@@ -0,0 +1,164 @@
+"""
+Process-wide pooled HTTP client for the Stability AI API.
+
+A single ``requests.Session`` is shared by every thread of a process so TCP and
+TLS connections to the API are kept alive and reused instead of paying a DNS
+lookup and handshake on each generation. The session is rebuilt after ``fork()``
+so gunicorn workers never share sockets inherited from the master.
+"""
+import os
+import socket
+import threading
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import requests
+
+from . import metrics
+
+DEFAULT_BASE_URL = "https://api.stability.ai"
+
+# Number of TCP connections opened by the current thread. urllib3 connects in
+# the calling thread, so comparing this before and after a request tells us
+# whether the request reused a pooled connection.
+_connects = threading.local()
+
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+
+def _connection_count():
+    return getattr(_connects, "count", 0)
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _connects.count = _connection_count() + 1
+        super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _connects.count = _connection_count() + 1
+        super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools count new connections and enable TCP keep-alive"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", KEEPALIVE_SOCKET_OPTIONS)
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+class StabilityClient:
+    """Keep-alive connection pool to the Stability API shared by a whole process"""
+
+    def __init__(self, base_url=None, pool_size=None, connect_timeout=None, read_timeout=None):
+        self.base_url = (base_url or getattr(settings, "STABILITY_API_HOST", DEFAULT_BASE_URL)).rstrip("/")
+        self.pool_size = pool_size or getattr(settings, "STABILITY_POOL_SIZE", 10)
+        self.timeout = (
+            connect_timeout or getattr(settings, "STABILITY_CONNECT_TIMEOUT", 5),
+            read_timeout or getattr(settings, "STABILITY_READ_TIMEOUT", 60),
+        )
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._requests = 0
+        self._new_connections = 0
+
+    @property
+    def session(self):
+        """The pooled session, rebuilt if this process was forked since it was created"""
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _build_session(self):
+        session = requests.Session()
+        adapter = KeepAliveAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Connection"] = "keep-alive"
+        return session
+
+    def post(self, path, **kwargs):
+        """POST to ``path`` on the API, reusing a pooled connection when one is idle"""
+        kwargs.setdefault("timeout", self.timeout)
+        before = _connection_count()
+        response = self.session.post(f"{self.base_url}{path}", **kwargs)
+        opened = _connection_count() - before
+
+        response.connection_reused = opened == 0
+        with self._lock:
+            self._requests += 1
+            self._new_connections += opened
+        metrics.inc("stability_http_requests_total", connection="reused" if opened == 0 else "new")
+        return response
+
+    def stats(self):
+        """Requests sent and connections opened by this client in this process"""
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "new_connections": self._new_connections,
+                "reused_connections": max(self._requests - self._new_connections, 0),
+            }
+
+    def reset_after_fork(self):
+        # Drop, rather than close, sockets inherited from the parent process:
+        # closing them here could tear down connections the parent still uses.
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._requests = 0
+        self._new_connections = 0
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide ``StabilityClient``"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = StabilityClient()
+    return _client
+
+
+def _reset_client_after_fork():
+    global _client_lock
+    _client_lock = threading.Lock()
+    if _client is not None:
+        _client.reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client_after_fork)
@@ -0,0 +1,70 @@
+"""
+Conditional GET for the result and gallery pages.
+
+A generation does not change once its variants are built, and a gallery only
+changes when one of its generations does or a row is added or deleted. Both
+pages are sent with a strong ``ETag`` computed from values the view loads
+anyway (the generation row; the gallery's version in ``gallery_cache``), and with
+``Cache-Control: private, no-cache`` so browsers keep them but ask first. A
+request whose ``If-None-Match`` matches gets a 304 before any template is
+rendered.
+
+The tag also covers the user, the query string, ``PAGE_ETAG_VERSION`` (change
+it when a release changes these pages) and, when the storage presigns image
+URLs, the period those URLs stay valid in, so a kept page never links expired
+images. While flash messages are pending the page is always rendered, or they
+would not be shown.
+
+``Last-Modified`` is not sent: variants are added after ``created_at``.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib import messages
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
+
+from .storage import url_lifetime
+from . import metrics
+
+
+def _url_period():
+    """Index of the current half of the presigned URL lifetime, or None when URLs do not expire"""
+    lifetime = url_lifetime()
+    if lifetime is None:
+        return None
+    return int(time.time() // max(lifetime // 2, 1))
+
+
+def page_etag(request, *parts):
+    """A strong ETag for the page of ``request`` rendered from ``parts``"""
+    key = [request.user.pk, request.get_full_path(), getattr(settings, "PAGE_ETAG_VERSION", ""), _url_period()]
+    key.extend(parts)
+    return quote_etag(hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:32])
+
+
+def _finish(response, etag):
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ("Cookie",))
+    return response
+
+
+def not_modified(request, etag, view):
+    """A 304 response when the browser's copy of the page is current, else None"""
+    if len(messages.get_messages(request)):
+        return None
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        metrics.inc("conditional_requests_total", view=view, outcome="rendered")
+        return None
+    metrics.inc("conditional_requests_total", view=view, outcome="not_modified")
+    return _finish(response, etag)
+
+
+def cacheable(response, etag):
+    """Mark a rendered page as revalidated with ``etag``"""
+    if response.status_code == 200:
+        _finish(response, etag)
+    return response
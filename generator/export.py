@@ -0,0 +1,148 @@
+"""
+Streaming ZIP export of a user's gallery.
+
+``archive()`` yields the bytes of a ZIP archive of the user's images, newest
+first, while it builds it. ``zipfile`` writes into an unseekable ``_Sink``
+emptied after every write, so each entry is sent as a local header, its data
+and a data descriptor, and the central directory follows the last entry (in
+its ZIP64 form once the archive passes 4 GiB). Images are read
+``CHUNK_SIZE`` bytes at a time and stored uncompressed: PNG and WebP are
+compressed already and deflate gains little on them. Memory stays at one
+chunk and one batch of rows however large the archive grows.
+
+Generations are read ``EXPORT_BATCH_SIZE`` at a time with keyset pagination.
+After each batch's images the archive gets ``manifest/NNNNN.json``, listing
+their prompts, timestamps and file names, and the cursor that follows them. A
+cut-off download still holds every manifest part written before the cut (a
+streaming unzip reads them without the central directory); passing the last
+one's ``next_cursor`` back as ``?cursor=`` exports the rest.
+
+A gunicorn sync worker is killed after its timeout, long before a multi-GB
+download ends, so nginx sends exports to the ASGI service, where
+``aiter_chunks()`` runs the archive on the request's own thread.
+"""
+import json
+import posixpath
+import zipfile
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import Generation
+from .pagination import keyset_page
+from . import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+
+class _Sink:
+    """Write-only, unseekable file that hands what ``zipfile`` wrote to ``drain()``"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def entry_name(generation):
+    """Name of the image of ``generation`` in the archive, in date order within its directory"""
+    extension = posixpath.splitext(generation.image.name)[1].lower() or ".png"
+    return f"images/{timezone.localtime(generation.created_at):%Y-%m-%d_%H-%M-%S}_{generation.pk}{extension}"
+
+
+def _entry(name, moment, compress_type):
+    info = zipfile.ZipInfo(name, date_time=timezone.localtime(moment).timetuple()[:6])
+    info.compress_type = compress_type
+    return info
+
+
+def _write_entry(zip_file, sink, info, chunks):
+    with zip_file.open(info, "w") as entry:
+        for chunk in chunks:
+            entry.write(chunk)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _manifest_item(generation, name):
+    return {
+        "id": generation.pk,
+        "prompt": generation.prompt,
+        "created_at": generation.created_at.isoformat(),
+        "file": name,
+    }
+
+
+def _entries(user, cursor, sink, zip_file):
+    batch_size = getattr(settings, "EXPORT_BATCH_SIZE", 100)
+    generations = Generation.objects.filter(user=user)
+    part = 0
+    while True:
+        batch, cursor = keyset_page(generations, cursor, batch_size)
+        items = []
+        for generation in batch:
+            try:
+                image = default_storage.open(generation.image.name, "rb")
+            except FileNotFoundError:
+                logger.warning(f"Image {generation.image.name} of generation {generation.pk} missing from export")
+                items.append(_manifest_item(generation, None))
+                continue
+            name = entry_name(generation)
+            with image:
+                chunks = iter(lambda: image.read(CHUNK_SIZE), b"")
+                yield from _write_entry(zip_file, sink, _entry(name, generation.created_at, zipfile.ZIP_STORED), chunks)
+            items.append(_manifest_item(generation, name))
+
+        part += 1
+        manifest = json.dumps({"items": items, "next_cursor": cursor}, indent=2).encode("utf-8")
+        info = _entry(f"manifest/{part:05d}.json", timezone.now(), zipfile.ZIP_DEFLATED)
+        yield from _write_entry(zip_file, sink, info, [manifest])
+        if cursor is None:
+            return
+
+
+def archive(user, cursor=None):
+    """Yield the ZIP archive of ``user``'s images after ``cursor`` and their manifest, piece by piece"""
+    metrics.inc("gallery_exports_total", resumed=str(bool(cursor)).lower())
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w") as zip_file:
+        for data in _entries(user, cursor, sink, zip_file):
+            if data:
+                metrics.inc("gallery_export_bytes_total", len(data))
+                yield data
+    # The central directory, written by close()
+    data = sink.drain()
+    metrics.inc("gallery_export_bytes_total", len(data))
+    yield data
+
+
+async def aiter_chunks(chunks):
+    """Iterate the synchronous ``chunks`` asynchronously, each step on the request's thread"""
+    chunks = iter(chunks)
+    step = sync_to_async(next, thread_sensitive=True)
+    try:
+        while (chunk := await step(chunks, None)) is not None:
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            await sync_to_async(chunks.close, thread_sensitive=True)()
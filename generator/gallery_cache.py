@@ -0,0 +1,141 @@
+"""
+Cache of rendered gallery pages.
+
+Each gallery item is rendered once and cached under its generation and the
+fields it shows, so an item whose variants are built later is simply rendered
+again. Whole pages (the items' HTML, the next cursor and, for
+the first page, the stats block) are cached per user and cursor together
+with the user's gallery version, per view (the gallery and its infinite
+scroll fragments). A repeat load reads the version and the page
+in one ``get_many`` and runs no queries or template rendering for the items;
+the version also serves as the gallery's ETag.
+
+The version is a random token replaced whenever one of the user's generations
+is saved or deleted (``post_save``/``post_delete``; again once the
+transaction commits, so a page read before the commit is not kept), and
+explicitly where rows change without signals: ``bulk_create`` in batches,
+variants recorded with ``update()``, ``rehome_images``.
+
+Entries live in the ``GALLERY_CACHE`` cache for ``GALLERY_CACHE_TIMEOUT``
+seconds, and for at most half the lifetime of presigned image URLs. The cache
+must be shared by every process that writes generations (Redis in
+production), or galleries lag behind the worker.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import Generation
+from .storage import url_lifetime
+from . import metrics
+
+KEY_PREFIX = "gallery"
+ITEM_TEMPLATE = "generator/includes/gallery_item.html"
+
+
+def _cache():
+    return caches[getattr(settings, "GALLERY_CACHE", "default")]
+
+
+def timeout():
+    configured = getattr(settings, "GALLERY_CACHE_TIMEOUT", 24 * 3600)
+    lifetime = url_lifetime()
+    if lifetime is not None:
+        configured = min(configured, lifetime // 2)
+    return configured
+
+
+def _version_key(user_id):
+    return f"{KEY_PREFIX}:version:{user_id}"
+
+
+def _page_key(user_id, view, cursor):
+    return f"{KEY_PREFIX}:page:{user_id}:{view}:{cursor or ''}"
+
+
+def _item_key(generation):
+    shown = (generation.prompt, generation.created_at, generation.image.name, generation.variants)
+    digest = hashlib.sha256(repr(shown).encode("utf-8")).hexdigest()[:16]
+    return f"{KEY_PREFIX}:item:{generation.pk}:{digest}"
+
+
+def get_page(user_id, view, cursor):
+    """The user's gallery version and the page of ``view`` cached for it, or None"""
+    cache = _cache()
+    version_key, page_key = _version_key(user_id), _page_key(user_id, view, cursor)
+    values = cache.get_many([version_key, page_key])
+    version = values.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(version_key)
+    page = values.get(page_key)
+    if page is not None and page["version"] == version:
+        metrics.inc("gallery_cache_requests_total", kind="page", outcome="hit")
+        page["html"] = mark_safe(page["html"])
+        return version, page
+    metrics.inc("gallery_cache_requests_total", kind="page", outcome="miss")
+    return version, None
+
+
+def set_page(user_id, view, cursor, version, page):
+    """Cache ``page`` (``html``, ``next_cursor`` and optionally ``stats``) for ``version``"""
+    _cache().set(_page_key(user_id, view, cursor), {**page, "html": str(page["html"]), "version": version},
+                 timeout=timeout())
+
+
+def render_items(generations):
+    """The gallery items of ``generations`` as HTML, rendering only those not cached"""
+    cache = _cache()
+    keys = [_item_key(generation) for generation in generations]
+    cached = cache.get_many(keys)
+    missing = {}
+    for key, generation in zip(keys, generations):
+        if key not in cached:
+            missing[key] = render_to_string(ITEM_TEMPLATE, {"generation": generation})
+    if missing:
+        cache.set_many(missing, timeout=timeout())
+    metrics.inc("gallery_cache_requests_total", len(keys) - len(missing), kind="item", outcome="hit")
+    metrics.inc("gallery_cache_requests_total", len(missing), kind="item", outcome="miss")
+    return mark_safe("".join(cached.get(key) or missing[key] for key in keys))
+
+
+def _new_versions(user_ids):
+    _cache().set_many({_version_key(user_id): uuid.uuid4().hex for user_id in user_ids}, timeout=None)
+
+
+def invalidate(user_ids):
+    """Give the galleries of ``user_ids`` a new version, now and again once the transaction commits"""
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+    _new_versions(user_ids)
+    # A page rendered before the commit, without the change, may have been
+    # cached under the version just set
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _new_versions(user_ids))
+
+
+def invalidate_image(image_name, rows=None, user_id=None):
+    """
+    Invalidate the galleries showing ``image_name`` after ``rows`` rows using
+    it were updated. When that was a single row, of ``user_id``, its users
+    need not be looked up.
+    """
+    if rows == 1 and user_id is not None:
+        invalidate([user_id])
+    else:
+        invalidate(Generation.objects.filter(image=image_name).values_list("user_id", flat=True).distinct())
+
+
+@receiver(post_save, sender=Generation)
+@receiver(post_delete, sender=Generation)
+def _generation_changed(instance, raw=False, **kwargs):
+    if not raw:
+        invalidate([instance.user_id])
@@ -0,0 +1,168 @@
+"""
+Database-backed queue for image generation.
+
+The ``generate`` view only enqueues a ``GenerationJob``; the slow upstream call
+is made by the ``generation_worker`` management command. Jobs are claimed with
+``SELECT ... FOR UPDATE SKIP LOCKED`` so several worker processes can drain the
+same Postgres table without an external broker. Users are served round-robin
+and quotas are checked on enqueue (see ``scheduling``).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .circuit_breaker import CircuitOpenError
+from .models import GenerationJob
+from . import batch, scheduling, services, variants
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def jobs_run_eagerly():
+    """Whether jobs are executed inline by the view instead of by a worker"""
+    return getattr(settings, "GENERATION_JOBS_EAGER", False)
+
+
+def enqueue_generation(user, prompt, params=None):
+    """Validate ``prompt``, check ``user``'s quota and queue a generation job"""
+    try:
+        validated_prompt = services.validate_prompt(prompt)
+    except ValidationError as e:
+        raise services.ImageGenerationError("; ".join(e.messages))
+
+    if user is not None:
+        scheduling.check_quota(user)
+
+    return GenerationJob.objects.create(user=user, prompt=validated_prompt, params=params or {})
+
+
+def claim_next_job():
+    """
+    Atomically move the next queued job to ``running`` and return it.
+
+    The next job is the oldest one of the user who has waited longest for a
+    turn, skipping users at their concurrency limit. Rows locked by another
+    worker are skipped rather than waited on, so concurrent workers never
+    claim the same job; the user's concurrency slot taken with it keeps them
+    from starting more of one user's jobs than allowed. Returns ``None`` when
+    nothing can be started.
+    """
+    with transaction.atomic():
+        queue = scheduling.fair_queue(GenerationJob.objects.select_for_update(skip_locked=True))
+        busy = []
+        while True:
+            job = queue.exclude(user__in=busy).first()
+            if job is None:
+                return None
+            if scheduling.acquire_slots(job.user_id):
+                break
+            busy.append(job.user_id)
+        job.status = GenerationJob.Status.RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=["status", "started_at"])
+    return job
+
+
+def run_job(job):
+    """
+    Execute a job and record its outcome on the row.
+
+    A job claimed by ``claim_next_job`` gives its user's slot back once the
+    generation is over. A job of a batch runs the whole batch.
+    """
+    if job.batch is not None:
+        return _run_batch(job)
+    claimed = job.status == GenerationJob.Status.RUNNING
+    try:
+        generation = services.create_generation(job.user, job.prompt, job.params)
+    except services.ImageGenerationError as e:
+        if isinstance(e, CircuitOpenError) and not jobs_run_eagerly():
+            # The API is down: put the job back for when it recovers
+            job.status = GenerationJob.Status.QUEUED
+            job.started_at = None
+            job.save(update_fields=["status", "started_at"])
+            return job
+        job.status = GenerationJob.Status.FAILED
+        job.error = str(e)
+    except Exception as e:
+        logger.error(f"Unexpected error while running generation job {job.pk}: {str(e)}")
+        job.status = GenerationJob.Status.FAILED
+        job.error = "An unexpected error occurred. Please try again."
+    else:
+        job.status = GenerationJob.Status.SUCCEEDED
+        job.generation = generation
+    finally:
+        if claimed:
+            scheduling.release_slots(job.user_id)
+
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "error", "generation", "finished_at"])
+
+    # The result page works without variants, so build them after the job is
+    # reported as done rather than making the user wait for the encoding
+    if job.status == GenerationJob.Status.SUCCEEDED:
+        variants.generate_variants(job.generation)
+    return job
+
+
+def _run_batch(job):
+    """
+    Run ``job`` together with the jobs of its batch still queued, and record
+    each one's outcome.
+
+    The batch runs on the slot that ``job``'s claim took (or the view holds,
+    when jobs run eagerly) and on as many more of the user's slots as are free.
+    """
+    claimed = job.status == GenerationJob.Status.RUNNING
+    now = timezone.now()
+    with transaction.atomic():
+        rest = list(
+            GenerationJob.objects.select_for_update(skip_locked=True)
+            .filter(batch=job.batch, status=GenerationJob.Status.QUEUED)
+            .exclude(pk=job.pk)
+            .order_by("pk")
+        )
+        GenerationJob.objects.filter(pk__in=[other.pk for other in rest]).update(
+            status=GenerationJob.Status.RUNNING, started_at=now
+        )
+    jobs = [job, *rest]
+
+    items = [{"prompt": each.prompt, "seed": each.params.get("seed")} for each in jobs]
+    try:
+        results = batch.run_batch(job.user, items, held_slots=1)
+    except Exception as e:
+        logger.error(f"Unexpected error while running generation batch {job.batch}: {str(e)}")
+        results = [{"status": "failed", "error": "An unexpected error occurred. Please try again."} for _ in jobs]
+    finally:
+        if claimed:
+            scheduling.release_slots(job.user_id)
+
+    finished_at = timezone.now()
+    for each, result in zip(jobs, results):
+        each.finished_at = finished_at
+        if result["status"] == "succeeded":
+            each.status = GenerationJob.Status.SUCCEEDED
+            each.generation_id = result["generation_id"]
+        elif result.get("circuit_open") and not jobs_run_eagerly():
+            # The API is down: put the job back for when it recovers
+            each.status = GenerationJob.Status.QUEUED
+            each.started_at = None
+            each.finished_at = None
+        else:
+            each.status = GenerationJob.Status.FAILED
+            each.error = result["error"]
+    GenerationJob.objects.bulk_update(jobs, ["status", "error", "generation", "started_at", "finished_at"])
+    return job
+
+
+def requeue_stale_jobs(older_than):
+    """Put back jobs left ``running`` by a worker that died mid-generation"""
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    return GenerationJob.objects.filter(
+        status=GenerationJob.Status.RUNNING,
+        started_at__lt=cutoff,
+    ).update(status=GenerationJob.Status.QUEUED, started_at=None)
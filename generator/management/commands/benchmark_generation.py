@@ -0,0 +1,55 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from generator import benchmarking
+
+
+class Command(BaseCommand):
+    help = "Load-test login, generate, result and gallery against a local stub API and report latencies as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Worker processes, like gunicorn workers")
+        parser.add_argument("--concurrency", type=int, default=4, help="Simulated users per process")
+        parser.add_argument("--flows", type=int, default=5, help="Flows each simulated user runs")
+        parser.add_argument("--delay", type=float, default=0.5, help="Simulated upstream generation time in seconds")
+        parser.add_argument(
+            "--backend",
+            choices=["stub", "local"],
+            default="stub",
+            help="Call a local stub Stability server, or render with the offline local backend",
+        )
+        parser.add_argument("--image-size", type=int, default=256, help="Side of the stub server's PNG in pixels")
+        parser.add_argument("--label", default="", help="Free-form name stored with the results, e.g. a release")
+        parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        report = benchmarking.run_benchmark(
+            processes=max(1, options["processes"]),
+            concurrency=max(1, options["concurrency"]),
+            flows=max(1, options["flows"]),
+            delay=options["delay"],
+            backend=options["backend"],
+            image_size=options["image_size"],
+            label=options["label"],
+        )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
+
+        summary = self.stderr if not options["output"] else self.stdout
+        summary.write(
+            f"{report['flows']} flows in {report['duration_s']}s "
+            f"({report['throughput']['flows_per_s']} flows/s), {report['errors']} error(s)"
+        )
+        for view, stats in report["views"].items():
+            latency = stats["latency_ms"]
+            summary.write(
+                f"{view:>9}: p50 {latency['p50']:>8} ms  p95 {latency['p95']:>8} ms  "
+                f"p99 {latency['p99']:>8} ms  queries {stats['queries']['mean']}"
+            )
+        for worker in report["workers"]:
+            summary.write(f"   worker {worker['pid']}: peak RSS {worker['peak_rss_mb']} MB")
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from generator.models import Generation
+from generator import variants
+
+
+class Command(BaseCommand):
+    help = "Build responsive image variants for generations that are missing them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Check every generation, not only rows without recorded variants",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Rows fetched from the database at a time",
+        )
+
+    def handle(self, *args, **options):
+        generations = Generation.objects.order_by("pk")
+        if not options["all"]:
+            generations = generations.filter(variants={})
+
+        built = failed = 0
+        seen_images = set()
+        for generation in generations.only("pk", "image").iterator(chunk_size=options["batch_size"]):
+            # Rows sharing an image are all updated by the first one
+            if generation.image.name in seen_images:
+                continue
+            seen_images.add(generation.image.name)
+
+            if variants.generate_variants(generation):
+                built += 1
+            else:
+                failed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Built variants for {built} image(s), {failed} failed"))
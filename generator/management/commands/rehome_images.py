@@ -0,0 +1,77 @@
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from generator.models import Generation, ResultCacheEntry
+from generator.storage import CONTENT_NAME, ContentAddressedMixin, image_storage
+from generator import gallery_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Move generated images saved under their upload names to content-addressed storage. "
+        "Safe to run while the site is up and to re-run: each file is copied into place before "
+        "rows are pointed at it, and the old file is only removed with --delete-old once no row uses it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Image names fetched from the database at a time",
+        )
+        parser.add_argument(
+            "--delete-old",
+            action="store_true",
+            help="Delete each old file once no generation refers to it any more",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report what would be moved without changing anything",
+        )
+
+    def handle(self, *args, **options):
+        storage = image_storage()
+        if not isinstance(storage, ContentAddressedMixin):
+            self.stderr.write(self.style.ERROR("The default storage is not content-addressed"))
+            return
+
+        names = (
+            Generation.objects.exclude(image="")
+            .values_list("image", flat=True)
+            .distinct()
+            .order_by("image")
+            .iterator(chunk_size=options["batch_size"])
+        )
+        moved = missing = deleted = 0
+        for old_name in names:
+            if CONTENT_NAME.match(old_name):
+                continue
+            if not storage.exists(old_name):
+                missing += 1
+                self.stderr.write(f"Missing file: {old_name}")
+                continue
+            if options["dry_run"]:
+                moved += 1
+                continue
+
+            with storage.open(old_name, "rb") as f:
+                new_name = storage.save(old_name, File(f, name=old_name))
+            with transaction.atomic():
+                rows = Generation.objects.filter(image=old_name).update(image=new_name)
+                ResultCacheEntry.objects.filter(image=old_name).update(image=new_name)
+                storage.retain([new_name] * rows)
+                gallery_cache.invalidate_image(new_name)
+            moved += 1
+
+            # Rows created from the old name meanwhile keep it until the next run
+            if options["delete_old"] and not Generation.objects.filter(image=old_name).exists():
+                storage.delete(old_name)
+                deleted += 1
+
+        verb = "Would move" if options["dry_run"] else "Moved"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {moved} image(s), {missing} missing, {deleted} old file(s) deleted"
+        ))
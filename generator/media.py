@@ -0,0 +1,90 @@
+"""
+Delivery of generated images to the users who own them.
+
+Media URLs (``MEDIA_URL``) are routed to ``views.protected_media``, which
+checks that the signed-in user owns the ``Generation`` the file belongs to;
+anyone else gets a 404. Variants belong to the generation whose image they
+were resized from: the variant's name gives the original's stem, from which
+the original's possible names (one per image format) are derived, so both
+checks are lookups on the ``(user, image)`` index.
+
+Django only decides whether the file may be sent. With
+``MEDIA_ACCEL_REDIRECT_PREFIX`` set (production), the response is empty and
+carries an ``X-Accel-Redirect`` header naming the file under that prefix,
+which nginx maps to an ``internal`` location on the media volume and sends
+with ``sendfile``, so no image bytes pass through Python. Without it
+(development), the file is streamed by Django as a ``FileResponse``.
+
+Storages without local paths (S3) link to the bucket directly and never reach
+this view.
+"""
+from urllib.parse import quote
+import mimetypes
+import posixpath
+import re
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse
+
+from .models import Generation
+from .recompression import FORMATS
+from .storage import CONTENT_NAME, content_name
+
+# variants/<shard>/<stem>_<width>.<ext>, see variants.variant_name()
+VARIANT_NAME = re.compile(r"^variants/[0-9a-f]{2}/[0-9a-f]{2}/(?P<stem>[^/]+)_\d+\.\w+$")
+# Content-addressed names never change, so browsers may keep them
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+CACHE_CONTROL = "private, max-age=3600"
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+def clean_name(name):
+    """``name`` relative to the media root, or None if it points outside it"""
+    name = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    if name in ("", ".") or name == ".." or name.startswith("../"):
+        return None
+    return name
+
+
+def original_names(stem):
+    """The names the original of a variant with ``stem`` can be stored under"""
+    directory = Generation._meta.get_field("image").upload_to.rstrip("/")
+    extensions = [f".{extension}" for extension, _, _ in FORMATS.values()]
+    if SHA256_HEX.match(stem):
+        return [content_name(directory, stem, extension) for extension in extensions]
+    # Stored before content addressing
+    return [f"{directory}/{stem}{extension}" for extension in extensions]
+
+
+def is_owner(user, name):
+    """Whether ``user`` may view the media file ``name``"""
+    if user.is_staff:
+        return True
+    generations = Generation.objects.filter(user=user)
+    match = VARIANT_NAME.match(name)
+    if match:
+        return generations.filter(image__in=original_names(match["stem"])).exists()
+    return generations.filter(image=name).exists()
+
+
+def accel_redirect_prefix():
+    return getattr(settings, "MEDIA_ACCEL_REDIRECT_PREFIX", None)
+
+
+def serve(name):
+    """The response sending the media file ``name``, by nginx when configured"""
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    prefix = accel_redirect_prefix()
+    if prefix:
+        # nginx answers 404 itself if the file is missing
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + quote(name)
+    else:
+        try:
+            response = FileResponse(default_storage.open(name, "rb"), content_type=content_type)
+        except FileNotFoundError:
+            raise Http404("File not found.")
+    immutable = CONTENT_NAME.match(name) or VARIANT_NAME.match(name)
+    response["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if immutable else CACHE_CONTROL
+    return response
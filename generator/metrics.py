@@ -0,0 +1,270 @@
+"""
+Lightweight metrics registry with multi-process aggregation.
+
+Counters, gauges and histograms are keyed by name plus a set of labels. Values
+live in module state guarded by a lock, so any thread in the process can record
+them cheaply.
+
+When ``METRICS_DIR`` is set, each process also writes its values to
+``<METRICS_DIR>/<host>-<pid>.json`` at most every ``METRICS_FLUSH_INTERVAL``
+seconds and on exit. ``collect()`` merges every file so a scrape of any one
+gunicorn worker reports the whole deployment: the directory may be a volume
+shared with the job worker and ASGI containers, hence the host name. Counters
+and histograms are summed (those of exited processes included), gauges are
+reported per live process with ``host`` and ``pid`` labels. A process on
+another host is taken to be live while its file is less than
+``METRICS_STALE_AFTER`` seconds old. Empty the directory when the server is
+restarted.
+"""
+from contextlib import contextmanager
+import atexit
+import bisect
+import glob
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 2 * 1024 ** 2, 4 * 1024 ** 2, 8 * 1024 ** 2, 16 * 1024 ** 2)
+
+# Containers sharing METRICS_DIR have PID namespaces of their own
+HOST = socket.gethostname()
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_last_flush = 0.0
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Increment counter ``name`` by ``amount``"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    flush_if_due()
+
+
+def set_gauge(name, value, **labels):
+    """Set gauge ``name`` to ``value``"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+    flush_if_due()
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Record ``value`` in histogram ``name``"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                "buckets": tuple(buckets),
+                "counts": [0] * len(buckets),
+                "count": 0,
+                "sum": 0.0,
+            }
+        index = bisect.bisect_left(histogram["buckets"], value)
+        if index < len(histogram["counts"]):
+            histogram["counts"][index] += 1
+        histogram["count"] += 1
+        histogram["sum"] += value
+    flush_if_due()
+
+
+@contextmanager
+def timer(name, **labels):
+    """Record the duration of the ``with`` block in histogram ``name``, in seconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def get_counter(name, **labels):
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def get_gauge(name, **labels):
+    with _lock:
+        return _gauges.get(_key(name, labels))
+
+
+def get_histogram(name, **labels):
+    with _lock:
+        histogram = _histograms.get(_key(name, labels))
+        return dict(histogram, counts=list(histogram["counts"])) if histogram else None
+
+
+def snapshot():
+    """Return a copy of every metric recorded in this process"""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {
+                key: dict(histogram, counts=list(histogram["counts"]))
+                for key, histogram in _histograms.items()
+            },
+        }
+
+
+def reset():
+    """Forget all recorded values (used by tests, and by forked children)"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+# A forked child starts from zero; the parent's values are in the parent's file
+os.register_at_fork(after_in_child=reset)
+
+
+def metrics_dir():
+    return getattr(settings, "METRICS_DIR", None)
+
+
+def _encode(data):
+    return {
+        kind: [[name, [list(label) for label in labels], value] for (name, labels), value in values.items()]
+        for kind, values in data.items()
+    }
+
+
+def _decode(data):
+    return {
+        kind: {(name, tuple(tuple(label) for label in labels)): value for name, labels, value in values}
+        for kind, values in data.items()
+    }
+
+
+def flush():
+    """Write this process's values to ``METRICS_DIR``"""
+    global _last_flush
+    directory = metrics_dir()
+    if not directory:
+        return
+    _last_flush = time.monotonic()
+    os.makedirs(directory, exist_ok=True)
+    # Write then rename, so readers never see a half-written file
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(_encode(snapshot()), f)
+    os.replace(temp_path, os.path.join(directory, f"{HOST}-{os.getpid()}.json"))
+
+
+def flush_if_due():
+    """Flush unless this process did less than ``METRICS_FLUSH_INTERVAL`` seconds ago"""
+    if time.monotonic() - _last_flush >= getattr(settings, "METRICS_FLUSH_INTERVAL", 1.0) and metrics_dir():
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+atexit.register(lambda: metrics_dir() and flush())
+
+
+def _alive(host, pid, path):
+    if host != HOST:
+        try:
+            return time.time() - os.path.getmtime(path) < getattr(settings, "METRICS_STALE_AFTER", 300)
+        except OSError:
+            return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    """Return the metrics of every process sharing ``METRICS_DIR`` merged into one snapshot"""
+    directory = metrics_dir()
+    if not directory:
+        return snapshot()
+
+    flush()
+    merged = {"counters": {}, "gauges": {}, "histograms": {}}
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        host, _, pid = os.path.splitext(os.path.basename(path))[0].rpartition("-")
+        if not pid.isdigit():
+            continue
+        try:
+            with open(path) as f:
+                data = _decode(json.load(f))
+        except (OSError, ValueError):
+            continue
+
+        for key, value in data.get("counters", {}).items():
+            merged["counters"][key] = merged["counters"].get(key, 0) + value
+        for key, histogram in data.get("histograms", {}).items():
+            total = merged["histograms"].get(key)
+            if total is None:
+                merged["histograms"][key] = dict(histogram, counts=list(histogram["counts"]))
+            else:
+                total["counts"] = [a + b for a, b in zip(total["counts"], histogram["counts"])]
+                total["count"] += histogram["count"]
+                total["sum"] += histogram["sum"]
+        if _alive(host, int(pid), path):
+            for (name, labels), value in data.get("gauges", {}).items():
+                merged["gauges"][(name, labels + (("host", host), ("pid", pid)))] = value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(data=None):
+    """Format ``data`` (default: ``collect()``) in the Prometheus text exposition format"""
+    data = collect() if data is None else data
+    lines = []
+    for kind, prometheus_type in (("counters", "counter"), ("gauges", "gauge")):
+        seen = set()
+        for (name, labels), value in sorted(data[kind].items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} {prometheus_type}")
+            lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    seen = set()
+    for (name, labels), histogram in sorted(data["histograms"].items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram["buckets"], histogram["counts"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, [('le', _number(bound))])} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"{name}_sum{_labels(labels)} {_number(histogram['sum'])}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0003_generationjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('image', models.CharField(max_length=255)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name_plural': 'result cache entries',
+            },
+        ),
+        migrations.AddField(
+            model_name='generationjob',
+            name='params',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
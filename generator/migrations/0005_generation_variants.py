@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0004_result_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generation',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0006_generation_user_created_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(fields=['user', 'status'], name='generator_job_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(fields=['user', '-started_at'], name='generator_job_user_started_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0007_generationjob_user_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModerationTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=255)),
+                ('kind', models.CharField(choices=[('block', 'Blocked'), ('allow', 'Allowed')], default='block', max_length=8)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('term', 'kind'), name='generator_moderation_term_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0009_storedfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generation',
+            name='image_format',
+            field=models.CharField(blank=True, max_length=8),
+        ),
+        migrations.AddField(
+            model_name='generation',
+            name='image_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='generation',
+            name='original_format',
+            field=models.CharField(blank=True, max_length=8),
+        ),
+        migrations.AddField(
+            model_name='generation',
+            name='original_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0010_generation_image_formats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CircuitTransition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('circuit', models.CharField(max_length=50)),
+                ('from_state', models.CharField(choices=[('closed', 'Closed'), ('open', 'Open'), ('half_open', 'Half-open')], max_length=16)),
+                ('to_state', models.CharField(choices=[('closed', 'Closed'), ('open', 'Open'), ('half_open', 'Half-open')], max_length=16)),
+                ('failures', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['circuit', '-created_at'], name='generator_circuit_created_idx')],
+            },
+        ),
+    ]
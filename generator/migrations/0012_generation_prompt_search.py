@@ -0,0 +1,64 @@
+from django.db import migrations
+
+# See generator/search.py. Indexes are built without locking the table on
+# PostgreSQL, hence the non-atomic migration.
+POSTGRESQL_FORWARDS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS generator_gen_prompt_fts_idx ON generator_generation "
+    "USING GIN (to_tsvector('english', prompt))",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS generator_gen_prompt_trgm_idx ON generator_generation "
+    "USING GIN (prompt gin_trgm_ops)",
+]
+POSTGRESQL_BACKWARDS = [
+    "DROP INDEX CONCURRENTLY IF EXISTS generator_gen_prompt_trgm_idx",
+    "DROP INDEX CONCURRENTLY IF EXISTS generator_gen_prompt_fts_idx",
+]
+
+SQLITE_FORWARDS = [
+    "CREATE VIRTUAL TABLE generator_generation_fts USING fts5("
+    "prompt, user_id, content='generator_generation', content_rowid='id', "
+    "tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER generator_generation_fts_insert AFTER INSERT ON generator_generation BEGIN "
+    "INSERT INTO generator_generation_fts(rowid, prompt, user_id) VALUES (new.id, new.prompt, new.user_id); END",
+    "CREATE TRIGGER generator_generation_fts_delete AFTER DELETE ON generator_generation BEGIN "
+    "INSERT INTO generator_generation_fts(generator_generation_fts, rowid, prompt, user_id) "
+    "VALUES ('delete', old.id, old.prompt, old.user_id); END",
+    "CREATE TRIGGER generator_generation_fts_update AFTER UPDATE OF prompt, user_id ON generator_generation BEGIN "
+    "INSERT INTO generator_generation_fts(generator_generation_fts, rowid, prompt, user_id) "
+    "VALUES ('delete', old.id, old.prompt, old.user_id); "
+    "INSERT INTO generator_generation_fts(rowid, prompt, user_id) VALUES (new.id, new.prompt, new.user_id); END",
+    "INSERT INTO generator_generation_fts(generator_generation_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS generator_generation_fts_update",
+    "DROP TRIGGER IF EXISTS generator_generation_fts_delete",
+    "DROP TRIGGER IF EXISTS generator_generation_fts_insert",
+    "DROP TABLE IF EXISTS generator_generation_fts",
+]
+
+STATEMENTS = {
+    "postgresql": (POSTGRESQL_FORWARDS, POSTGRESQL_BACKWARDS),
+    "sqlite": (SQLITE_FORWARDS, SQLITE_BACKWARDS),
+}
+
+
+def run(direction):
+    def operation(apps, schema_editor):
+        statements = STATEMENTS.get(schema_editor.connection.vendor)
+        if statements:
+            for sql in statements[direction]:
+                schema_editor.execute(sql)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('generator', '0011_circuittransition'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(0), run(1)),
+    ]
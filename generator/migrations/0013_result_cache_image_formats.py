@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0012_generation_prompt_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resultcacheentry',
+            name='image_format',
+            field=models.CharField(blank=True, max_length=8),
+        ),
+        migrations.AddField(
+            model_name='resultcacheentry',
+            name='original_format',
+            field=models.CharField(blank=True, max_length=8),
+        ),
+        migrations.AddField(
+            model_name='resultcacheentry',
+            name='original_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
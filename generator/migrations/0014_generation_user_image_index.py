@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0013_result_cache_image_formats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='generation',
+            index=models.Index(fields=['user', 'image'], name='generator_gen_user_image_idx'),
+        ),
+    ]
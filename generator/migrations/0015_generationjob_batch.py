@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0014_generation_user_image_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationjob',
+            name='batch',
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+import importlib
+
+from django.db import migrations, models
+
+# SQLite alters a column by copying the table, which drops the triggers that
+# keep the prompt search index of migration 0012 in sync; they are recreated
+# (and the index rebuilt) after the copy in either direction.
+prompt_search = importlib.import_module("generator.migrations.0012_generation_prompt_search")
+SQLITE_TRIGGERS = prompt_search.SQLITE_FORWARDS[1:]
+
+
+def restore_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        for sql in SQLITE_TRIGGERS:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0015_generationjob_batch'),
+    ]
+
+    operations = [
+        # Queued jobs accept prompts up to 1000 characters; the generation
+        # they produce must be able to store them
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.AlterField(
+            model_name='generation',
+            name='prompt',
+            field=models.CharField(max_length=1000),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
@@ -5,9 +5,140 @@ from django.contrib.auth.models import User
 
 class Generation(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
-    prompt = models.CharField(max_length=255)
+    prompt = models.CharField(max_length=1000)
     image = models.ImageField(upload_to='generated_images/')
+    # Resized copies of ``image`` by format then width, e.g. {"webp": {"320": "variants/..."}}
+    variants = models.JSONField(default=dict, blank=True)
+    # Format and size in bytes of the image as returned by the API and as
+    # stored after re-encoding (see recompression.py); blank when unknown
+    original_format = models.CharField(max_length=8, blank=True)
+    original_size = models.PositiveIntegerField(null=True, blank=True)
+    image_format = models.CharField(max_length=8, blank=True)
+    image_size = models.PositiveIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Backs the keyset-paginated gallery: WHERE user_id = ? ORDER BY created_at DESC
+            models.Index(fields=["user", "-created_at"], name="generator_gen_user_created_idx"),
+            # Backs the owner check of protected media: WHERE user_id = ? AND image IN (...)
+            models.Index(fields=["user", "image"], name="generator_gen_user_image_idx"),
+        ]
+
     def __str__(self):
         return f"{self.prompt} ({self.created_at:%Y-%m-%d %H:%M})"
+
+
+class GenerationJob(models.Model):
+    """A queued request to generate an image, drained by the ``generation_worker`` command"""
+
+    class Status(models.TextChoices):
+        QUEUED = "queued", "Queued"
+        RUNNING = "running", "Running"
+        SUCCEEDED = "succeeded", "Succeeded"
+        FAILED = "failed", "Failed"
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    prompt = models.CharField(max_length=1000)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.QUEUED)
+    error = models.TextField(blank=True)
+    generation = models.ForeignKey(Generation, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Jobs queued by one batch request share this id and run together
+    batch = models.UUIDField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="generator_job_status_idx"),
+            # Per-user in-flight counts and last start time for fair scheduling
+            models.Index(fields=["user", "status"], name="generator_job_user_status_idx"),
+            models.Index(fields=["user", "-started_at"], name="generator_job_user_started_idx"),
+        ]
+
+    def __str__(self):
+        return f"Job #{self.pk} [{self.status}] {self.prompt[:50]}"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.Status.SUCCEEDED, self.Status.FAILED)
+
+
+class ResultCacheEntry(models.Model):
+    """Maps a hash of (normalised prompt, generation parameters) to an already stored image"""
+    key = models.CharField(max_length=64, unique=True)
+    image = models.CharField(max_length=255)
+    size = models.PositiveIntegerField(default=0)
+    # Copied to the ``Generation`` rows created from this entry
+    original_format = models.CharField(max_length=8, blank=True)
+    original_size = models.PositiveIntegerField(null=True, blank=True)
+    image_format = models.CharField(max_length=8, blank=True)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "result cache entries"
+
+    def __str__(self):
+        return f"{self.key[:12]} -> {self.image}"
+
+
+class ModerationTerm(models.Model):
+    """A word or phrase blocked in prompts, or allowed despite a blocked term inside it"""
+
+    class Kind(models.TextChoices):
+        BLOCK = "block", "Blocked"
+        ALLOW = "allow", "Allowed"
+
+    # A trailing "*" also matches longer words starting with the term, a
+    # leading one longer words ending with it
+    term = models.CharField(max_length=255)
+    kind = models.CharField(max_length=8, choices=Kind.choices, default=Kind.BLOCK)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["term", "kind"], name="generator_moderation_term_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.term} ({self.kind})"
+
+
+class StoredFile(models.Model):
+    """A content-addressed image file and the number of ``Generation`` rows using it"""
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    references = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.references} references)"
+
+
+class CircuitTransition(models.Model):
+    """A change of state of a circuit breaker (see ``circuit_breaker``)"""
+
+    class State(models.TextChoices):
+        CLOSED = "closed", "Closed"
+        OPEN = "open", "Open"
+        HALF_OPEN = "half_open", "Half-open"
+
+    circuit = models.CharField(max_length=50)
+    from_state = models.CharField(max_length=16, choices=State.choices)
+    to_state = models.CharField(max_length=16, choices=State.choices)
+    # Failures counted in the window that opened the circuit
+    failures = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["circuit", "-created_at"], name="generator_circuit_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.circuit}: {self.from_state} -> {self.to_state}"
@@ -0,0 +1,246 @@
+"""
+Prompt moderation against block and allow lists of terms and phrases.
+
+Terms come from the built-in ``DEFAULT_BLOCKLIST``, the files named by
+``MODERATION_BLOCKLIST_FILE`` and ``MODERATION_ALLOWLIST_FILE`` (one term per
+line, ``#`` starts a comment) and ``ModerationTerm`` rows edited in the admin.
+A term ending in ``*`` also matches words it starts, so ``hack*`` covers
+"hacker" and "hacking" but not "shack"; one starting with ``*`` also matches
+words it ends, so ``*malware*`` covers "antimalware" as well. Unlike the
+substring check these lists replaced, the built-in terms only match at the
+start of a word.
+
+Every term is compiled into one Aho-Corasick automaton, so checking a prompt
+walks it once: the cost grows with the prompt's length, not with the number
+of terms. Prompts and terms are normalised the same way before matching:
+accents and zero-width characters are dropped, case and common leetspeak
+digits are folded and punctuation separates words. A blocked term is ignored
+where it lies inside an allowed phrase, e.g. ``hack*`` in "life hack".
+
+The lists are re-read when a file or the table changes, checked at most every
+``MODERATION_RELOAD_INTERVAL`` seconds per process. Until the table exists
+(before ``migrate``, in benchmarks and scripts) only the built-in list and the
+files apply.
+"""
+from collections import deque
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, transaction
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import ModerationTerm
+from . import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCKLIST = ("hack*", "exploit*", "virus*", "malware*", "spam*")
+
+# Digits and symbols read as letters. "l" is folded with "i" because "1"
+# stands for either; terms are folded the same way, so both readings match.
+_LEET = str.maketrans({
+    "0": "o", "1": "i", "l": "i", "3": "e", "4": "a", "5": "s",
+    "7": "t", "8": "b", "9": "g", "@": "a", "$": "s",
+})
+_SEPARATORS = re.compile(r"[\W_]+")
+
+_lock = threading.Lock()
+_moderator = None
+_signature = None
+_next_check = 0.0
+
+
+def normalize(text):
+    """Fold ``text`` for matching: words of letters separated by single spaces, padded with one on each side"""
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(
+            char for char in text
+            if not unicodedata.combining(char) and unicodedata.category(char) != "Cf"
+        )
+    text = text.casefold().translate(_LEET)
+    return f" {_SEPARATORS.sub(' ', text).strip()} "
+
+
+def _pattern(term):
+    """Return the string a term matches in normalised text, or None for a blank term"""
+    term = term.strip()
+    words = normalize(term.strip("*")).strip()
+    if not words:
+        return None
+    # The padding spaces anchor the term to word boundaries
+    start = "" if term.startswith("*") else " "
+    end = "" if term.endswith("*") else " "
+    return f"{start}{words}{end}"
+
+
+class Moderator:
+    """Aho-Corasick automaton over the block and allow lists"""
+
+    def __init__(self, blocked=(), allowed=()):
+        self.terms = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for allow, terms in ((False, blocked), (True, allowed)):
+            for term in terms:
+                pattern = _pattern(term)
+                if pattern:
+                    self._add(pattern, len(self.terms))
+                    self.terms.append((term.strip(), len(pattern), allow))
+        self._link()
+
+    def _add(self, pattern, index):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (index,)
+
+    def _link(self):
+        """Set each state's failure link and merge in the outputs it inherits"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
+
+    def matches(self, text):
+        """Yield ``(start, end, term index)`` for every term in normalised ``text``"""
+        goto, fail, out, terms = self._goto, self._fail, self._out, self.terms
+        state = 0
+        for position, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in out[state]:
+                yield position - terms[index][1], position, index
+
+    def blocked_terms(self, prompt):
+        """Return the blocked terms found in ``prompt`` outside any allowed phrase"""
+        blocked, allowed = [], []
+        for start, end, index in self.matches(normalize(prompt)):
+            (allowed if self.terms[index][2] else blocked).append((start, end, index))
+        return [
+            self.terms[index][0] for start, end, index in blocked
+            if not any(a_start <= start and end <= a_end for a_start, a_end, _ in allowed)
+        ]
+
+    def is_blocked(self, prompt):
+        return bool(self.blocked_terms(prompt))
+
+
+def read_terms(path):
+    """Terms listed in the file at ``path``, one per line"""
+    with open(path, encoding="utf-8") as f:
+        lines = (line.split("#", 1)[0].strip() for line in f)
+        return [line for line in lines if line]
+
+
+def _files():
+    return {
+        ModerationTerm.Kind.BLOCK: getattr(settings, "MODERATION_BLOCKLIST_FILE", None),
+        ModerationTerm.Kind.ALLOW: getattr(settings, "MODERATION_ALLOWLIST_FILE", None),
+    }
+
+
+def _current_signature():
+    """Fingerprint of the term sources: file modification times and the table's size and last change"""
+    files = []
+    for path in _files().values():
+        if path:
+            stat = os.stat(path)
+            files.append((path, stat.st_mtime_ns, stat.st_size))
+    rows = _query_table(
+        lambda: ModerationTerm.objects.aggregate(count=Count("pk"), changed=Max("updated_at")),
+        {"count": None, "changed": None},
+    )
+    return tuple(files), rows["count"], rows["changed"]
+
+
+def _query_table(query, unavailable):
+    """Run ``query`` on the terms table, or return ``unavailable`` if it cannot be read"""
+    try:
+        if not transaction.get_connection().in_atomic_block:
+            return query()
+        # A savepoint, so a failed query does not break the enclosing transaction
+        with transaction.atomic():
+            return query()
+    except DatabaseError as e:
+        logger.warning(f"Moderation terms table unavailable, using the built-in list and files: {e}")
+        return unavailable
+
+
+def load_moderator():
+    """Compile a ``Moderator`` from every term source"""
+    terms = {ModerationTerm.Kind.BLOCK: list(DEFAULT_BLOCKLIST), ModerationTerm.Kind.ALLOW: []}
+    for kind, path in _files().items():
+        if path:
+            terms[kind].extend(read_terms(path))
+    for kind, term in _query_table(lambda: list(ModerationTerm.objects.values_list("kind", "term")), []):
+        terms[kind].append(term)
+
+    moderator = Moderator(terms[ModerationTerm.Kind.BLOCK], terms[ModerationTerm.Kind.ALLOW])
+    metrics.set_gauge("moderation_terms", len(moderator.terms))
+    return moderator
+
+
+def get_moderator():
+    """Return the compiled lists, rebuilt first if a source changed since the last check"""
+    global _moderator, _signature, _next_check
+    if _moderator is not None and time.monotonic() < _next_check:
+        return _moderator
+
+    with _lock:
+        if _moderator is None or time.monotonic() >= _next_check:
+            signature = _current_signature()
+            if _moderator is None or signature != _signature:
+                _moderator = load_moderator()
+                _signature = signature
+            _next_check = time.monotonic() + getattr(settings, "MODERATION_RELOAD_INTERVAL", 5)
+    return _moderator
+
+
+def is_blocked(prompt):
+    """Whether ``prompt`` contains a blocked term"""
+    if get_moderator().is_blocked(prompt):
+        metrics.inc("moderation_rejections_total")
+        return True
+    return False
+
+
+def _recheck():
+    global _next_check
+    _next_check = 0.0
+
+
+@receiver(post_save, sender=ModerationTerm)
+@receiver(post_delete, sender=ModerationTerm)
+def _terms_changed(**kwargs):
+    # Other processes notice the change at their next periodic check
+    _recheck()
+
+
+@receiver(setting_changed)
+def _settings_changed(setting, **kwargs):
+    if setting.startswith("MODERATION_"):
+        _recheck()
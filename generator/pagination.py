@@ -0,0 +1,51 @@
+"""
+Keyset (cursor) pagination over ``(created_at, id)``.
+
+Unlike OFFSET pagination, fetching page N costs the same as fetching page 1:
+each page starts from an indexed seek to the last row the client saw. Cursors
+are opaque URL-safe strings encoding that row's ``created_at`` and ``id``.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created_at, pk):
+    raw = f"{created_at.isoformat()}|{pk}".encode("ascii")
+    return urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return the ``(created_at, pk)`` position encoded in ``cursor``"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, pk = urlsafe_b64decode(padded.encode("ascii")).decode("ascii").split("|")
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def keyset_page(queryset, cursor=None, page_size=24):
+    """
+    Return ``(items, next_cursor)`` for the page after ``cursor``, newest first.
+
+    ``next_cursor`` is ``None`` on the last page. One extra row is fetched to
+    know whether another page exists, so no COUNT query is needed.
+    """
+    queryset = queryset.order_by("-created_at", "-pk")
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+    items = list(queryset[:page_size + 1])
+    if len(items) <= page_size:
+        return items, None
+
+    items = items[:page_size]
+    last = items[-1]
+    return items, encode_cursor(last.created_at, last.pk)
@@ -0,0 +1,177 @@
+"""
+Live progress of queued generations, pushed to browsers as server-sent events.
+
+The job page (and the generate form, once it has queued a job) opens an
+``EventSource`` on ``jobs/<pk>/events/``, which streams a ``status`` event
+for every change of the job: queued, running, then succeeded (with the result
+URL) or failed (with the error). The stream ends with the job.
+
+Jobs are run by the worker process, so changes are found by polling. Rather
+than each stream querying its own job, every stream of a process subscribes
+to the ``ProgressHub`` of its event loop, which looks up all of their
+unfinished jobs in one query every ``PROGRESS_POLL_INTERVAL`` seconds and
+fans the changes out. An idle connection costs a queue and a suspended
+coroutine, not a thread, so this needs the ASGI entry point; under WSGI a
+stream is only delivered once its job is finished.
+
+Django's ``ASGIHandler`` gives every request a thread of its own for its
+synchronous work (sessions, authentication, the ORM), kept until the response
+ends. ``ASGIHandler`` below runs event streams on the process's shared thread
+instead, so a thousand open streams do not park a thousand threads.
+"""
+import asyncio
+import json
+import weakref
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+from django.urls import Resolver404, resolve, reverse
+
+from .models import GenerationJob
+from . import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+JOB_FIELDS = ("pk", "status", "error", "generation_id")
+# Job ids looked up per query; keeps ``IN (...)`` within SQLite's variable limit
+POLL_BATCH_SIZE = 500
+# How long browsers wait before reconnecting a dropped stream
+RECONNECT_DELAY_MS = 3000
+
+
+def job_event(job):
+    """The event data describing ``job``, a ``GenerationJob`` or a dict of ``JOB_FIELDS``"""
+    if isinstance(job, GenerationJob):
+        job = {field: getattr(job, field) for field in JOB_FIELDS}
+    event = {"id": job["pk"], "status": job["status"]}
+    if job["status"] == GenerationJob.Status.SUCCEEDED and job["generation_id"]:
+        event["result_url"] = reverse("generation_result", kwargs={"pk": job["generation_id"]})
+    elif job["status"] == GenerationJob.Status.FAILED:
+        event["error"] = job["error"]
+    return event
+
+
+def is_final(event):
+    return event["status"] in (GenerationJob.Status.SUCCEEDED, GenerationJob.Status.FAILED)
+
+
+def format_event(data, event="status"):
+    """Serialise one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ProgressHub:
+    """Polls the jobs that streams are waiting on and hands each change to their queues"""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._states = {}
+        self._task = None
+
+    @property
+    def streams(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def subscribe(self, job_id):
+        """Return a queue that receives the events of job ``job_id``"""
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._poll())
+        metrics.set_gauge("progress_streams", self.streams)
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        queues = self._subscribers.get(job_id, set())
+        queues.discard(queue)
+        if not queues:
+            self._subscribers.pop(job_id, None)
+            self._states.pop(job_id, None)
+        metrics.set_gauge("progress_streams", self.streams)
+
+    async def _poll(self):
+        while self._subscribers:
+            try:
+                await self.poll_once()
+            except Exception as e:
+                logger.error(f"Error polling generation progress: {str(e)}")
+            await asyncio.sleep(getattr(settings, "PROGRESS_POLL_INTERVAL", 1.0))
+
+    async def poll_once(self):
+        """Look up every watched job and publish the ones that changed"""
+        job_ids = list(self._subscribers)
+        for start in range(0, len(job_ids), POLL_BATCH_SIZE):
+            batch = job_ids[start:start + POLL_BATCH_SIZE]
+            async for job in GenerationJob.objects.filter(pk__in=batch).values(*JOB_FIELDS):
+                event = job_event(job)
+                if self._states.get(job["pk"]) != event:
+                    self._states[job["pk"]] = event
+                    for queue in self._subscribers.get(job["pk"], ()):
+                        queue.put_nowait(event)
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    """Return the ``ProgressHub`` of the running event loop"""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = ProgressHub()
+    return hub
+
+
+async def job_events(job):
+    """
+    Yield the server-sent events of ``job``, starting with its current state.
+
+    A comment is sent every ``PROGRESS_HEARTBEAT`` seconds so proxies keep the
+    connection open. After ``PROGRESS_STREAM_TIMEOUT`` seconds the stream
+    ends; the browser reconnects on its own.
+    """
+    event = job_event(job)
+    yield f"retry: {RECONNECT_DELAY_MS}\n" + format_event(event)
+    if is_final(event):
+        return
+
+    hub = get_hub()
+    queue = hub.subscribe(job.pk)
+    heartbeat = getattr(settings, "PROGRESS_HEARTBEAT", 15)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + getattr(settings, "PROGRESS_STREAM_TIMEOUT", 300)
+    try:
+        while loop.time() < deadline:
+            try:
+                next_event = await asyncio.wait_for(queue.get(), min(heartbeat, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if next_event == event:
+                continue
+            event = next_event
+            yield format_event(event)
+            if is_final(event):
+                return
+    finally:
+        hub.unsubscribe(job.pk, queue)
+
+
+class ASGIHandler(DjangoASGIHandler):
+    """Django's ASGI handler, serving event streams without a thread per request"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and self.is_event_stream(scope["path"]):
+            # Outside a ThreadSensitiveContext, synchronous code runs on the
+            # single thread shared by the process
+            await self.handle(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+    @staticmethod
+    def is_event_stream(path):
+        try:
+            return resolve(path).url_name == "generation_job_events"
+        except Resolver404:
+            return False
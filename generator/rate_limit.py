@@ -0,0 +1,199 @@
+"""
+Client-side pacing and retry policy for calls to the Stability AI API.
+
+Outbound calls are held to ``STABILITY_RATE_LIMIT`` per
+``STABILITY_RATE_PERIOD`` seconds, matching how the account quota is
+expressed, over a sliding window rather than fixed ones: a fixed window lets a
+burst at the end of one window and another at the start of the next through,
+twice the limit within one period. Calls are counted per fixed window, and a
+call is let through while this window's count plus the previous window's,
+weighted by how much of it still lies within the last period, stays within
+the limit. The two counters need only the cache's atomic ``incr``; a refused
+call takes its count back.
+
+The counters live in the Django cache, so with a shared backend (Redis) every
+gunicorn worker, worker thread and ASGI process draws from the same quota. A
+``Retry-After`` from the API closes the window for everyone until it expires.
+"""
+from email.utils import parsedate_to_datetime
+import asyncio
+import math
+import random
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+KEY_PREFIX = "stability-rate-limit"
+BLOCKED_KEY = f"{KEY_PREFIX}:blocked-until"
+
+_waiting_lock = threading.Lock()
+_waiting = 0
+
+
+class RateLimitTimeout(Exception):
+    """The quota had no room for the call within the allowed wait"""
+    pass
+
+
+def _cache():
+    return caches[getattr(settings, "STABILITY_RATE_LIMIT_CACHE", "default")]
+
+
+def max_wait():
+    return getattr(settings, "STABILITY_RATE_LIMIT_MAX_WAIT", 30)
+
+
+def max_retries():
+    return getattr(settings, "STABILITY_MAX_RETRIES", 3)
+
+
+def _wait_for_room(limit, period, now, previous, current):
+    """Seconds until the sliding window has room for one more call"""
+    window_start = now - now % period
+    if current + 1 <= limit and previous:
+        # The previous window's weight falls as it slides out
+        weight = (limit - current - 1) / previous
+        return max(window_start + period * (1 - weight) - now, 0.001)
+    return window_start + period - now
+
+
+def try_acquire():
+    """Take a call from the quota; return 0 when granted, otherwise the seconds until one may be available"""
+    limit = getattr(settings, "STABILITY_RATE_LIMIT", 150)
+    period = getattr(settings, "STABILITY_RATE_PERIOD", 10)
+    if not limit:
+        return 0
+
+    cache = _cache()
+    now = time.time()
+    blocked_until = cache.get(BLOCKED_KEY)
+    if blocked_until and blocked_until > now:
+        return blocked_until - now
+
+    window = int(now // period)
+    key = f"{KEY_PREFIX}:{window}"
+    timeout = math.ceil(period) * 3
+    previous = cache.get(f"{KEY_PREFIX}:{window - 1}") or 0
+    cache.add(key, 0, timeout=timeout)
+    try:
+        used = cache.incr(key)
+    except ValueError:
+        # The window's key expired between add() and incr()
+        cache.add(key, 0, timeout=timeout)
+        used = cache.incr(key)
+
+    overlap = 1 - (now % period) / period
+    in_window = previous * overlap + used
+    if in_window <= limit:
+        metrics.set_gauge("stability_rate_limit_tokens", math.floor(limit - in_window))
+        return 0
+
+    # Refused calls are not counted against the quota
+    cache.decr(key)
+    metrics.set_gauge("stability_rate_limit_tokens", 0)
+    return _wait_for_room(limit, period, now, previous, used - 1)
+
+
+def _next_wait(waited, deadline):
+    """Seconds to sleep before trying again, or 0 once the call was let through"""
+    wait = try_acquire()
+    if not wait:
+        return 0
+    # Spread the callers woken by the same refill so they do not retry in lockstep
+    wait += random.uniform(0, min(wait, 1))
+    if waited + wait > deadline:
+        metrics.inc("stability_rate_limit_timeouts_total")
+        raise RateLimitTimeout(f"No API capacity within {deadline}s")
+    return wait
+
+
+def _set_waiting(delta):
+    global _waiting
+    with _waiting_lock:
+        _waiting += delta
+        metrics.set_gauge("stability_rate_limit_waiting", _waiting)
+
+
+def acquire(deadline=None):
+    """Block until the call is let through and return the seconds spent waiting"""
+    deadline = max_wait() if deadline is None else deadline
+    waited = 0
+    wait = _next_wait(waited, deadline)
+    if wait:
+        _set_waiting(1)
+        try:
+            while wait:
+                time.sleep(wait)
+                waited += wait
+                wait = _next_wait(waited, deadline)
+        finally:
+            _set_waiting(-1)
+    metrics.observe("stability_rate_limit_wait_seconds", waited)
+    return waited
+
+
+async def aacquire(deadline=None):
+    """Async counterpart of ``acquire``; waits on the event loop"""
+    deadline = max_wait() if deadline is None else deadline
+    next_wait = sync_to_async(_next_wait, thread_sensitive=False)
+    waited = 0
+    wait = await next_wait(waited, deadline)
+    if wait:
+        _set_waiting(1)
+        try:
+            while wait:
+                await asyncio.sleep(wait)
+                waited += wait
+                wait = await next_wait(waited, deadline)
+        finally:
+            _set_waiting(-1)
+    metrics.observe("stability_rate_limit_wait_seconds", waited)
+    return waited
+
+
+def block_for(seconds):
+    """Hold every caller back for ``seconds``, as asked by a ``Retry-After``"""
+    cache = _cache()
+    until = time.time() + seconds
+    if until > (cache.get(BLOCKED_KEY) or 0):
+        cache.set(BLOCKED_KEY, until, timeout=math.ceil(seconds) + 1)
+    metrics.set_gauge("stability_rate_limit_tokens", 0)
+
+
+async def ablock_for(seconds):
+    """Async counterpart of ``block_for``; the cache is written on a worker thread"""
+    await sync_to_async(block_for, thread_sensitive=False)(seconds)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a ``Retry-After`` header (delay-seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None):
+    """
+    Seconds to wait before retry number ``attempt`` (0-based).
+
+    Uses exponential backoff with full jitter, and never less than the
+    server's ``Retry-After``.
+    """
+    base = getattr(settings, "STABILITY_RETRY_BASE_DELAY", 1)
+    cap = getattr(settings, "STABILITY_RETRY_MAX_DELAY", 30)
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, base)
+    return delay
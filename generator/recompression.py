@@ -0,0 +1,234 @@
+"""
+Optional re-encoding of generated images before they are stored.
+
+The API returns lossless PNGs of 1.5-3 MB. With ``GENERATION_IMAGE_FORMAT`` set
+to "png", "webp" or "avif", every decoded image is re-encoded: optimised PNG,
+or lossy WebP/AVIF at ``GENERATION_IMAGE_QUALITY`` (default: per format).
+Metadata (text chunks, EXIF, ICC profile) is dropped unless
+``GENERATION_IMAGE_STRIP_METADATA`` is False. An output that is not smaller
+than the original is discarded, and so is one that fails to encode.
+
+Encoding is CPU-bound, so it runs in a pool of ``GENERATION_ENCODE_WORKERS``
+processes (0 encodes on the calling thread). Only file paths cross the process
+boundary: workers read the decoded temporary file and write the new one.
+
+Every returned file carries ``original_format``, ``original_size`` and
+``image_format``; ``services.image_fields()`` turns them into ``Generation``
+fields.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import multiprocessing
+import os
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from PIL import Image, features
+
+from .streaming import temporary_image_file
+from . import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Format -> (file extension, MIME type, Pillow format)
+FORMATS = {
+    "png": ("png", "image/png", "PNG"),
+    "webp": ("webp", "image/webp", "WEBP"),
+    "avif": ("avif", "image/avif", "AVIF"),
+}
+DEFAULT_QUALITY = {"webp": 85, "avif": 60}
+RATIO_BUCKETS = (1, 1.25, 1.5, 2, 3, 4, 6, 8, 12, 16)
+# ``Image.info`` entries that Pillow would otherwise write back out
+METADATA_KEYS = ("exif", "icc_profile", "xmp", "XML:com.adobe.xmp", "comment")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def target_format():
+    """The configured storage format, or None to keep images as returned"""
+    format_name = getattr(settings, "GENERATION_IMAGE_FORMAT", None)
+    if not format_name:
+        return None
+    format_name = format_name.lower()
+    if format_name not in FORMATS:
+        raise ValueError(f"Unsupported GENERATION_IMAGE_FORMAT: {format_name}")
+    if format_name != "png" and not features.check(format_name):
+        logger.warning(f"Pillow cannot encode {format_name}; storing images as returned")
+        return None
+    return format_name
+
+
+def quality(format_name):
+    configured = getattr(settings, "GENERATION_IMAGE_QUALITY", None)
+    return configured if configured is not None else DEFAULT_QUALITY.get(format_name)
+
+
+def encode_image(source_path, target_path, format_name, quality=None, strip_metadata=True):
+    """Re-encode the image at ``source_path`` to ``target_path``; runs in a worker process"""
+    with Image.open(source_path) as image:
+        image.load()
+        if format_name != "png" and image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        if strip_metadata:
+            for key in METADATA_KEYS:
+                image.info.pop(key, None)
+        options = {"optimize": True} if format_name == "png" else {"quality": quality}
+        if format_name == "webp":
+            options["method"] = 6
+        image.save(target_path, format=FORMATS[format_name][2], **options)
+    return os.path.getsize(target_path)
+
+
+def _pool_size():
+    return getattr(settings, "GENERATION_ENCODE_WORKERS", 2)
+
+
+def get_pool():
+    """The process-wide encoding pool, or None to encode inline"""
+    global _pool
+    if not _pool_size():
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Workers are started from a clean server process rather than
+                # forked from this multi-threaded one
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                _pool = ProcessPoolExecutor(_pool_size(), mp_context=multiprocessing.get_context(method))
+    return _pool
+
+
+def _forget_pool():
+    global _pool
+    _pool = None
+
+
+# A forked child (gunicorn --preload) must not share its parent's pool
+os.register_at_fork(after_in_child=_forget_pool)
+
+
+def _discard_broken_pool(pool):
+    """Replace a pool whose worker died (e.g. killed for memory) on next use"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+    logger.error("Image encoding pool broken; starting a new one")
+
+
+def _submit(pool, arguments):
+    """Queue an encoding on ``pool``; None when it has to run inline"""
+    if pool is None:
+        return None
+    try:
+        return pool.submit(encode_image, *arguments)
+    except BrokenProcessPool:
+        _discard_broken_pool(pool)
+        return None
+
+
+def _annotate(image_file, format_name):
+    image_file.original_format = os.path.splitext(image_file.name)[1].lstrip(".").lower() or "png"
+    image_file.original_size = image_file.size
+    image_file.image_format = format_name or image_file.original_format
+    return image_file
+
+
+def _prepare(image_files, format_name):
+    """Flush the decoded files and create the files the encoded images go to"""
+    jobs = []
+    for image_file in image_files:
+        _annotate(image_file, None)
+        image_file.flush()
+        extension, content_type, _ = FORMATS[format_name]
+        target = temporary_image_file(f"generated.{extension}", content_type)
+        target.artifact = getattr(image_file, "artifact", {})
+        jobs.append((image_file, target))
+    return jobs
+
+
+def _finish(image_file, target, size, format_name):
+    """Pick the smaller of the original and the encoded image and close the other"""
+    if size is None or size >= image_file.size:
+        target.close()
+        return image_file
+    target.seek(0)
+    target.size = size
+    target.original_format = image_file.original_format
+    target.original_size = image_file.original_size
+    target.image_format = format_name
+    metrics.observe("generation_compression_ratio", image_file.size / size, buckets=RATIO_BUCKETS,
+                    format=format_name)
+    metrics.inc("generation_bytes_saved_total", image_file.size - size, format=format_name)
+    image_file.close()
+    return target
+
+
+def _arguments(image_file, target, format_name):
+    return (
+        image_file.temporary_file_path(), target.temporary_file_path(), format_name,
+        quality(format_name), getattr(settings, "GENERATION_IMAGE_STRIP_METADATA", True),
+    )
+
+
+def _encode_failed(error):
+    logger.error(f"Could not re-encode generated image: {str(error)}")
+    metrics.inc("generation_encode_errors_total")
+
+
+def recompress(image_files):
+    """Re-encode ``image_files`` to the configured format, in parallel; returns the files to store"""
+    format_name = target_format()
+    if format_name is None:
+        return [_annotate(image_file, None) for image_file in image_files]
+
+    jobs = _prepare(image_files, format_name)
+    pool = get_pool()
+    results = []
+    with metrics.timer("generation_stage_seconds", stage="encode"):
+        arguments = [_arguments(source, target, format_name) for source, target in jobs]
+        futures = [_submit(pool, job_arguments) for job_arguments in arguments]
+        for (source, target), job_arguments, future in zip(jobs, arguments, futures):
+            try:
+                try:
+                    size = future.result() if future else encode_image(*job_arguments)
+                except BrokenProcessPool:
+                    _discard_broken_pool(pool)
+                    size = encode_image(*job_arguments)
+            except Exception as e:
+                _encode_failed(e)
+                size = None
+            results.append(_finish(source, target, size, format_name))
+    return results
+
+
+async def arecompress(image_files):
+    """Async counterpart of ``recompress``: waits for the pool without blocking the event loop"""
+    format_name = target_format()
+    pool = get_pool()
+    if format_name is None or pool is None:
+        return await sync_to_async(recompress, thread_sensitive=False)(image_files)
+
+    jobs = _prepare(image_files, format_name)
+    encode_inline = sync_to_async(encode_image, thread_sensitive=False)
+    results = []
+    with metrics.timer("generation_stage_seconds", stage="encode"):
+        arguments = [_arguments(source, target, format_name) for source, target in jobs]
+        futures = [_submit(pool, job_arguments) for job_arguments in arguments]
+        for (source, target), job_arguments, future in zip(jobs, arguments, futures):
+            try:
+                try:
+                    size = await (asyncio.wrap_future(future) if future else encode_inline(*job_arguments))
+                except BrokenProcessPool:
+                    _discard_broken_pool(pool)
+                    size = await encode_inline(*job_arguments)
+            except Exception as e:
+                _encode_failed(e)
+                size = None
+            results.append(_finish(source, target, size, format_name))
+    return results
@@ -0,0 +1,114 @@
+"""
+Content-addressed cache of generation results.
+
+Entries are keyed by a SHA-256 of the normalised prompt plus every payload
+parameter that influences the output. A hit points a new ``Generation`` at the
+file that is already stored, with the format and size fields recorded for it,
+so no upstream call is made and no bytes are copied.
+"""
+from datetime import timedelta
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ResultCacheEntry
+from . import metrics
+
+
+def cache_enabled():
+    return getattr(settings, "GENERATION_CACHE_ENABLED", True)
+
+
+def normalize_prompt(prompt):
+    """Case-fold and collapse whitespace so trivially different prompts share a key"""
+    return " ".join(prompt.split()).casefold()
+
+
+def is_cacheable(params):
+    """Seeded requests are deterministic; unseeded ones are only cached when the deployment opts in"""
+    if not cache_enabled():
+        return False
+    if params.get("seed"):
+        return True
+    return getattr(settings, "GENERATION_CACHE_UNSEEDED", False)
+
+
+def cache_key(prompt, params):
+    material = {"prompt": normalize_prompt(prompt)}
+    material.update(params)
+    encoded = json.dumps(material, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def _expiry_cutoff():
+    max_age = getattr(settings, "GENERATION_CACHE_MAX_AGE", 30 * 24 * 3600)
+    return timezone.now() - timedelta(seconds=max_age)
+
+
+def lookup(key):
+    """
+    Return ``{"name", "fields"}`` for ``key``: the stored image and the
+    ``Generation`` fields describing it (see ``services.image_fields``), or
+    ``None`` on a miss.
+    """
+    entry = ResultCacheEntry.objects.filter(key=key, created_at__gte=_expiry_cutoff()).first()
+    if entry is not None and not default_storage.exists(entry.image):
+        # The file was removed behind our back; forget the entry
+        entry.delete()
+        entry = None
+
+    if entry is None:
+        metrics.inc("generation_cache_requests_total", result="miss")
+        return None
+
+    ResultCacheEntry.objects.filter(pk=entry.pk).update(hits=F("hits") + 1, last_used_at=timezone.now())
+    metrics.inc("generation_cache_requests_total", result="hit")
+    return {
+        "name": entry.image,
+        "fields": {
+            "original_format": entry.original_format,
+            "original_size": entry.original_size,
+            "image_format": entry.image_format,
+            # Entries recorded before the formats were have a size of 0
+            "image_size": entry.size or None,
+        },
+    }
+
+
+def store(key, image_name, fields):
+    """Record ``image_name``, described by the ``Generation`` ``fields``, as the result for ``key``"""
+    ResultCacheEntry.objects.update_or_create(
+        key=key,
+        defaults={
+            "image": image_name,
+            "size": fields.get("image_size") or 0,
+            "original_format": fields.get("original_format", ""),
+            "original_size": fields.get("original_size"),
+            "image_format": fields.get("image_format", ""),
+            "created_at": timezone.now(),
+            "last_used_at": timezone.now(),
+        },
+    )
+    evict()
+
+
+def evict():
+    """Drop expired entries, then the least recently used ones beyond the size limit"""
+    expired, _ = ResultCacheEntry.objects.filter(created_at__lt=_expiry_cutoff()).delete()
+
+    max_entries = getattr(settings, "GENERATION_CACHE_MAX_ENTRIES", 10000)
+    stale_ids = list(
+        ResultCacheEntry.objects.order_by("-last_used_at", "-pk").values_list("pk", flat=True)[max_entries:]
+    )
+    overflow = 0
+    if stale_ids:
+        overflow, _ = ResultCacheEntry.objects.filter(pk__in=stale_ids).delete()
+
+    evicted = expired + overflow
+    if evicted:
+        metrics.inc("generation_cache_evictions_total", evicted)
+    return evicted
@@ -0,0 +1,316 @@
+"""
+Content-addressed storage on an S3-compatible object store.
+
+Selected with ``STORAGES["default"]["BACKEND"] = "generator.s3.S3Storage"``
+(production does this when ``S3_BUCKET`` is set), so web containers no longer
+share a media volume and can be scaled out. Requires ``boto3``.
+
+Generated images are named, deduplicated and reference counted as by
+``storage.ContentAddressedStorage``. They are uploaded as they are read, in
+``part_size`` parts of a multipart upload once they exceed one part, so no
+more than two parts are held in memory. Pages link to the bucket directly,
+with presigned URLs or under ``public_url``, and Django never proxies image
+bytes.
+
+Recently written or read files are kept in a small on-disk LRU cache
+(``cache_dir``, ``cache_max_bytes``), so building variants straight after a
+generation, or re-reading a popular image, does not download it again.
+"""
+from urllib.parse import quote
+import hashlib
+import itertools
+import mimetypes
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from django.core.files import File
+from django.core.files.storage import Storage
+
+from .storage import HASH_CHUNK_SIZE, ContentAddressedMixin, content_name, file_digest
+import logging
+
+logger = logging.getLogger(__name__)
+
+# S3 rejects parts smaller than 5 MiB, except the last one
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# Content-addressed objects never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _not_found(error):
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+
+class LocalFileCache:
+    """
+    Files kept under ``directory`` up to ``max_bytes``, least recently used
+    evicted first. Shared by every process pointed at the directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes)
+
+    def path(self, name):
+        digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + posixpath.splitext(name)[1])
+
+    def get(self, name):
+        """Path of the cached copy of ``name``, or None"""
+        if not self.enabled:
+            return None
+        path = self.path(name)
+        try:
+            # Mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, name, source_path=None, fileobj=None, move=False):
+        """Cache ``name`` from a file on disk (moved when ``move``) or a readable ``fileobj``"""
+        if not self.enabled:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(name)
+        if move:
+            try:
+                os.replace(source_path, path)
+                self._evict()
+                return path
+            except OSError:
+                pass
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if source_path:
+                    with open(source_path, "rb") as source:
+                        shutil.copyfileobj(source, f, HASH_CHUNK_SIZE)
+                else:
+                    shutil.copyfileobj(fileobj, f, HASH_CHUNK_SIZE)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self._evict()
+        return path
+
+    def discard(self, name):
+        try:
+            os.unlink(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.startswith(".tmp-"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class S3Storage(ContentAddressedMixin, Storage):
+    """
+    Options: ``bucket_name``; ``endpoint_url``, ``region_name``,
+    ``access_key`` and ``secret_key`` (default: boto3's own configuration);
+    ``location``, a key prefix; ``public_url`` to link objects from a public
+    bucket or CDN instead of presigning, and ``url_expire`` seconds otherwise;
+    ``part_size``; ``cache_dir`` and ``cache_max_bytes`` (0 disables the cache).
+    """
+
+    def __init__(self, bucket_name=None, endpoint_url=None, region_name=None, access_key=None, secret_key=None,
+                 location="", public_url=None, url_expire=3600, part_size=DEFAULT_PART_SIZE,
+                 addressing_style="auto", cache_dir=None, cache_max_bytes=256 * 1024 * 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        self.region_name = region_name
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.location = location.strip("/")
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.url_expire = url_expire
+        self.part_size = part_size
+        self.addressing_style = addressing_style
+        self.cache = LocalFileCache(
+            cache_dir or os.path.join(tempfile.gettempdir(), "s3-media-cache"), cache_max_bytes
+        )
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """boto3 client, created on first use in each process (clients are thread-safe, not fork-safe)"""
+        if self._client is None or self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = boto3.session.Session().client(
+                        "s3",
+                        endpoint_url=self.endpoint_url,
+                        region_name=self.region_name,
+                        aws_access_key_id=self.access_key,
+                        aws_secret_access_key=self.secret_key,
+                        config=Config(
+                            signature_version="s3v4",
+                            s3={"addressing_style": self.addressing_style},
+                            retries={"max_attempts": 3, "mode": "standard"},
+                            # Checksums only where S3 requires them, which
+                            # S3-compatible stores all accept
+                            request_checksum_calculation="when_required",
+                            response_checksum_validation="when_required",
+                        ),
+                    )
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def key(self, name):
+        name = name.replace("\\", "/")
+        return f"{self.location}/{name}" if self.location else name
+
+    def _save(self, name, content):
+        temporary_path = getattr(content, "temporary_file_path", lambda: None)()
+        if self.is_content_addressed(name):
+            directory = name.split("/", 1)[0]
+            if temporary_path:
+                digest, _ = file_digest(temporary_path)
+            else:
+                sha256 = hashlib.sha256()
+                for chunk in content.chunks():
+                    sha256.update(chunk if isinstance(chunk, bytes) else chunk.encode())
+                digest = sha256.hexdigest()
+            name = content_name(directory, digest, posixpath.splitext(name)[1])
+            if self.exists(name):
+                logger.info(f"Deduplicated {name}")
+                return name
+
+        extra = {"ContentType": mimetypes.guess_type(name)[0] or "application/octet-stream"}
+        if self.is_content_addressed(name):
+            extra["CacheControl"] = IMMUTABLE_CACHE_CONTROL
+        if temporary_path:
+            with open(temporary_path, "rb") as f:
+                self._upload(self.key(name), f, extra)
+            # The decoded image is usually read again at once to build variants
+            self.cache.put(name, source_path=temporary_path, move=True)
+        else:
+            content.seek(0)
+            self._upload(self.key(name), content, extra)
+            content.seek(0)
+            self.cache.put(name, fileobj=content)
+        return name
+
+    def _upload(self, key, fileobj, extra):
+        """Upload ``fileobj`` in one request, or in parts when it is larger than one part"""
+        first = fileobj.read(self.part_size)
+        second = fileobj.read(self.part_size) if len(first) == self.part_size else b""
+        if not second:
+            self.client.put_object(Bucket=self.bucket_name, Key=key, Body=first, **extra)
+            return
+
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key, **extra)["UploadId"]
+        try:
+            parts = []
+            remaining = iter(lambda: fileobj.read(self.part_size), b"")
+            for number, part in enumerate(itertools.chain((first, second), remaining), 1):
+                response = self.client.upload_part(
+                    Bucket=self.bucket_name, Key=key, UploadId=upload_id, PartNumber=number, Body=part,
+                )
+                parts.append({"PartNumber": number, "ETag": response["ETag"]})
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            # Otherwise the uploaded parts are kept, and billed, until a lifecycle rule removes them
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    def _open(self, name, mode="rb"):
+        if "w" in mode or "a" in mode or "+" in mode:
+            raise ValueError("S3Storage files are read-only; use save()")
+        cached = self.cache.get(name)
+        if cached:
+            return File(open(cached, "rb"), name=name)
+
+        try:
+            body = self.client.get_object(Bucket=self.bucket_name, Key=self.key(name))["Body"]
+        except ClientError as e:
+            if _not_found(e):
+                raise FileNotFoundError(name)
+            raise
+        with body:
+            if self.cache.enabled:
+                return File(open(self.cache.put(name, fileobj=body), "rb"), name=name)
+            spooled = tempfile.SpooledTemporaryFile(max_size=self.part_size)
+            shutil.copyfileobj(body, spooled, HASH_CHUNK_SIZE)
+        spooled.seek(0)
+        return File(spooled, name=name)
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=self.key(name))
+        except ClientError as e:
+            if _not_found(e):
+                return None
+            raise
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def size(self, name):
+        cached = self.cache.get(name) if self.is_content_addressed(name) else None
+        if cached:
+            return os.path.getsize(cached)
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head["ContentLength"]
+
+    def get_modified_time(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head["LastModified"]
+
+    def delete(self, name):
+        self.cache.discard(name)
+        self.client.delete_object(Bucket=self.bucket_name, Key=self.key(name))
+
+    def listdir(self, path):
+        prefix = self.key(path).rstrip("/") + "/" if path else (f"{self.location}/" if self.location else "")
+        directories, files = [], []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter="/"):
+            directories.extend(entry["Prefix"][len(prefix):].rstrip("/") for entry in page.get("CommonPrefixes", []))
+            files.extend(entry["Key"][len(prefix):] for entry in page.get("Contents", []))
+        return directories, files
+
+    def url(self, name):
+        key = self.key(name)
+        if self.public_url:
+            return f"{self.public_url}/{quote(key)}"
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket_name, "Key": key}, ExpiresIn=self.url_expire,
+        )
@@ -0,0 +1,201 @@
+"""
+Per-user fair share of generation capacity.
+
+Admission: before work is accepted, a user's generations today and this month
+(plus jobs still queued or running, which will become generations) are
+checked against ``GENERATION_USER_DAILY_QUOTA`` and
+``GENERATION_USER_MONTHLY_QUOTA``. The three counts come from one query of
+scalar subqueries, each bounded by an index and the current month, so the cost
+does not grow with the user's history.
+
+Dispatch: workers claim the queued job of the user who has waited longest
+since their last job started, skipping users already running
+``GENERATION_USER_MAX_CONCURRENT`` jobs. Users therefore take turns, and one
+user's backlog cannot occupy every worker.
+
+Concurrency: whatever starts upstream work for a user - a worker claiming a
+job, the eager or async generate views, a batch's parallel calls - first takes
+one of the user's ``GENERATION_USER_MAX_CONCURRENT`` slots. The slots are a
+counter per user in the Django cache, taken with an atomic ``incr``, so with a
+shared backend (Redis) two workers claiming rows of the same user, or a batch
+next to a running job, cannot both get past the limit. A process that dies
+holding slots leaves them taken until ``GENERATION_USER_SLOT_TIMEOUT`` seconds
+pass without the user starting anything.
+"""
+from contextlib import asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Generation, GenerationJob
+from .services import ImageGenerationError
+
+ACTIVE_STATUSES = (GenerationJob.Status.QUEUED, GenerationJob.Status.RUNNING)
+SLOTS_KEY_PREFIX = "generation-slots"
+
+
+class QuotaExceeded(ImageGenerationError):
+    """The user has used up their generation allowance for now"""
+    pass
+
+
+class ConcurrencyLimitReached(ImageGenerationError):
+    """The user already has as many generations running as allowed"""
+
+    def __init__(self):
+        super().__init__(
+            f"You already have {max_concurrent()} generations in progress. Please wait for one to finish."
+        )
+
+
+def max_concurrent():
+    return getattr(settings, "GENERATION_USER_MAX_CONCURRENT", 2)
+
+
+def _slots_key(user_id):
+    return f"{SLOTS_KEY_PREFIX}:{user_id}"
+
+
+def acquire_slots(user_id, wanted=1):
+    """Take up to ``wanted`` of the user's concurrency slots and return how many were taken"""
+    if user_id is None:
+        return wanted
+    key = _slots_key(user_id)
+    timeout = getattr(settings, "GENERATION_USER_SLOT_TIMEOUT", 600)
+    cache.add(key, 0, timeout=timeout)
+    try:
+        used = cache.incr(key, wanted)
+    except ValueError:
+        # The key expired between add() and incr()
+        cache.add(key, 0, timeout=timeout)
+        used = cache.incr(key, wanted)
+
+    over = min(max(used - max_concurrent(), 0), wanted)
+    if over:
+        release_slots(user_id, over)
+    if over < wanted:
+        cache.touch(key, timeout)
+    return wanted - over
+
+
+def release_slots(user_id, count=1):
+    """Give back ``count`` slots taken by ``acquire_slots``"""
+    if user_id is None or not count:
+        return
+    key = _slots_key(user_id)
+    try:
+        remaining = cache.decr(key, count)
+    except ValueError:
+        # Expired while held; nothing left to give back
+        return
+    if remaining < 0:
+        cache.incr(key, -remaining)
+
+
+def _take_slots(user, wanted):
+    taken = acquire_slots(getattr(user, "pk", None), wanted)
+    if not taken:
+        raise ConcurrencyLimitReached()
+    return taken
+
+
+@contextmanager
+def generation_slots(user, wanted=1, held=0):
+    """
+    Hold up to ``wanted`` of ``user``'s slots while generating and yield how many.
+
+    ``held`` of them are the caller's already; the rest are taken as far as
+    they are free. Raises ``ConcurrencyLimitReached`` when the caller holds
+    none and not even one is free.
+    """
+    user_id = getattr(user, "pk", None)
+    if held:
+        taken = acquire_slots(user_id, wanted - held) if wanted > held else 0
+    else:
+        taken = _take_slots(user, wanted)
+    try:
+        yield held + taken
+    finally:
+        release_slots(user_id, taken)
+
+
+@asynccontextmanager
+async def ageneration_slots(user, wanted=1):
+    """Async counterpart of ``generation_slots``"""
+    taken = await sync_to_async(_take_slots)(user, wanted)
+    try:
+        yield taken
+    finally:
+        await sync_to_async(release_slots)(getattr(user, "pk", None), taken)
+
+
+def _count(queryset):
+    """Scalar subquery counting ``queryset``'s rows, 0 when there are none"""
+    counted = queryset.order_by().values("user").annotate(count=Count("pk")).values("count")[:1]
+    return Coalesce(Subquery(counted), Value(0))
+
+
+def usage(user, now=None):
+    """
+    Return ``{"active", "today", "month"}`` for ``user`` in a single query.
+
+    ``active`` counts queued and running jobs; ``today`` and ``month`` count
+    stored generations since the start of the day and month, in the current
+    time zone.
+    """
+    now = timezone.localtime(now)
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    month_start = day_start.replace(day=1)
+
+    generations = Generation.objects.filter(user=OuterRef("pk"), created_at__gte=month_start)
+    return User.objects.filter(pk=user.pk).values(
+        active=_count(GenerationJob.objects.filter(user=OuterRef("pk"), status__in=ACTIVE_STATUSES)),
+        today=_count(generations.filter(created_at__gte=day_start)),
+        month=_count(generations),
+    ).get()
+
+
+def check_quota(user, requested=1):
+    """Raise ``QuotaExceeded`` unless ``user`` may start ``requested`` more generations"""
+    daily = getattr(settings, "GENERATION_USER_DAILY_QUOTA", None)
+    monthly = getattr(settings, "GENERATION_USER_MONTHLY_QUOTA", None)
+    if not daily and not monthly:
+        return
+
+    used = usage(user)
+    if daily and used["today"] + used["active"] + requested > daily:
+        raise QuotaExceeded(f"Daily limit of {daily} images reached. Please try again tomorrow.")
+    if monthly and used["month"] + used["active"] + requested > monthly:
+        raise QuotaExceeded(f"Monthly limit of {monthly} images reached.")
+
+
+def fair_queue(queryset=None):
+    """
+    Order queued jobs round-robin across users.
+
+    Jobs of users at their concurrency limit are left out; the rest are
+    ordered by when their user last had a job started (never first), then by
+    age. The running count is read without locking the user, so it only
+    narrows the choice; the claim still takes one of the user's slots.
+    """
+    if queryset is None:
+        queryset = GenerationJob.objects.all()
+    running = GenerationJob.objects.filter(user=OuterRef("user"), status=GenerationJob.Status.RUNNING)
+    last_started = (
+        GenerationJob.objects
+        .filter(user=OuterRef("user"), started_at__isnull=False)
+        .order_by("-started_at")
+        .values("started_at")[:1]
+    )
+    return (
+        queryset
+        .filter(status=GenerationJob.Status.QUEUED)
+        .annotate(user_running=_count(running), user_last_started=Subquery(last_started))
+        .filter(user_running__lt=max_concurrent())
+        .order_by(F("user_last_started").asc(nulls_first=True), "created_at", "pk")
+    )
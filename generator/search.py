@@ -0,0 +1,136 @@
+"""
+Prompt search over a user's generations.
+
+On PostgreSQL a prompt matches when its ``english`` full-text vector matches
+the query (``websearch_to_tsquery``: words, "quoted phrases", -exclusions) or
+when the query is trigram-similar to a part of it (``<%``, from
+``pg_trgm``), which catches typos and partial words. Results are ranked by
+``ts_rank`` plus ``word_similarity``. Both conditions are served by GIN
+indexes created in migration 0012.
+
+On SQLite (development) the same migration creates an FTS5 index of the
+prompts, kept in sync by triggers, that also indexes the owner so the user
+filter is applied inside the index. Every query word must match (after Porter
+stemming); results are ranked by how often the words occur per length of the
+prompt. There is no fuzzy or prefix matching: both read every posting of a
+common word, whoever owns it, and so does ``bm25``.
+
+Only the newest ``SEARCH_MAX_RESULTS`` matches are ranked, so a word found in
+most of a large gallery costs a bounded amount of ranking.
+
+Pages are keyset paginated over ``(score, id)``, like the gallery over
+``(created_at, id)``: each page seeks past the last result seen rather than
+counting an offset.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import re
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Generation
+from .pagination import InvalidCursor
+from . import metrics
+
+CONFIG = "english"
+FTS_TABLE = "generator_generation_fts"
+MAX_QUERY_LENGTH = 200
+
+
+def encode_cursor(score, pk):
+    raw = f"{score!r}|{pk}".encode("ascii")
+    return urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return the ``(score, pk)`` position encoded in ``cursor``"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, pk = urlsafe_b64decode(padded.encode("ascii")).decode("ascii").split("|")
+        return float(score), int(pk)
+    except (ValueError, UnicodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def _postgresql_matches(user_id, query, limit):
+    """SQL selecting the user's newest ``limit`` matching rows with their ``score``, and its parameters"""
+    table = connection.ops.quote_name(Generation._meta.db_table)
+    sql = (
+        f"SELECT candidates.*, (ts_rank(to_tsvector('{CONFIG}', prompt), websearch_to_tsquery('{CONFIG}', %s))"
+        f" + word_similarity(%s, prompt))::float8 AS score"
+        f" FROM (SELECT * FROM {table} WHERE user_id = %s"
+        f" AND (to_tsvector('{CONFIG}', prompt) @@ websearch_to_tsquery('{CONFIG}', %s) OR %s <%% prompt)"
+        f" ORDER BY id DESC LIMIT %s) candidates"
+    )
+    return sql, [query, query, user_id, query, query, limit]
+
+
+def query_words(query):
+    """The words of ``query`` as FTS5 tokenizes them (underscores separate words)"""
+    return re.findall(r"[^\W_]+", query.lower())
+
+
+def fts_query(user_id, words):
+    """An FTS5 query matching prompts of ``user_id`` that contain all of ``words``"""
+    return " AND ".join([f'user_id : "{user_id}"', *(f'prompt : "{word}"' for word in words)])
+
+
+def _sqlite_matches(user_id, query, limit):
+    words = query_words(query)
+    if not words:
+        return None, None
+    table = connection.ops.quote_name(Generation._meta.db_table)
+    occurrences = " + ".join(
+        f"(length(lower({table}.prompt)) - length(replace(lower({table}.prompt), %s, ''))) / %s" for _ in words
+    )
+    sql = (
+        f"SELECT {table}.*, ({occurrences}) / (1 + length({table}.prompt) / 100.0) AS score"
+        f" FROM (SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rowid DESC LIMIT %s) candidates"
+        f" JOIN {table} ON {table}.id = candidates.rowid"
+    )
+    params = [value for word in words for value in (word, len(word))]
+    return sql, params + [fts_query(user_id, words), limit]
+
+
+def _fallback_matches(user_id, query, limit):
+    table = connection.ops.quote_name(Generation._meta.db_table)
+    escaped = query.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    sql = (
+        f"SELECT candidates.*, 0.0 AS score FROM (SELECT * FROM {table} WHERE user_id = %s"
+        f" AND LOWER(prompt) LIKE %s ESCAPE '\\' ORDER BY id DESC LIMIT %s) candidates"
+    )
+    return sql, [user_id, f"%{escaped}%", limit]
+
+
+MATCHES = {"postgresql": _postgresql_matches, "sqlite": _sqlite_matches}
+
+
+def search(user, query, cursor=None, page_size=24):
+    """
+    Return ``(generations, next_cursor)``: the page of ``user``'s generations
+    matching ``query`` after ``cursor``, best first, each with its ``score``.
+    """
+    query = query.strip()[:MAX_QUERY_LENGTH]
+    if not query:
+        return [], None
+    max_results = getattr(settings, "SEARCH_MAX_RESULTS", 1000)
+    sql, params = MATCHES.get(connection.vendor, _fallback_matches)(user.pk, query, max_results)
+    if sql is None:
+        return [], None
+
+    sql = f"SELECT * FROM ({sql}) matches"
+    if cursor:
+        score, pk = decode_cursor(cursor)
+        sql += " WHERE score < %s OR (score = %s AND id < %s)"
+        params += [score, score, pk]
+    sql += " ORDER BY score DESC, id DESC LIMIT %s"
+    params.append(page_size + 1)
+
+    with metrics.timer("generation_search_seconds", vendor=connection.vendor):
+        items = list(Generation.objects.raw(sql, params))
+    if len(items) <= page_size:
+        return items, None
+
+    items = items[:page_size]
+    last = items[-1]
+    return items, encode_cursor(last.score, last.pk)
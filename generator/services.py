@@ -0,0 +1,214 @@
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from .models import Generation
+from .backends import get_backend
+from . import metrics, moderation, recompression, result_cache, singleflight
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Histogram of the time spent in each step of a generation, labelled by ``stage``
+STAGE_METRIC = "generation_stage_seconds"
+
+# Payload parameters sent with every generation unless overridden. "sampler"
+# and "seed" may also be passed; the API picks them itself when omitted.
+DEFAULT_GENERATION_PARAMS = {
+    "cfg_scale": 7,
+    "height": 1024,
+    "width": 1024,
+    "steps": 30,
+}
+
+
+class ImageGenerationError(Exception):
+    """Custom exception for image generation errors"""
+    pass
+
+
+class RetryableError(ImageGenerationError):
+    """A failure worth retrying: rate limiting, server errors, timeouts and dropped connections"""
+
+    def __init__(self, message, reason, retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        return type(self), (str(self), self.reason, self.retry_after), self.__dict__
+
+
+def validate_prompt(prompt):
+    """Validate the prompt before sending to API"""
+    if not prompt or not prompt.strip():
+        raise ValidationError("Prompt cannot be empty")
+
+    if len(prompt.strip()) < 3:
+        raise ValidationError("Prompt must be at least 3 characters long")
+
+    if len(prompt) > 1000:
+        raise ValidationError("Prompt is too long (maximum 1000 characters)")
+
+    # Check for potentially harmful content
+    if moderation.is_blocked(prompt):
+        raise ValidationError("Prompt contains inappropriate content")
+
+    return prompt.strip()
+
+
+def generation_params(params=None):
+    """Merge ``params`` over the defaults, dropping unset values"""
+    merged = dict(DEFAULT_GENERATION_PARAMS)
+    merged.update(params or {})
+    return {name: value for name, value in merged.items() if value is not None}
+
+
+def _check_images(images):
+    """Validate response structure"""
+    if not images:
+        raise ImageGenerationError("Invalid response from API")
+
+    if not all(image_file.size for image_file in images):
+        for image_file in images:
+            image_file.close()
+        raise ImageGenerationError("No image data received from API")
+    for image_file in images:
+        metrics.observe("generation_image_bytes", image_file.size, buckets=metrics.BYTE_BUCKETS)
+    return images
+
+
+def _validated(prompt):
+    try:
+        with metrics.timer(STAGE_METRIC, stage="validation"):
+            return validate_prompt(prompt)
+    except ValidationError as e:
+        logger.warning(f"Validation error for prompt: {prompt[:50]}... - {str(e)}")
+        raise ImageGenerationError(str(e))
+
+
+# Generates images from a prompt with the configured backend
+def generate_images_from_prompt(prompt, params=None, samples=1):
+    """
+    Generate ``samples`` images from prompt in a single backend call.
+
+    Returns the images as temporary files that can be assigned directly to an
+    ``ImageField``; the storage moves them into place rather than copying them.
+    They are re-encoded first when ``GENERATION_IMAGE_FORMAT`` is set.
+    """
+    validated_prompt = _validated(prompt)
+    try:
+        images = _check_images(get_backend().generate(validated_prompt, generation_params(params), samples))
+    except ImageGenerationError:
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error while generating image: {str(e)}")
+        raise ImageGenerationError("An unexpected error occurred. Please try again.")
+    return recompression.recompress(images)
+
+
+def generate_image_from_prompt(prompt, params=None):
+    """Generate a single image from prompt, returned as a temporary file"""
+    return generate_images_from_prompt(prompt, params)[0]
+
+
+async def agenerate_images_from_prompt(prompt, params=None, samples=1):
+    """Non-blocking counterpart of ``generate_images_from_prompt`` for async views"""
+    # Moderation may reload its lists from the database
+    validated_prompt = await sync_to_async(_validated)(prompt)
+    try:
+        images = _check_images(await get_backend().agenerate(validated_prompt, generation_params(params), samples))
+    except ImageGenerationError:
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error while generating image: {str(e)}")
+        raise ImageGenerationError("An unexpected error occurred. Please try again.")
+    return await recompression.arecompress(images)
+
+
+def image_upload_name(filename):
+    """Storage name for a new generated image, honouring ``Generation.image``'s ``upload_to``"""
+    return Generation._meta.get_field("image").generate_filename(None, filename)
+
+
+def image_fields(image_file):
+    """``Generation`` fields describing a generated image file"""
+    return {
+        "original_format": getattr(image_file, "original_format", ""),
+        "original_size": getattr(image_file, "original_size", None),
+        "image_format": getattr(image_file, "image_format", ""),
+        "image_size": image_file.size,
+    }
+
+
+def create_generation(user, prompt, params=None):
+    """
+    Generate an image for ``prompt`` and store it as a ``Generation`` owned by ``user``.
+
+    Identical requests are answered from the result cache: the new row points
+    at the image file that is already stored instead of calling the API. An
+    identical request already in flight is waited on and its image shared.
+    """
+    params = generation_params(params)
+    key = result_cache.cache_key(prompt, params)
+    cacheable = result_cache.is_cacheable(params)
+
+    cached = result_cache.lookup(key) if cacheable else None
+    if cached:
+        return Generation.objects.create(prompt=prompt, image=cached["name"], user=user, **cached["fields"])
+
+    def produce():
+        image_file = generate_image_from_prompt(prompt, params)
+        # Save to storage; the temporary file is moved, not copied
+        try:
+            with metrics.timer(STAGE_METRIC, stage="storage"):
+                name = default_storage.save(image_upload_name(image_file.name), image_file)
+        finally:
+            image_file.close()
+        return {"name": name, "fields": image_fields(image_file)}
+
+    stored, shared = singleflight.coalesce(key, produce, ImageGenerationError)
+    with metrics.timer(STAGE_METRIC, stage="db"):
+        generation = Generation.objects.create(
+            prompt=prompt,
+            image=stored["name"],
+            user=user,
+            **stored["fields"]
+        )
+    if cacheable and not shared:
+        result_cache.store(key, stored["name"], stored["fields"])
+    return generation
+
+
+async def acreate_generation(user, prompt, params=None):
+    """Async counterpart of ``create_generation`` using the async ORM"""
+    params = generation_params(params)
+    key = result_cache.cache_key(prompt, params)
+    cacheable = result_cache.is_cacheable(params)
+
+    cached = await sync_to_async(result_cache.lookup)(key) if cacheable else None
+    if cached:
+        return await Generation.objects.acreate(prompt=prompt, image=cached["name"], user=user, **cached["fields"])
+
+    async def produce():
+        images = await agenerate_images_from_prompt(prompt, params)
+        image_file = images[0]
+        try:
+            # Storage backends are synchronous: move the file into place on a
+            # worker thread rather than blocking the event loop
+            with metrics.timer(STAGE_METRIC, stage="storage"):
+                name = await sync_to_async(default_storage.save, thread_sensitive=False)(
+                    image_upload_name(image_file.name), image_file
+                )
+        finally:
+            for extra in images:
+                extra.close()
+        return {"name": name, "fields": image_fields(image_file)}
+
+    stored, shared = await singleflight.acoalesce(key, produce, ImageGenerationError)
+    with metrics.timer(STAGE_METRIC, stage="db"):
+        generation = await Generation.objects.acreate(prompt=prompt, image=stored["name"], user=user, **stored["fields"])
+    if cacheable and not shared:
+        await sync_to_async(result_cache.store)(key, stored["name"], stored["fields"])
+    return generation
+
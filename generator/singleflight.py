@@ -0,0 +1,186 @@
+"""
+Coalescing of identical generation requests that are in flight at once.
+
+When many users submit the same prompt and parameters within seconds, only
+the first request (the leader) calls the API. The others (followers) wait for
+it, then each gets a ``Generation`` of its own pointing at the image the
+leader stored. Requests made after the leader has finished start a new
+flight, so resubmitting an unseeded prompt still produces a new image.
+
+Flights are coordinated through the Django cache named by
+``GENERATION_COALESCE_CACHE``, which is Redis in production, so they span
+every gunicorn worker, job worker and ASGI process. The leader takes the
+request's lock with ``cache.add`` and publishes its result, or its error,
+under the flight's id before releasing the lock. The error is published as the
+exception itself when it pickles, so followers raise the same type (a
+``CircuitOpenError`` stays one, and their jobs are requeued like the
+leader's), and as its message otherwise. If the leader dies, its lock
+expires and a follower takes over. A follower that has waited
+``GENERATION_COALESCE_MAX_WAIT`` seconds generates on its own.
+"""
+import asyncio
+import pickle
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+KEY_PREFIX = "generation-flight"
+# Followers poll at least once in this time, so results need not live longer
+RESULT_TIMEOUT = 60
+METRIC = "generation_coalesce_requests_total"
+
+
+def enabled():
+    return getattr(settings, "GENERATION_COALESCE", True)
+
+
+def _cache():
+    return caches[getattr(settings, "GENERATION_COALESCE_CACHE", "default")]
+
+
+def max_wait():
+    return getattr(settings, "GENERATION_COALESCE_MAX_WAIT", 120)
+
+
+def poll_interval():
+    return getattr(settings, "GENERATION_COALESCE_POLL_INTERVAL", 0.2)
+
+
+def _lock_key(key):
+    return f"{KEY_PREFIX}:{key}"
+
+
+def _result_key(flight):
+    return f"{KEY_PREFIX}:result:{flight}"
+
+
+def _published_error(error):
+    """What the leader publishes for ``error``: the exception itself if the cache can store it"""
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        return {"error": str(error)}
+    return {"error": str(error), "exception": error}
+
+
+def _joined(result, error_class):
+    """Hand a leader's published result to a follower"""
+    if "error" in result:
+        metrics.inc(METRIC, role="follower", outcome="error")
+        raise result.get("exception") or error_class(result["error"])
+    metrics.inc(METRIC, role="follower", outcome="shared")
+    return result
+
+
+def _check(values, lock_key, flight):
+    """
+    From one read of the lock and the flight's result: the result once
+    published, False when the flight is gone and should be retried, or None
+    to keep waiting.
+    """
+    result = values.get(_result_key(flight))
+    if result is not None:
+        return result
+    if values.get(lock_key) != flight:
+        return False
+    return None
+
+
+def coalesce(key, produce, error_class=Exception):
+    """
+    Return ``(result, shared)``: the result of ``produce()`` for ``key``, or
+    of an identical call in flight elsewhere when ``shared``.
+
+    ``produce`` must return a value the cache can store. An ``error_class``
+    exception raised by the leader is raised in its followers too, so a
+    failing upstream is not called again by every waiting request.
+    """
+    if not enabled():
+        return produce(), False
+
+    cache = _cache()
+    lock_key = _lock_key(key)
+    deadline = time.monotonic() + max_wait()
+    flight = None
+    while time.monotonic() < deadline:
+        if flight is None:
+            candidate = uuid.uuid4().hex
+            if cache.add(lock_key, candidate, timeout=max_wait()):
+                return _lead(cache, lock_key, candidate, produce, error_class), False
+            flight = cache.get(lock_key)
+            continue
+
+        state = _check(cache.get_many([lock_key, _result_key(flight)]), lock_key, flight)
+        if state is False:
+            flight = None
+        elif state is not None:
+            return _joined(state, error_class), True
+        else:
+            time.sleep(poll_interval())
+
+    metrics.inc(METRIC, role="follower", outcome="timeout")
+    return produce(), False
+
+
+def _lead(cache, lock_key, flight, produce, error_class):
+    metrics.inc(METRIC, role="leader", outcome="produced")
+    try:
+        result = produce()
+    except error_class as e:
+        cache.set(_result_key(flight), _published_error(e), timeout=RESULT_TIMEOUT)
+        raise
+    else:
+        cache.set(_result_key(flight), result, timeout=RESULT_TIMEOUT)
+        return result
+    finally:
+        # Another flight may own the lock if ours expired; leave it alone then
+        if cache.get(lock_key) == flight:
+            cache.delete(lock_key)
+
+
+async def acoalesce(key, produce, error_class=Exception):
+    """Async counterpart of ``coalesce`` for a coroutine function ``produce``"""
+    if not enabled():
+        return await produce(), False
+
+    cache = _cache()
+    lock_key = _lock_key(key)
+    deadline = time.monotonic() + max_wait()
+    flight = None
+    while time.monotonic() < deadline:
+        if flight is None:
+            candidate = uuid.uuid4().hex
+            if await cache.aadd(lock_key, candidate, timeout=max_wait()):
+                return await _alead(cache, lock_key, candidate, produce, error_class), False
+            flight = await cache.aget(lock_key)
+            continue
+
+        state = _check(await cache.aget_many([lock_key, _result_key(flight)]), lock_key, flight)
+        if state is False:
+            flight = None
+        elif state is not None:
+            return _joined(state, error_class), True
+        else:
+            await asyncio.sleep(poll_interval())
+
+    metrics.inc(METRIC, role="follower", outcome="timeout")
+    return await produce(), False
+
+
+async def _alead(cache, lock_key, flight, produce, error_class):
+    metrics.inc(METRIC, role="leader", outcome="produced")
+    try:
+        result = await produce()
+    except error_class as e:
+        await cache.aset(_result_key(flight), _published_error(e), timeout=RESULT_TIMEOUT)
+        raise
+    else:
+        await cache.aset(_result_key(flight), result, timeout=RESULT_TIMEOUT)
+        return result
+    finally:
+        if await cache.aget(lock_key) == flight:
+            await cache.adelete(lock_key)
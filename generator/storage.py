@@ -0,0 +1,233 @@
+"""
+Content-addressed file storage for generated images.
+
+Files saved under one of ``CONTENT_ADDRESSED_DIRS`` are named after the
+SHA-256 of their bytes and sharded two levels deep by the digest's leading
+characters, e.g. ``generated_images/3f/a2/3fa2...c1.png``, so no directory
+grows beyond a few thousand entries. Saving bytes that are already stored
+returns the existing name and writes nothing.
+
+Each stored file gets a ``StoredFile`` row counting the ``Generation`` rows
+that use it, created with the first of them. The file is deleted when the last
+of them is, after the commit and only if no save has referenced it again in
+the meantime. Saving touches no database rows, so it is safe on worker
+threads. Files are written to a temporary name in their final directory and
+renamed into place, so readers (and nginx) never see a partial image.
+
+Other names, such as image variants, are stored as by ``FileSystemStorage``.
+``generator.s3.S3Storage`` applies the same scheme to an S3 bucket.
+"""
+from collections import Counter
+import hashlib
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Generation, StoredFile
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONTENT_ADDRESSED_DIRS = ("generated_images",)
+HASH_CHUNK_SIZE = 1024 * 1024
+# Names produced by content_name(); anything else is never counted or deleted
+CONTENT_NAME = re.compile(r"^[^/]+/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}\.\w+$")
+
+
+def shard(digest):
+    """Nested directories for a hex digest: two levels of 256 entries"""
+    return f"{digest[:2]}/{digest[2:4]}"
+
+
+def content_name(directory, digest, extension):
+    return f"{directory}/{shard(digest)}/{digest}{extension.lower()}"
+
+
+def file_digest(path):
+    """SHA-256 hex digest and size of the file at ``path``"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+class ContentAddressedMixin:
+    """
+    Naming and reference counting shared by the content-addressed storages.
+
+    Subclasses name files under ``content_addressed_dirs`` with
+    ``content_name()`` in ``_save()``.
+    """
+
+    def __init__(self, content_addressed_dirs=CONTENT_ADDRESSED_DIRS, **kwargs):
+        super().__init__(**kwargs)
+        self.content_addressed_dirs = tuple(content_addressed_dirs)
+
+    def is_content_addressed(self, name):
+        directory, _, rest = name.partition("/")
+        return bool(rest) and directory in self.content_addressed_dirs
+
+    def get_available_name(self, name, max_length=None):
+        if self.is_content_addressed(name):
+            # The final name depends on the content and is chosen by _save()
+            return name
+        return super().get_available_name(name, max_length=max_length)
+
+    def retain(self, names):
+        """Count one more reference to each of ``names`` (repeats count repeatedly)"""
+        table = connection.ops.quote_name(StoredFile._meta.db_table)
+        references = connection.ops.quote_name("references")
+        # One upsert per file; the syntax is shared by PostgreSQL and SQLite
+        sql = (
+            f"INSERT INTO {table} (name, size, {references}, created_at) VALUES (%s, %s, %s, %s) "
+            f"ON CONFLICT (name) DO UPDATE SET {references} = {table}.{references} + EXCLUDED.{references}"
+        )
+        with connection.cursor() as cursor:
+            for name, count in Counter(names).items():
+                if CONTENT_NAME.match(name):
+                    try:
+                        size = self.size(name)
+                    except FileNotFoundError:
+                        size = 0
+                    created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+                    cursor.execute(sql, [name, size, count, created_at])
+
+    def release(self, name, dependents=()):
+        """
+        Drop one reference to ``name``; returns whether it was the last one.
+
+        The file, and ``dependents`` with it, is deleted after the commit.
+        """
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(name=name).first()
+            if stored is None:
+                return False
+            if stored.references > 1:
+                StoredFile.objects.filter(pk=stored.pk).update(references=F("references") - 1)
+                return False
+            stored.delete()
+            transaction.on_commit(lambda: self._delete_unreferenced(name, dependents))
+        return True
+
+    def _delete_unreferenced(self, name, dependents=()):
+        """Delete ``name`` and ``dependents`` unless ``name`` was retained again since its release"""
+        with transaction.atomic():
+            # A save that deduplicated against the file may have retained it
+            # between the release and this callback
+            if StoredFile.objects.select_for_update().filter(name=name).exists():
+                logger.info(f"Kept {name}: referenced again before it was deleted")
+                return False
+            for path in (name, *dependents):
+                self.delete(path)
+        return True
+
+
+class ContentAddressedStorage(ContentAddressedMixin, FileSystemStorage):
+    """
+    ``FileSystemStorage`` that stores files under ``content_addressed_dirs``
+    by content hash, deduplicated and reference counted.
+    """
+
+    def _save(self, name, content):
+        if not self.is_content_addressed(name):
+            return super()._save(name, content)
+
+        directory = name.split("/", 1)[0]
+        extension = posixpath.splitext(name)[1]
+        os.makedirs(self.path(directory), exist_ok=True)
+
+        if hasattr(content, "temporary_file_path"):
+            # Already on disk: hash it, then move it into place
+            source = content.temporary_file_path()
+            digest, _ = file_digest(source)
+            temp_path = None
+        else:
+            temp_path, digest = self._write_temporary(directory, content)
+            source = temp_path
+
+        name = content_name(directory, digest, extension)
+        full_path = self.path(name)
+        try:
+            if os.path.exists(full_path):
+                logger.info(f"Deduplicated {name}")
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                self._move(source, full_path, directory)
+                if self.file_permissions_mode is not None:
+                    os.chmod(full_path, self.file_permissions_mode)
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.unlink(temp_path)
+        return name
+
+    def _write_temporary(self, directory, content):
+        """Copy ``content`` to a temporary file in ``directory``, hashing it on the way"""
+        sha256 = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.path(directory), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if hasattr(content, "seek"):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    sha256.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return temp_path, sha256.hexdigest()
+
+    def _move(self, source, full_path, directory):
+        """Atomically publish ``source`` at ``full_path``, copying first when it is on another filesystem"""
+        try:
+            os.replace(source, full_path)
+        except OSError:
+            fd, temp_path = tempfile.mkstemp(dir=self.path(directory), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f, open(source, "rb") as original:
+                    shutil.copyfileobj(original, f, HASH_CHUNK_SIZE)
+                os.replace(temp_path, full_path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+
+def image_storage():
+    return Generation._meta.get_field("image").storage
+
+
+def url_lifetime(storage=None):
+    """Seconds the URLs of ``storage`` stay valid (presigned S3 URLs), or None when they do not expire"""
+    storage = storage or image_storage()
+    url_expire = getattr(storage, "url_expire", None)
+    if not url_expire or getattr(storage, "public_url", None):
+        return None
+    return url_expire
+
+
+@receiver(post_save, sender=Generation)
+def _retain_image(instance, created, raw=False, **kwargs):
+    storage = image_storage()
+    if created and not raw and instance.image and hasattr(storage, "retain"):
+        storage.retain([instance.image.name])
+
+
+@receiver(post_delete, sender=Generation)
+def _release_image(instance, **kwargs):
+    storage = image_storage()
+    if instance.image and hasattr(storage, "release"):
+        variant_names = [name for names in (instance.variants or {}).values() for name in names.values()]
+        storage.release(instance.image.name, variant_names)
@@ -0,0 +1,153 @@
+"""
+Incremental decoding of Stability API responses.
+
+The JSON body of a text-to-image response is dominated by one base64 string
+per artifact. ``ArtifactStreamDecoder`` consumes the body chunk by chunk,
+decodes those strings as they arrive straight into temporary files, and keeps
+only the small remainder of the document (seeds, finish reasons) in memory.
+Peak memory per generation is therefore bounded by the chunk size rather than
+by the image size.
+"""
+import binascii
+import json
+import re
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+
+BASE64_FIELD = re.compile(rb'"base64"\s*:\s*"')
+# Longest possible partial match of BASE64_FIELD kept between chunks
+_MARKER_TAIL = 64
+# The JSON around the base64 payloads is tiny; anything bigger is not a
+# well-formed artifact response
+MAX_SKELETON_SIZE = 1024 * 1024
+
+
+class StreamDecodeError(ValueError):
+    pass
+
+
+def temporary_image_file(name="generated.png", content_type="image/png"):
+    """A disk-backed file that Django storages move into place instead of copying"""
+    return TemporaryUploadedFile(name, content_type, 0, None)
+
+
+class ArtifactStreamDecoder:
+    """
+    Feed response chunks with ``feed()``, then call ``close()`` to get the
+    decoded artifacts as temporary files. Each file carries the artifact's
+    remaining JSON fields (``seed``, ``finishReason``...) as ``file.artifact``.
+    """
+
+    def __init__(self, file_factory=temporary_image_file):
+        self.file_factory = file_factory
+        self.files = []
+        self._skeleton = bytearray()
+        self._pending = b""
+        self._in_value = False
+        self._carry = b""
+        self._sink = None
+
+    def feed(self, chunk):
+        data = self._pending + chunk
+        self._pending = b""
+        while data:
+            if self._in_value:
+                data = self._consume_value(data)
+            else:
+                data = self._consume_structure(data)
+        if len(self._skeleton) > MAX_SKELETON_SIZE:
+            raise StreamDecodeError("Response is not an artifact document")
+
+    def _consume_structure(self, data):
+        match = BASE64_FIELD.search(data)
+        if match is None:
+            # Keep a tail in case the field name is split across chunks
+            split = max(len(data) - _MARKER_TAIL, 0)
+            self._skeleton += data[:split]
+            self._pending = data[split:]
+            return b""
+
+        self._skeleton += data[:match.end()]
+        self._in_value = True
+        self._carry = b""
+        self._sink = self.file_factory()
+        return data[match.end():]
+
+    def _consume_value(self, data):
+        end = data.find(b'"')
+        payload = data if end == -1 else data[:end]
+        if payload.endswith(b"\\") and end == -1:
+            # Escaped character split across chunks: wait for the next one
+            self._pending = b"\\"
+            payload = payload[:-1]
+        self._write_base64(payload.replace(b"\\/", b"/"))
+
+        if end == -1:
+            return b""
+        self._finish_value()
+        return data[end:]
+
+    def _write_base64(self, payload):
+        payload = self._carry + payload
+        aligned = len(payload) - len(payload) % 4
+        self._carry = payload[aligned:]
+        if aligned:
+            try:
+                self._sink.write(binascii.a2b_base64(payload[:aligned]))
+            except binascii.Error as e:
+                raise StreamDecodeError(f"Invalid base64 image data: {e}")
+
+    def _finish_value(self):
+        if self._carry:
+            raise StreamDecodeError("Truncated base64 image data")
+        self._sink.size = self._sink.tell()
+        self._sink.seek(0)
+        self.files.append(self._sink)
+        self._sink = None
+        self._in_value = False
+
+    def close(self):
+        """Finish decoding and return the artifact files"""
+        if self._in_value:
+            self.discard()
+            raise StreamDecodeError("Response ended inside image data")
+        self._skeleton += self._pending
+        self._pending = b""
+        try:
+            document = json.loads(bytes(self._skeleton))
+        except ValueError:
+            self.discard()
+            raise StreamDecodeError("Response is not valid JSON")
+
+        artifacts = document.get("artifacts") if isinstance(document, dict) else None
+        if not artifacts:
+            self.discard()
+            return []
+
+        # Artifacts whose "base64" value was missing were never opened as files
+        decoded = iter(self.files)
+        for artifact in artifacts:
+            if "base64" in artifact:
+                image_file = next(decoded)
+                image_file.artifact = {k: v for k, v in artifact.items() if k != "base64"}
+        return self.files
+
+    def discard(self):
+        """Close and remove every temporary file created so far"""
+        for image_file in self.files + ([self._sink] if self._sink else []):
+            image_file.close()
+        self.files = []
+        self._sink = None
+
+
+def decode_artifacts(chunks, file_factory=temporary_image_file):
+    """Decode an iterable of response body chunks into a list of artifact files"""
+    decoder = ArtifactStreamDecoder(file_factory)
+    try:
+        for chunk in chunks:
+            if chunk:
+                decoder.feed(chunk)
+    except Exception:
+        decoder.discard()
+        raise
+    return decoder.close()
@@ -0,0 +1,28 @@
+from django import template
+from django.core.files.storage import default_storage
+
+from generator.variants import VARIANT_FORMATS
+
+register = template.Library()
+
+
+@register.inclusion_tag("generator/includes/responsive_image.html")
+def responsive_image(generation, sizes="100vw", css_class="", loading="lazy"):
+    """Render a generation as a <picture> with a srcset per variant format"""
+    sources = []
+    for format_name, names in (generation.variants or {}).items():
+        if format_name not in VARIANT_FORMATS or not names:
+            continue
+        srcset = ", ".join(
+            f"{default_storage.url(name)} {width}w"
+            for width, name in sorted(names.items(), key=lambda item: int(item[0]))
+        )
+        sources.append({"type": VARIANT_FORMATS[format_name][1], "srcset": srcset})
+
+    return {
+        "generation": generation,
+        "sources": sources,
+        "sizes": sizes,
+        "css_class": css_class,
+        "loading": loading,
+    }
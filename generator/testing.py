@@ -0,0 +1,255 @@
+"""
+Local stand-ins for external services, used by tests and benchmarks.
+
+``StubStabilityServer`` runs an HTTP/1.1 keep-alive server on a background
+thread and answers text-to-image requests with a small PNG, optionally after a
+simulated delay or with a forced status code for all or the first few requests.
+
+``StubS3Server`` is an in-memory S3-compatible object store with path-style
+addressing: single and multipart uploads, reads, deletes and listings.
+Signatures are not checked.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+import base64
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+from PIL import Image
+
+
+def make_png(size=(8, 8), color=(255, 128, 0)):
+    """Return the bytes of a small solid-colour PNG"""
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        with server.lock:
+            server.requests.append({"path": self.path, "headers": dict(self.headers), "json": body})
+            number = len(server.requests)
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        if server.status != 200 and (server.failures is None or number <= server.failures):
+            payload = json.dumps({"message": "stub error"}).encode()
+            self.send_response(server.status)
+            for name, value in server.extra_headers.items():
+                self.send_header(name, value)
+        else:
+            samples = int(body.get("samples", 1))
+            artifacts = [
+                {"base64": base64.b64encode(server.image).decode("ascii"), "seed": index, "finishReason": "SUCCESS"}
+                for index in range(samples)
+            ]
+            payload = json.dumps({"artifacts": artifacts}).encode()
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class _StubServerMixin:
+    daemon_threads = True
+    # Accept bursts of concurrent connections from load tests
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # Clients closing pooled connections early is expected, not an error
+        pass
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class StubStabilityServer(_StubServerMixin, ThreadingHTTPServer):
+    def __init__(self, image=None, delay=0, status=200, extra_headers=None, port=0, failures=None):
+        super().__init__(("127.0.0.1", port), _StubHandler)
+        self.image = image or make_png()
+        self.delay = delay
+        self.status = status
+        self.extra_headers = extra_headers or {}
+        # Answer only the first ``failures`` requests with ``status``; None fails them all
+        self.failures = failures
+        self.requests = []
+        self.lock = threading.Lock()
+        self._thread = None
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _target(self):
+        parts = urlsplit(self.path)
+        bucket, _, key = parts.path.lstrip("/").partition("/")
+        query = {name: values[0] for name, values in parse_qs(parts.query, keep_blank_values=True).items()}
+        return bucket, unquote(key), query
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _xml(self, status, body):
+        self._reply(status, f'<?xml version="1.0" encoding="UTF-8"?>{body}'.encode(), {"Content-Type": "application/xml"})
+
+    def _not_found(self, key):
+        self._xml(404, f"<Error><Code>NoSuchKey</Code><Message>Not found</Message><Key>{escape(key)}</Key></Error>")
+
+    def _record(self, operation, key, size=0):
+        with self.server.lock:
+            self.server.requests.append({"operation": operation, "key": key, "size": size})
+
+    def do_PUT(self):
+        bucket, key, query = self._target()
+        body = self._body()
+        server = self.server
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if "uploadId" in query:
+            self._record("upload_part", key, len(body))
+            with server.lock:
+                server.uploads[query["uploadId"]]["parts"][int(query["partNumber"])] = body
+        else:
+            self._record("put_object", key, len(body))
+            with server.lock:
+                server.objects[key] = {"body": body, "content_type": self.headers.get("Content-Type", ""),
+                                       "cache_control": self.headers.get("Cache-Control", "")}
+        self._reply(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        bucket, key, query = self._target()
+        self._body()
+        server = self.server
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self._record("create_multipart_upload", key)
+            with server.lock:
+                server.uploads[upload_id] = {"key": key, "parts": {},
+                                             "content_type": self.headers.get("Content-Type", ""),
+                                             "cache_control": self.headers.get("Cache-Control", "")}
+            self._xml(200, f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{escape(key)}</Key>"
+                           f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+        else:
+            self._record("complete_multipart_upload", key)
+            with server.lock:
+                upload = server.uploads.pop(query["uploadId"])
+                body = b"".join(upload["parts"][number] for number in sorted(upload["parts"]))
+                server.objects[key] = {"body": body, "content_type": upload["content_type"],
+                                       "cache_control": upload["cache_control"]}
+            self._xml(200, f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{escape(key)}</Key>"
+                           f'<ETag>"{hashlib.md5(body).hexdigest()}-{len(upload["parts"])}"</ETag>'
+                           f"</CompleteMultipartUploadResult>")
+
+    def do_GET(self):
+        bucket, key, query = self._target()
+        if not key:
+            return self._list(bucket, query)
+        self._record("get_object", key)
+        stored = self.server.objects.get(key)
+        if stored is None:
+            return self._not_found(key)
+        self._reply(200, stored["body"], {"Content-Type": stored["content_type"] or "binary/octet-stream",
+                                          "Last-Modified": "Mon, 05 Oct 2026 10:00:00 GMT"})
+
+    def do_HEAD(self):
+        bucket, key, query = self._target()
+        self._record("head_object", key)
+        stored = self.server.objects.get(key)
+        if stored is None:
+            return self._reply(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(stored["body"])))
+        self.send_header("Last-Modified", "Mon, 05 Oct 2026 10:00:00 GMT")
+        self.end_headers()
+
+    def do_DELETE(self):
+        bucket, key, query = self._target()
+        if "uploadId" in query:
+            self._record("abort_multipart_upload", key)
+            with self.server.lock:
+                self.server.uploads.pop(query["uploadId"], None)
+        else:
+            self._record("delete_object", key)
+            with self.server.lock:
+                self.server.objects.pop(key, None)
+        self._reply(204)
+
+    def _list(self, bucket, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter", "")
+        keys, prefixes = [], set()
+        for key in sorted(self.server.objects):
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter, 1)[0] + delimiter)
+            else:
+                keys.append(key)
+        contents = "".join(
+            f"<Contents><Key>{escape(key)}</Key><Size>{len(self.server.objects[key]['body'])}</Size></Contents>"
+            for key in keys
+        )
+        common = "".join(f"<CommonPrefixes><Prefix>{escape(p)}</Prefix></CommonPrefixes>" for p in sorted(prefixes))
+        self._xml(200, f"<ListBucketResult><Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix>"
+                       f"<KeyCount>{len(keys) + len(prefixes)}</KeyCount><IsTruncated>false</IsTruncated>"
+                       f"{contents}{common}</ListBucketResult>")
+
+
+class StubS3Server(_StubServerMixin, ThreadingHTTPServer):
+    def __init__(self, port=0):
+        super().__init__(("127.0.0.1", port), _S3Handler)
+        # Key -> {"body", "content_type", "cache_control"}
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self._thread = None
+
+    def operations(self, name=None):
+        """Recorded requests, optionally only those of operation ``name``"""
+        return [request for request in self.requests if name is None or request["operation"] == name]
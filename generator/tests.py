@@ -1,15 +1,52 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
 from unittest.mock import patch, MagicMock
 import tempfile
+from io import StringIO
+import importlib.util
+import unittest
+from datetime import timedelta
+from django.utils import timezone
 import os
-from .models import Generation
-from .views import generate_image_from_prompt
+from .models import Generation, GenerationJob, ResultCacheEntry
+from .services import ImageGenerationError, generate_image_from_prompt
 import requests
 
 
+def fake_image_file(*args, **kwargs):
+    """Stand-in for generate_image_from_prompt's temporary image file"""
+    return ContentFile(b'fake image data', name='generated.png')
+
+
+class CleanCacheTestCase(TestCase):
+    """Starts each test with an empty cache, where the circuit breaker, rate
+    limiter, concurrency slots and cached pages keep state between tests"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class TemporaryMediaMixin:
+    """Stores the files a test writes under a temporary ``MEDIA_ROOT``,
+    with ``media_settings`` overridden alongside it"""
+
+    media_settings = {}
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = self.settings(MEDIA_ROOT=self.media_root.name, **self.media_settings)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
 class GenerationModelTest(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -101,8 +138,9 @@ class AuthenticationTest(TestCase):
             self.assertEqual(response.status_code, 302)  # Should redirect to login
 
 
-class GenerateViewTest(TestCase):
+class GenerateViewTest(CleanCacheTestCase):
     def setUp(self):
+        super().setUp()
         self.client = Client()
         self.user = User.objects.create_user(
             username='testuser',
@@ -125,11 +163,11 @@ class GenerateViewTest(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertIn('/accounts/login/', response.url)
 
-    @patch('generator.views.generate_image_from_prompt')
+    @patch('generator.services.generate_image_from_prompt')
     def test_generate_view_post_success(self, mock_generate):
         """Test successful image generation"""
         # Mock the image generation to return fake image data
-        mock_generate.return_value = b'fake image data'
+        mock_generate.side_effect = fake_image_file
         
         self.client.login(username='testuser', password='testpass123')
         response = self.client.post(reverse('generate'), {
@@ -139,7 +177,7 @@ class GenerateViewTest(TestCase):
         self.assertEqual(response.status_code, 302)  # Redirect to result page
         self.assertTrue(Generation.objects.filter(prompt='A beautiful sunset').exists())
 
-    @patch('generator.views.generate_image_from_prompt')
+    @patch('generator.services.generate_image_from_prompt')
     def test_generate_view_post_api_error(self, mock_generate):
         """Test handling of API errors during image generation"""
         # Mock the image generation to raise an exception
@@ -156,8 +194,9 @@ class GenerateViewTest(TestCase):
         self.assertContains(response, 'Generation failed')
 
 
-class GalleryViewTest(TestCase):
+class GalleryViewTest(CleanCacheTestCase):
     def setUp(self):
+        super().setUp()
         self.client = Client()
         self.user = User.objects.create_user(
             username='testuser',
@@ -260,26 +299,27 @@ class ResultViewTest(TestCase):
         self.assertEqual(response.status_code, 302)  # Should redirect to login
 
 
-class APIIntegrationTest(TestCase):
-    @patch('generator.views.requests.post')
+class APIIntegrationTest(CleanCacheTestCase):
+    @patch('generator.client.requests.Session.post')
     def test_generate_image_from_prompt_success(self, mock_post):
         """Test successful API call to Stability AI"""
         # Mock successful API response
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "artifacts": [{"base64": "ZmFrZSBpbWFnZSBkYXRh"}]
-        }
+        mock_response.iter_content.return_value = [
+            b'{"artifacts": [{"base64": "ZmFrZSBp',
+            b'bWFnZSBkYXRh"}]}',
+        ]
         mock_response.raise_for_status.return_value = None
         mock_post.return_value = mock_response
         
         # Test the function
         result = generate_image_from_prompt("A beautiful sunset")
         
-        self.assertEqual(result, b'fake image data')
+        self.assertEqual(result.read(), b'fake image data')
         mock_post.assert_called_once()
 
-    @patch('generator.views.requests.post')
+    @patch('generator.client.requests.Session.post')
     def test_generate_image_from_prompt_api_error(self, mock_post):
         """Test API error handling"""
         # Mock API error
@@ -290,7 +330,7 @@ class APIIntegrationTest(TestCase):
         with self.assertRaises(ImageGenerationError):
             generate_image_from_prompt("A beautiful sunset")
 
-    @patch('generator.views.requests.post')
+    @patch('generator.client.requests.Session.post')
     def test_generate_image_from_prompt_http_error(self, mock_post):
         """Test HTTP error handling"""
         # Mock HTTP error response
@@ -329,8 +369,8 @@ class FormValidationTest(TestCase):
         long_prompt = "A" * 1000  # Very long prompt
         self.client.login(username='testuser', password='testpass123')
         
-        with patch('generator.views.generate_image_from_prompt') as mock_generate:
-            mock_generate.return_value = b'fake image data'
+        with patch('generator.services.generate_image_from_prompt') as mock_generate:
+            mock_generate.side_effect = fake_image_file
             response = self.client.post(reverse('generate'), {
                 'prompt': long_prompt
             })
@@ -365,8 +405,8 @@ class SecurityTest(TestCase):
         malicious_prompt = "'; DROP TABLE generator_generation; --"
         self.client.login(username='testuser', password='testpass123')
         
-        with patch('generator.views.generate_image_from_prompt') as mock_generate:
-            mock_generate.return_value = b'fake image data'
+        with patch('generator.services.generate_image_from_prompt') as mock_generate:
+            mock_generate.side_effect = fake_image_file
             response = self.client.post(reverse('generate'), {
                 'prompt': malicious_prompt
             })
@@ -388,7 +428,7 @@ class ErrorHandlingTest(TestCase):
 
     def test_invalid_prompt_validation(self):
         """Test validation of invalid prompts"""
-        from .views import validate_prompt
+        from .services import validate_prompt
         
         # Test empty prompt
         with self.assertRaises(Exception):
@@ -408,7 +448,7 @@ class ErrorHandlingTest(TestCase):
 
     def test_valid_prompt_validation(self):
         """Test validation of valid prompts"""
-        from .views import validate_prompt
+        from .services import validate_prompt
         
         # Test valid prompt
         result = validate_prompt("A beautiful sunset")
@@ -417,3 +457,2264 @@ class ErrorHandlingTest(TestCase):
         # Test prompt with extra whitespace
         result = validate_prompt("  A beautiful sunset  ")
         self.assertEqual(result, "A beautiful sunset")
+
+
+@override_settings(GENERATION_JOBS_EAGER=False)
+class GenerationJobTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.client.login(username='testuser', password='testpass123')
+
+    def test_generate_view_enqueues_job(self):
+        """Test that POSTing a prompt queues a job instead of calling the API"""
+        with patch('generator.services.generate_image_from_prompt') as mock_generate:
+            response = self.client.post(reverse('generate'), {
+                'prompt': 'A beautiful sunset'
+            })
+
+        job = GenerationJob.objects.get()
+        self.assertRedirects(response, reverse('generation_job', kwargs={'pk': job.pk}))
+        self.assertEqual(job.status, GenerationJob.Status.QUEUED)
+        self.assertEqual(job.user, self.user)
+        mock_generate.assert_not_called()
+        self.assertFalse(Generation.objects.exists())
+
+    def test_generate_view_rejects_invalid_prompt(self):
+        """Test that invalid prompts are rejected before being queued"""
+        response = self.client.post(reverse('generate'), {'prompt': 'ab'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Generation failed')
+        self.assertFalse(GenerationJob.objects.exists())
+
+    @patch('generator.services.generate_image_from_prompt')
+    def test_worker_drains_queue(self, mock_generate):
+        """Test that the worker command processes every queued job"""
+        mock_generate.side_effect = fake_image_file
+        first = GenerationJob.objects.create(user=self.user, prompt='First image')
+        second = GenerationJob.objects.create(user=self.user, prompt='Second image')
+
+        call_command('generation_worker', concurrency=1, once=True, stdout=StringIO())
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.status, GenerationJob.Status.SUCCEEDED)
+        self.assertEqual(second.status, GenerationJob.Status.SUCCEEDED)
+        self.assertEqual(first.generation.prompt, 'First image')
+        self.assertEqual(first.generation.user, self.user)
+        self.assertIsNotNone(first.finished_at)
+
+    @patch('generator.services.generate_image_from_prompt')
+    def test_worker_keeps_prompt_longer_than_255_characters(self, mock_generate):
+        """Test that a queued prompt fits the generation it produces"""
+        mock_generate.side_effect = fake_image_file
+        self.assertEqual(Generation._meta.get_field('prompt').max_length,
+                         GenerationJob._meta.get_field('prompt').max_length)
+        prompt = 'A lighthouse on a cliff at dusk, ' * 10
+        self.client.post(reverse('generate'), {'prompt': prompt})
+
+        call_command('generation_worker', concurrency=1, once=True, stdout=StringIO())
+
+        job = GenerationJob.objects.get()
+        self.assertEqual(job.status, GenerationJob.Status.SUCCEEDED)
+        self.assertGreater(len(job.generation.prompt), 255)
+        self.assertEqual(job.generation.prompt, prompt.strip())
+
+    @patch('generator.services.generate_image_from_prompt')
+    def test_worker_records_failure(self, mock_generate):
+        """Test that generation errors are stored on the job"""
+        from .views import ImageGenerationError
+        mock_generate.side_effect = ImageGenerationError("API Error")
+        job = GenerationJob.objects.create(user=self.user, prompt='A beautiful sunset')
+
+        call_command('generation_worker', concurrency=1, once=True, stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, GenerationJob.Status.FAILED)
+        self.assertEqual(job.error, 'API Error')
+        self.assertIsNone(job.generation)
+
+    def test_claim_next_job_is_fifo(self):
+        """Test that jobs are claimed oldest first and only once"""
+        from .jobs import claim_next_job
+        first = GenerationJob.objects.create(user=self.user, prompt='First image')
+        GenerationJob.objects.create(user=self.user, prompt='Second image')
+
+        claimed = claim_next_job()
+        self.assertEqual(claimed.pk, first.pk)
+        self.assertEqual(claimed.status, GenerationJob.Status.RUNNING)
+        self.assertNotEqual(claim_next_job().pk, first.pk)
+        self.assertIsNone(claim_next_job())
+
+    def test_job_status_page(self):
+        """Test the status page while queued and after completion"""
+        job = GenerationJob.objects.create(user=self.user, prompt='A beautiful sunset')
+        response = self.client.get(reverse('generation_job', kwargs={'pk': job.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Queued')
+
+        generation = Generation.objects.create(user=self.user, prompt=job.prompt, image='generated_images/test.png')
+        job.status = GenerationJob.Status.SUCCEEDED
+        job.generation = generation
+        job.save()
+        response = self.client.get(reverse('generation_job', kwargs={'pk': job.pk}))
+        self.assertRedirects(
+            response,
+            reverse('generation_result', kwargs={'pk': generation.pk}),
+            fetch_redirect_response=False
+        )
+
+    def test_job_status_page_other_user(self):
+        """Test that users cannot see each other's jobs"""
+        other_user = User.objects.create_user(username='otheruser', password='otherpass123')
+        job = GenerationJob.objects.create(user=other_user, prompt='A beautiful sunset')
+
+        response = self.client.get(reverse('generation_job', kwargs={'pk': job.pk}))
+        self.assertEqual(response.status_code, 404)
+
+
+class StabilityClientTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        from .testing import StubStabilityServer
+        self.server = StubStabilityServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_connections_are_reused(self):
+        """Test that consecutive requests share one keep-alive connection"""
+        from .client import StabilityClient
+        client = StabilityClient(base_url=self.server.url, pool_size=2)
+
+        responses = [client.post('/v1/test', json={'samples': 1}) for _ in range(3)]
+
+        self.assertEqual([r.status_code for r in responses], [200, 200, 200])
+        self.assertEqual([r.connection_reused for r in responses], [False, True, True])
+        self.assertEqual(client.stats(), {'requests': 3, 'new_connections': 1, 'reused_connections': 2})
+        client.close()
+
+    def test_split_timeouts(self):
+        """Test that connect and read timeouts are configured separately"""
+        from .client import StabilityClient
+        client = StabilityClient(base_url=self.server.url, connect_timeout=2, read_timeout=45)
+
+        self.assertEqual(client.timeout, (2, 45))
+
+    def test_session_rebuilt_after_fork(self):
+        """Test that a forked process gets a fresh session and counters"""
+        from .client import StabilityClient
+        client = StabilityClient(base_url=self.server.url)
+        client.post('/v1/test', json={})
+        parent_session = client.session
+
+        client.reset_after_fork()
+
+        self.assertIsNot(client.session, parent_session)
+        self.assertEqual(client.stats()['requests'], 0)
+        response = client.post('/v1/test', json={})
+        self.assertFalse(response.connection_reused)
+        client.close()
+
+    def test_generate_image_against_stub_server(self):
+        """Test a full API call through the pooled client"""
+        from .client import StabilityClient
+        from .testing import make_png
+        client = StabilityClient(base_url=self.server.url)
+
+        with patch('generator.backends.stability.get_client', return_value=client), \
+                patch('generator.backends.stability.STABILITY_API_KEY', 'test-key'):
+            result = generate_image_from_prompt("A beautiful sunset")
+
+        self.assertEqual(result.read(), make_png())
+        self.assertEqual(self.server.requests[0]['headers']['Authorization'], 'Bearer test-key')
+        client.close()
+
+
+class ResultCacheTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        from . import metrics
+        metrics.reset()
+
+    def test_cache_key_normalises_prompt(self):
+        """Test that case and whitespace differences share a cache key"""
+        from .result_cache import cache_key
+        params = {'cfg_scale': 7, 'seed': 42}
+
+        self.assertEqual(cache_key('A  Beautiful sunset ', params), cache_key('a beautiful SUNSET', params))
+        self.assertNotEqual(cache_key('A beautiful sunset', params), cache_key('A beautiful sunset', {'cfg_scale': 7, 'seed': 43}))
+
+    @patch('generator.services.generate_image_from_prompt')
+    def test_seeded_requests_reuse_stored_file(self, mock_generate):
+        """Test that a repeated seeded request reuses the stored image without calling the API"""
+        from .services import create_generation
+        from . import metrics
+        mock_generate.side_effect = fake_image_file
+
+        first = create_generation(self.user, 'A beautiful sunset', {'seed': 42})
+        second = create_generation(self.user, 'a beautiful  sunset', {'seed': 42})
+
+        mock_generate.assert_called_once()
+        self.assertNotEqual(first.pk, second.pk)
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(ResultCacheEntry.objects.get().hits, 1)
+        self.assertEqual(metrics.get_counter('generation_cache_requests_total', result='hit'), 1)
+        self.assertEqual(metrics.get_counter('generation_cache_requests_total', result='miss'), 1)
+
+    @patch('generator.services.generate_image_from_prompt')
+    def test_cache_hits_keep_image_fields(self, mock_generate):
+        """Test that rows created from a cache hit record the image's formats and sizes like the first"""
+        from asgiref.sync import async_to_sync
+        from .batch import run_batch
+        from .services import acreate_generation, create_generation
+
+        def generated(*args, **kwargs):
+            image_file = fake_image_file()
+            image_file.original_format, image_file.original_size, image_file.image_format = 'png', 1234, 'webp'
+            return image_file
+        mock_generate.side_effect = generated
+
+        first = create_generation(self.user, 'A beautiful sunset', {'seed': 42})
+        second = create_generation(self.user, 'A beautiful sunset', {'seed': 42})
+        third = async_to_sync(acreate_generation)(self.user, 'A beautiful sunset', {'seed': 42})
+        [result] = run_batch(self.user, [{'prompt': 'A beautiful sunset', 'seed': 42}])
+
+        mock_generate.assert_called_once()
+        fields = ('original_format', 'original_size', 'image_format', 'image_size')
+        expected = ('png', 1234, 'webp', len(b'fake image data'))
+        for generation in (first, second, third, Generation.objects.get(pk=result['generation_id'])):
+            generation.refresh_from_db()
+            self.assertEqual(tuple(getattr(generation, field) for field in fields), expected)
+
+    @patch('generator.services.generate_image_from_prompt')
+    def test_unseeded_requests_not_cached_by_default(self, mock_generate):
+        """Test that requests without a seed always call the API unless opted in"""
+        from .services import create_generation
+        mock_generate.side_effect = fake_image_file
+
+        create_generation(self.user, 'A beautiful sunset')
+        create_generation(self.user, 'A beautiful sunset')
+        self.assertEqual(mock_generate.call_count, 2)
+
+        with self.settings(GENERATION_CACHE_UNSEEDED=True):
+            create_generation(self.user, 'A beautiful sunset')
+            create_generation(self.user, 'A beautiful sunset')
+        self.assertEqual(mock_generate.call_count, 3)
+
+    def test_eviction_by_age_and_size(self):
+        """Test that expired and least recently used entries are evicted"""
+        from . import result_cache
+        from django.utils import timezone
+        from datetime import timedelta
+        old = ResultCacheEntry.objects.create(key='old', image='generated_images/old.png')
+        ResultCacheEntry.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=60))
+        for index in range(3):
+            ResultCacheEntry.objects.create(key=f'key{index}', image=f'generated_images/{index}.png')
+        ResultCacheEntry.objects.filter(key='key0').update(last_used_at=timezone.now() - timedelta(hours=1))
+
+        with self.settings(GENERATION_CACHE_MAX_ENTRIES=2):
+            evicted = result_cache.evict()
+
+        self.assertEqual(evicted, 2)
+        self.assertEqual(set(ResultCacheEntry.objects.values_list('key', flat=True)), {'key1', 'key2'})
+
+    def test_missing_file_is_a_miss(self):
+        """Test that an entry whose file disappeared is dropped"""
+        from . import result_cache
+        ResultCacheEntry.objects.create(key='gone', image='generated_images/does-not-exist.png')
+
+        self.assertIsNone(result_cache.lookup('gone'))
+        self.assertFalse(ResultCacheEntry.objects.exists())
+
+
+class StreamingDecodeTest(CleanCacheTestCase):
+    def encode(self, *images, **extra):
+        import base64
+        import json
+        artifacts = [
+            dict({"base64": base64.b64encode(image).decode("ascii"), "seed": index}, **extra)
+            for index, image in enumerate(images)
+        ]
+        return json.dumps({"artifacts": artifacts}).encode()
+
+    def test_decodes_across_arbitrary_chunk_boundaries(self):
+        """Test that the decoder handles every possible chunk split"""
+        from .streaming import decode_artifacts
+        image = bytes(range(256)) * 3
+        body = self.encode(image, finishReason="SUCCESS")
+
+        for size in (1, 2, 3, 5, 7, 64, len(body)):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            files = decode_artifacts(chunks)
+            self.assertEqual(len(files), 1)
+            self.assertEqual(files[0].read(), image)
+            self.assertEqual(files[0].size, len(image))
+            self.assertEqual(files[0].artifact, {"seed": 0, "finishReason": "SUCCESS"})
+            files[0].close()
+
+    def test_decodes_multiple_artifacts_and_escaped_slashes(self):
+        """Test several samples in one response, with JSON-escaped slashes"""
+        from .streaming import decode_artifacts
+        first, second = b"\xff\xfe" * 100, b"\xfb\xef" * 50
+        body = self.encode(first, second).replace(b"/", b"\\/")
+
+        files = decode_artifacts([body[i:i + 10] for i in range(0, len(body), 10)])
+
+        self.assertEqual([f.read() for f in files], [first, second])
+        self.assertEqual([f.artifact["seed"] for f in files], [0, 1])
+
+    def test_rejects_truncated_response(self):
+        """Test that a body cut off inside the image data is an error"""
+        from .streaming import StreamDecodeError, decode_artifacts
+        body = self.encode(b"fake image data")
+
+        with self.assertRaises(StreamDecodeError):
+            decode_artifacts([body[:30]])
+
+    def test_empty_artifacts(self):
+        """Test that a response without artifacts yields no files"""
+        from .streaming import decode_artifacts
+        self.assertEqual(decode_artifacts([b'{"artifacts": []}']), [])
+
+    def test_create_generation_moves_file_into_storage(self):
+        """Test the streamed image lands in storage byte for byte"""
+        from .client import StabilityClient
+        from .services import create_generation
+        from .testing import StubStabilityServer, make_png
+        image = make_png(size=(64, 64))
+
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root), \
+                StubStabilityServer(image=image) as server, \
+                patch('generator.backends.stability.get_client', return_value=StabilityClient(base_url=server.url)), \
+                patch('generator.backends.stability.STABILITY_API_KEY', 'test-key'):
+            user = User.objects.create_user(username='testuser', password='testpass123')
+            generation = create_generation(user, 'A beautiful sunset')
+
+            with generation.image.open('rb') as stored:
+                self.assertEqual(stored.read(), image)
+
+
+class ImageVariantTest(TemporaryMediaMixin, CleanCacheTestCase):
+    media_settings = {'GENERATION_VARIANT_WIDTHS': (64, 128)}
+
+    def setUp(self):
+        super().setUp()
+        from django.core.files.storage import default_storage
+        from .testing import make_png
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.image_name = default_storage.save('generated_images/sunset.png', ContentFile(make_png(size=(256, 256))))
+        self.generation = Generation.objects.create(user=self.user, prompt='A beautiful sunset', image=self.image_name)
+
+    def test_builds_every_width_and_format(self):
+        """Test that each available format gets each configured width"""
+        from PIL import Image
+        from django.core.files.storage import default_storage
+        from .variants import available_formats, generate_variants
+
+        self.assertTrue(generate_variants(self.generation))
+
+        self.generation.refresh_from_db()
+        self.assertEqual(set(self.generation.variants), set(available_formats()))
+        with default_storage.open(self.generation.variants['webp']['64']) as variant:
+            self.assertEqual(Image.open(variant).size, (64, 64))
+
+    def test_idempotent_and_shared_between_rows(self):
+        """Test that a second run encodes nothing and rows sharing the image get the variants"""
+        from .variants import generate_variants
+        twin = Generation.objects.create(user=self.user, prompt='a beautiful sunset', image=self.image_name)
+        generate_variants(self.generation)
+
+        with patch('generator.variants._encode') as mock_encode:
+            generate_variants(twin)
+        mock_encode.assert_not_called()
+
+        twin.refresh_from_db()
+        self.generation.refresh_from_db()
+        self.assertEqual(twin.variants, self.generation.variants)
+
+    def test_backfill_command(self):
+        """Test that the management command fills in missing variants"""
+        call_command('generate_variants', stdout=StringIO())
+
+        self.generation.refresh_from_db()
+        self.assertIn('webp', self.generation.variants)
+
+    def test_gallery_renders_srcset(self):
+        """Test that the gallery emits a srcset for recorded variants"""
+        from .variants import generate_variants
+        generate_variants(self.generation)
+        self.client.login(username='testuser', password='testpass123')
+
+        response = self.client.get(reverse('user_gallery'))
+
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, '_64.webp 64w')
+        self.assertContains(response, self.generation.image.url)
+
+    def test_worker_builds_variants(self):
+        """Test that a finished job gets its variants"""
+        from .jobs import run_job
+        job = GenerationJob.objects.create(user=self.user, prompt='A beautiful sunset')
+        with open(os.path.join(self.media_root.name, self.image_name), 'rb') as image:
+            png = image.read()
+
+        with patch('generator.services.generate_image_from_prompt',
+                   side_effect=lambda *args: ContentFile(png, name='generated.png')):
+            run_job(job)
+
+        self.assertIn('webp', job.generation.variants)
+
+
+@override_settings(GALLERY_PAGE_SIZE=2)
+class GalleryPaginationTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        from django.utils import timezone
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.client.login(username='testuser', password='testpass123')
+        # Two rows share a timestamp so the id tie-breaker is exercised
+        now = timezone.now()
+        self.generations = []
+        for index, minutes in enumerate([50, 40, 30, 30, 10]):
+            generation = Generation.objects.create(user=self.user, prompt=f'Image {index}', image='generated_images/test.png')
+            Generation.objects.filter(pk=generation.pk).update(created_at=now - timedelta(minutes=minutes))
+            self.generations.append(generation)
+
+    def fetch_all_pages(self):
+        seen = []
+        url = f"{reverse('user_gallery_page')}?format=json"
+        while url:
+            data = self.client.get(url).json()
+            seen.extend(item['prompt'] for item in data['items'])
+            url = data['next_page_url'] and data['next_page_url'] + '&format=json'
+        return seen
+
+    def test_first_page_and_stats(self):
+        """Test that the gallery shows one page with stats over every image"""
+        response = self.client.get(reverse('user_gallery'))
+
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertLess(content.index('Image 4'), content.index('Image 3'))
+        self.assertNotIn('Image 2', content)
+        self.assertEqual(response.context['stats']['total'], 5)
+        self.assertContains(response, 'data-next-url')
+
+    def test_pages_cover_every_row_once(self):
+        """Test that walking the cursors visits every image exactly once, newest first"""
+        self.assertEqual(self.fetch_all_pages(), ['Image 4', 'Image 3', 'Image 2', 'Image 1', 'Image 0'])
+
+    def test_html_fragment(self):
+        """Test that the fragment endpoint returns items and the next page URL"""
+        first = self.client.get(reverse('user_gallery'))
+        next_url = first.context['next_page_url']
+
+        response = self.client.get(next_url)
+
+        self.assertContains(response, 'Image 2')
+        self.assertNotContains(response, 'Image 4')
+        self.assertNotContains(response, '<html')
+        self.assertTrue(response['X-Next-Page'])
+
+    def test_invalid_cursor(self):
+        """Test that a garbage cursor is rejected"""
+        response = self.client.get(reverse('user_gallery_page'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_other_users_rows_excluded(self):
+        """Test that pages only contain the current user's images"""
+        other = User.objects.create_user(username='otheruser', password='otherpass123')
+        Generation.objects.create(user=other, prompt='Not mine', image='generated_images/test.png')
+
+        self.assertNotIn('Not mine', self.fetch_all_pages())
+
+    def test_gallery_query_count_is_constant(self):
+        """Test that the gallery does not issue a query per image"""
+        with self.assertNumQueries(4):
+            self.client.get(reverse('user_gallery'))
+        for index in range(10):
+            Generation.objects.create(user=self.user, prompt=f'More {index}', image='generated_images/test.png')
+        with self.assertNumQueries(4):
+            self.client.get(reverse('user_gallery'))
+
+
+class BatchGenerationTest(TemporaryMediaMixin, CleanCacheTestCase):
+    media_settings = {'GENERATION_VARIANT_WIDTHS': (32,)}
+
+    def setUp(self):
+        super().setUp()
+        from .client import StabilityClient
+        from .testing import StubStabilityServer
+        self.server = StubStabilityServer().start()
+        self.patches = [
+            patch('generator.backends.stability.get_client', return_value=StabilityClient(base_url=self.server.url)),
+            patch('generator.backends.stability.STABILITY_API_KEY', 'test-key'),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.client.login(username='testuser', password='testpass123')
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        self.server.stop()
+
+    def post_json(self, data):
+        import json
+        return self.client.post(reverse('batch_generate'), json.dumps(data), content_type='application/json')
+
+    def test_variations_use_samples(self):
+        """Test that N variations of one prompt are requested with as few calls as possible"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post_json({'prompt': 'A beautiful sunset', 'count': 12})
+
+        data = response.json()
+        self.assertEqual(data['succeeded'], 12)
+        self.assertEqual(sorted(r['json']['samples'] for r in self.server.requests), [2, 10])
+        self.assertEqual(Generation.objects.filter(user=self.user).count(), 12)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "generator_generation"')]
+        self.assertEqual(len(inserts), 1)
+
+    def test_prompt_list_reports_partial_failures(self):
+        """Test that one bad prompt does not fail the rest of the batch"""
+        response = self.post_json({'prompts': ['A beautiful sunset', 'ab', 'A quiet harbour']})
+
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], ['succeeded', 'failed', 'succeeded'])
+        self.assertIn('at least 3 characters', results[1]['error'])
+        self.assertEqual(
+            Generation.objects.get(pk=results[2]['generation_id']).prompt,
+            'A quiet harbour'
+        )
+
+    def test_upstream_failure_is_per_call(self):
+        """Test that an API error only fails the items of that call"""
+        from .services import ImageGenerationError, generate_images_from_prompt
+
+        def flaky(prompt, params=None, samples=1):
+            if 'harbour' in prompt:
+                raise ImageGenerationError('Rate limit exceeded. Please try again later.')
+            return generate_images_from_prompt(prompt, params, samples)
+
+        with patch('generator.batch.services.generate_images_from_prompt', side_effect=flaky):
+            response = self.post_json({'prompts': ['A beautiful sunset', 'A quiet harbour']})
+
+        results = response.json()['results']
+        self.assertEqual(results[0]['status'], 'succeeded')
+        self.assertEqual(results[1]['status'], 'failed')
+        self.assertEqual(results[1]['error'], 'Rate limit exceeded. Please try again later.')
+
+    def test_seeded_items_are_separate_calls(self):
+        """Test that explicit seeds are each sent to the API"""
+        response = self.post_json({'prompt': 'A beautiful sunset', 'seeds': [1, 2, 3]})
+
+        self.assertEqual(response.json()['succeeded'], 3)
+        self.assertEqual(sorted(r['json']['seed'] for r in self.server.requests), [1, 2, 3])
+
+    def test_rejects_negative_seeds(self):
+        """Test that seeds are validated like the seed of a single generation"""
+        for seeds in ([1, -2], ['3', 'x'], [True]):
+            response = self.post_json({'prompt': 'A beautiful sunset', 'seeds': seeds})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.server.requests, [])
+
+    def test_variants_built_after_commit(self):
+        """Test that variants are built off the request, once the rows are committed"""
+        from . import variants
+        with patch('generator.variants._executor') as mock_executor:
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.post_json({'prompt': 'A beautiful sunset', 'seeds': [1, 2]})
+            mock_executor.assert_not_called()
+            self.assertEqual(Generation.objects.exclude(variants={}).count(), 0)
+            for callback in callbacks:
+                callback()
+
+        self.assertEqual(response.json()['succeeded'], 2)
+        submitted = [call.args for call in mock_executor.return_value.submit.call_args_list]
+        # Once per stored image, not per row
+        images = set(Generation.objects.values_list('image', flat=True))
+        self.assertEqual({generation.image.name for _, generation in submitted}, images)
+        self.assertEqual(len(submitted), len(images))
+        for function, generation in submitted:
+            self.assertIs(function, variants._generate_in_thread)
+            variants.generate_variants(generation)
+        self.assertEqual(Generation.objects.filter(variants={}).count(), 0)
+
+    @override_settings(GENERATION_JOBS_EAGER=False)
+    def test_batch_is_queued_for_the_worker(self):
+        """Test that a batch request only queues jobs, and one worker claim runs the whole batch"""
+        response = self.post_json({'prompts': ['A beautiful sunset', 'ab', 'A quiet harbour', 'A quiet harbour']})
+
+        data = response.json()
+        self.assertEqual((data['queued'], data['failed'], data['succeeded']), (3, 1, 0))
+        self.assertEqual(self.server.requests, [])
+        job = GenerationJob.objects.get(pk=data['results'][0]['job_id'])
+        self.assertEqual(data['results'][0]['status_url'], reverse('generation_job', kwargs={'pk': job.pk}))
+
+        call_command('generation_worker', concurrency=1, once=True, stdout=StringIO())
+
+        self.assertEqual(sorted(r['json']['samples'] for r in self.server.requests), [1, 2])
+        jobs = GenerationJob.objects.filter(batch=job.batch)
+        self.assertEqual(set(jobs.values_list('status', flat=True)), {GenerationJob.Status.SUCCEEDED})
+        self.assertEqual(Generation.objects.filter(pk__in=jobs.values('generation')).count(), 3)
+
+    def test_rejects_oversized_batch(self):
+        """Test the batch size limit"""
+        response = self.post_json({'prompt': 'A beautiful sunset', 'count': 51})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.server.requests, [])
+
+    def test_form_submission(self):
+        """Test the HTML form version of the endpoint"""
+        response = self.client.post(reverse('batch_generate'), {'prompts': 'A beautiful sunset\nA quiet harbour'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '2 of 2 images generated successfully!')
+        self.assertContains(response, 'View image', count=2)
+
+
+
+class AsyncGenerationTest(TemporaryMediaMixin, CleanCacheTestCase):
+    media_settings = {'GENERATION_VARIANT_WIDTHS': (32,)}
+
+    def setUp(self):
+        super().setUp()
+        from .testing import StubStabilityServer
+        self.server = StubStabilityServer().start()
+        self.patches = [
+            patch('generator.backends.stability.get_async_client', side_effect=self.make_async_client),
+            patch('generator.backends.stability.STABILITY_API_KEY', 'test-key'),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.client.login(username='testuser', password='testpass123')
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        self.server.stop()
+
+    def make_async_client(self):
+        from .async_client import AsyncStabilityClient
+        return AsyncStabilityClient(base_url=self.server.url)
+
+    def test_async_generate_creates_generation(self):
+        """Test the async view end to end against the stub API"""
+        from .testing import make_png
+        response = self.client.post(reverse('generate_async'), {'prompt': 'A beautiful sunset'})
+
+        generation = Generation.objects.get(user=self.user)
+        self.assertRedirects(response, reverse('generation_result', kwargs={'pk': generation.pk}))
+        self.assertEqual(generation.image.read(), make_png())
+        self.assertTrue(generation.image.name.startswith('generated_images/'))
+        self.assertIn('webp', generation.variants)
+        self.assertEqual(self.server.requests[0]['headers']['Authorization'], 'Bearer test-key')
+
+    def test_async_generate_json(self):
+        """Test that JSON clients get the new generation's id"""
+        response = self.client.post(
+            reverse('generate_async'), {'prompt': 'A beautiful sunset'}, HTTP_ACCEPT='application/json'
+        )
+
+        generation = Generation.objects.get(user=self.user)
+        self.assertEqual(response.json()['id'], generation.pk)
+
+    def test_async_generate_maps_api_errors(self):
+        """Test that upstream status codes surface as the same errors as the sync path"""
+        self.server.status = 401
+        response = self.client.post(
+            reverse('generate_async'), {'prompt': 'A beautiful sunset'}, HTTP_ACCEPT='application/json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Invalid API key. Please check your configuration.')
+        self.assertFalse(Generation.objects.exists())
+
+    @override_settings(STABILITY_RETRY_BASE_DELAY=0.01)
+    def test_async_retry_after_blocks_off_the_event_loop(self):
+        """Test that a Retry-After closes the shared window without cache I/O on the event loop"""
+        import asyncio
+        from asgiref.sync import async_to_sync
+        from .services import agenerate_images_from_prompt
+        self.server.status = 429
+        self.server.failures = 1
+        self.server.extra_headers = {'Retry-After': '0'}
+        on_event_loop = []
+
+        def block_for(seconds):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                on_event_loop.append(False)
+            else:
+                on_event_loop.append(True)
+
+        with patch('generator.rate_limit.block_for', side_effect=block_for):
+            async_to_sync(agenerate_images_from_prompt)('A beautiful sunset')
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(on_event_loop, [False])
+
+    def test_async_generate_rejects_invalid_prompt(self):
+        """Test that validation errors are rendered without calling the API"""
+        response = self.client.post(reverse('generate_async'), {'prompt': 'ab'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'at least 3 characters')
+        self.assertEqual(self.server.requests, [])
+
+
+@override_settings(STABILITY_RETRY_BASE_DELAY=0.01)
+class RateLimitTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        from .client import StabilityClient
+        from .testing import StubStabilityServer
+        from . import metrics
+        metrics.reset()
+        self.server = StubStabilityServer().start()
+        self.api_client = StabilityClient(base_url=self.server.url)
+        self.patches = [
+            patch('generator.backends.stability.get_client', return_value=self.api_client),
+            patch('generator.backends.stability.STABILITY_API_KEY', 'test-key'),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        self.api_client.close()
+        self.server.stop()
+
+    def test_retries_rate_limited_calls_after_retry_after(self):
+        """Test that 429s are retried no sooner than the server's Retry-After"""
+        from . import metrics
+        self.server.status = 429
+        self.server.failures = 2
+        self.server.extra_headers = {'Retry-After': '3'}
+
+        with patch('generator.backends.stability.time.sleep') as sleep, \
+                patch('generator.backends.stability.rate_limit.block_for') as block_for:
+            result = generate_image_from_prompt("A beautiful sunset")
+
+        self.assertTrue(result.size)
+        self.assertEqual(len(self.server.requests), 3)
+        block_for.assert_called_with(3.0)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(all(call.args[0] >= 3 for call in sleep.call_args_list))
+        self.assertEqual(metrics.get_counter('stability_retries_total', reason='rate_limited'), 2)
+
+    def test_retry_after_holds_back_other_callers(self):
+        """Test that a Retry-After closes the shared bucket for everyone"""
+        from . import rate_limit
+        rate_limit.block_for(5)
+
+        self.assertGreater(rate_limit.try_acquire(), 4)
+        with self.assertRaises(rate_limit.RateLimitTimeout):
+            rate_limit.acquire(deadline=1)
+
+    @override_settings(STABILITY_MAX_RETRIES=2)
+    def test_gives_up_after_max_retries(self):
+        """Test that persistent server errors surface after the retry budget"""
+        from .services import ImageGenerationError
+        self.server.status = 500
+
+        with patch('generator.backends.stability.time.sleep'):
+            with self.assertRaisesMessage(ImageGenerationError, 'currently unavailable'):
+                generate_image_from_prompt("A beautiful sunset")
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_client_errors_are_not_retried(self):
+        """Test that errors a retry cannot fix fail immediately"""
+        from .services import ImageGenerationError
+        self.server.status = 401
+
+        with self.assertRaisesMessage(ImageGenerationError, 'Invalid API key'):
+            generate_image_from_prompt("A beautiful sunset")
+        self.assertEqual(len(self.server.requests), 1)
+
+    @override_settings(STABILITY_RATE_LIMIT=2, STABILITY_RATE_PERIOD=60)
+    def test_bucket_paces_calls(self):
+        """Test that calls beyond the quota wait and report the bucket level"""
+        from . import metrics, rate_limit
+
+        self.assertEqual(rate_limit.try_acquire(), 0)
+        self.assertEqual(rate_limit.try_acquire(), 0)
+        self.assertEqual(metrics.get_gauge('stability_rate_limit_tokens'), 0)
+        self.assertGreater(rate_limit.try_acquire(), 0)
+
+        with patch('generator.rate_limit.time.sleep') as sleep:
+            with self.assertRaises(rate_limit.RateLimitTimeout):
+                rate_limit.acquire(deadline=0.5)
+        sleep.assert_not_called()
+
+    @override_settings(STABILITY_RATE_LIMIT=4, STABILITY_RATE_PERIOD=10)
+    def test_window_slides_across_boundaries(self):
+        """Test that a burst on each side of a window boundary stays within the quota"""
+        from . import rate_limit
+
+        with patch('generator.rate_limit.time.time', return_value=1009.0):
+            self.assertEqual([rate_limit.try_acquire() for _ in range(4)], [0, 0, 0, 0])
+            self.assertAlmostEqual(rate_limit.try_acquire(), 1.0)
+        # Just past the boundary almost all of the previous window still counts
+        with patch('generator.rate_limit.time.time', return_value=1010.5):
+            self.assertAlmostEqual(rate_limit.try_acquire(), 2.0)
+        # Once a quarter of the previous window has slid out, one more call fits
+        with patch('generator.rate_limit.time.time', return_value=1012.5):
+            self.assertEqual(rate_limit.try_acquire(), 0)
+            self.assertGreater(rate_limit.try_acquire(), 0)
+        with patch('generator.rate_limit.time.time', return_value=1019.0):
+            self.assertEqual([rate_limit.try_acquire() for _ in range(2)], [0, 0])
+
+    def test_parse_retry_after(self):
+        """Test both Retry-After formats"""
+        from email.utils import formatdate
+        import time
+        from .rate_limit import parse_retry_after
+
+        self.assertEqual(parse_retry_after('7'), 7.0)
+        self.assertAlmostEqual(parse_retry_after(formatdate(time.time() + 30, usegmt=True)), 30, delta=2)
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))
+
+
+@override_settings(STABILITY_RETRY_BASE_DELAY=0.01, CIRCUIT_BREAKER_FAILURE_THRESHOLD=2)
+class CircuitBreakerTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        from .client import StabilityClient
+        from .testing import StubStabilityServer
+        from . import metrics
+        metrics.reset()
+        self.server = StubStabilityServer().start()
+        self.api_client = StabilityClient(base_url=self.server.url)
+        self.patches = [
+            patch('generator.backends.stability.get_client', return_value=self.api_client),
+            patch('generator.backends.stability.STABILITY_API_KEY', 'test-key'),
+            patch('generator.backends.stability.time.sleep'),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        self.api_client.close()
+        self.server.stop()
+        # Leave the circuit closed for the tests that follow
+        cache.clear()
+
+    def transitions(self):
+        from .models import CircuitTransition
+        return list(CircuitTransition.objects.order_by('pk').values_list('from_state', 'to_state'))
+
+    def test_opens_after_repeated_failures(self):
+        """Test that outage errors open the circuit and later calls fail without a request"""
+        from .circuit_breaker import CircuitOpenError
+        from . import metrics
+        self.server.status = 503
+
+        with self.assertRaises(CircuitOpenError):
+            generate_image_from_prompt('A beautiful sunset')
+        self.assertEqual(len(self.server.requests), 2)
+        with self.assertRaisesMessage(CircuitOpenError, 'temporarily unavailable'):
+            generate_image_from_prompt('A beautiful sunset')
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.transitions(), [('closed', 'open')])
+        self.assertEqual(metrics.get_gauge('circuit_breaker_state', circuit='stability'), 2)
+        self.assertEqual(metrics.get_counter('circuit_breaker_rejections_total', circuit='stability'), 2)
+
+    def test_rate_limiting_does_not_open_the_circuit(self):
+        """Test that 429s are left to the rate limiter"""
+        from .circuit_breaker import stability
+        self.server.status = 429
+        self.server.failures = 2
+
+        generate_image_from_prompt('A beautiful sunset')
+
+        self.assertEqual(stability.state(), ('closed', None))
+
+    @override_settings(CIRCUIT_BREAKER_OPEN_SECONDS=0)
+    def test_half_open_trial_call(self):
+        """Test that one trial call is let through after the open period and decides the state"""
+        from .circuit_breaker import CircuitOpenError, stability
+        stability.record_failure()
+        stability.record_failure()
+
+        stability.check()
+        with self.assertRaises(CircuitOpenError):
+            stability.check()
+        stability.record_failure()
+        self.assertEqual(stability.state()[0], 'open')
+
+        generate_image_from_prompt('A beautiful sunset')
+        self.assertEqual(stability.state(), ('closed', None))
+        self.assertEqual(self.transitions(), [
+            ('closed', 'open'), ('open', 'half_open'), ('half_open', 'open'), ('open', 'half_open'),
+            ('half_open', 'closed'),
+        ])
+
+    @override_settings(CIRCUIT_BREAKER_OPEN_SECONDS=0)
+    def test_trial_answered_with_client_error_closes(self):
+        """Test that a 400 to the trial call proves the API is up instead of leaving the circuit half open"""
+        from .circuit_breaker import stability
+        stability.record_failure()
+        stability.record_failure()
+        self.server.status = 400
+        self.server.failures = 1
+
+        with self.assertRaisesMessage(ImageGenerationError, 'API error: 400'):
+            generate_image_from_prompt('A beautiful sunset')
+        self.assertEqual(stability.state(), ('closed', None))
+        generate_image_from_prompt('A beautiful sunset')
+        self.assertEqual(len(self.server.requests), 2)
+
+    @override_settings(CIRCUIT_BREAKER_OPEN_SECONDS=0)
+    def test_trial_retries_after_rate_limiting(self):
+        """Test that a 429 to the trial call closes the circuit and the trial's own retry goes through"""
+        from .circuit_breaker import stability
+        stability.record_failure()
+        stability.record_failure()
+        self.server.status = 429
+        self.server.failures = 1
+
+        generate_image_from_prompt('A beautiful sunset')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(stability.state(), ('closed', None))
+
+    @override_settings(CIRCUIT_BREAKER_OPEN_SECONDS=0)
+    def test_trial_without_answer_is_released(self):
+        """Test that a trial ending without a reply from the API lets the next caller try"""
+        from .circuit_breaker import stability
+        stability.record_failure()
+        stability.record_failure()
+
+        with patch.object(self.api_client, 'post', side_effect=requests.exceptions.InvalidURL('bad url')):
+            with self.assertRaisesMessage(ImageGenerationError, 'Network error'):
+                generate_image_from_prompt('A beautiful sunset')
+        self.assertEqual(stability.state()[0], 'half_open')
+        generate_image_from_prompt('A beautiful sunset')
+        self.assertEqual(stability.state(), ('closed', None))
+
+    @override_settings(GENERATION_JOBS_EAGER=False)
+    def test_worker_leaves_jobs_queued_while_open(self):
+        """Test that queued jobs wait for the API to recover instead of failing"""
+        from .circuit_breaker import stability
+        from . import jobs
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        job = jobs.enqueue_generation(user, 'A beautiful sunset')
+        jobs.run_job(jobs.claim_next_job())
+        self.assertEqual(len(self.server.requests), 1)
+        stability.record_failure()
+        stability.record_failure()
+
+        jobs.run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, GenerationJob.Status.QUEUED)
+        self.assertIsNone(job.started_at)
+        out = StringIO()
+        call_command('generation_worker', '--once', '--concurrency', '1', stdout=out)
+        self.assertIn('after 0 job(s)', out.getvalue())
+
+    def test_admin_shows_state_and_closes(self):
+        """Test the transition history in the admin"""
+        from .circuit_breaker import stability
+        from .models import CircuitTransition
+        admin_user = User.objects.create_superuser(username='admin', password='testpass123')
+        self.client.force_login(admin_user)
+        stability.record_failure()
+        stability.record_failure()
+        url = reverse('admin:generator_circuittransition_changelist')
+
+        response = self.client.get(url)
+        self.assertContains(response, 'The stability circuit is open')
+        self.client.post(url, {
+            'action': 'close_circuits',
+            '_selected_action': CircuitTransition.objects.values_list('pk', flat=True),
+        })
+        self.assertEqual(stability.state(), ('closed', None))
+        self.assertEqual(self.transitions()[-1], ('open', 'closed'))
+
+
+@override_settings(GENERATION_JOBS_EAGER=False, GENERATION_USER_MAX_CONCURRENT=1)
+class FairSchedulingTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.power_user = User.objects.create_user(username='poweruser', password='testpass123')
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+
+    def test_claims_round_robin_across_users(self):
+        """Test that a user with a long queue does not starve others"""
+        from .jobs import claim_next_job
+        from .scheduling import release_slots
+        for index in range(3):
+            GenerationJob.objects.create(user=self.power_user, prompt=f'Power prompt {index}')
+        GenerationJob.objects.create(user=self.user, prompt='A beautiful sunset')
+
+        first = claim_next_job()
+        second = claim_next_job()
+        self.assertEqual({first.user, second.user}, {self.power_user, self.user})
+        # Both users are at their concurrency limit of one running job
+        self.assertIsNone(claim_next_job())
+
+        first.status = GenerationJob.Status.SUCCEEDED
+        first.save()
+        release_slots(first.user_id)
+        self.assertEqual(claim_next_job().user, first.user)
+
+    def test_claim_takes_a_slot_per_user(self):
+        """Test that a job is not started while another worker holds the user's slot"""
+        from .jobs import claim_next_job, run_job
+        from .scheduling import acquire_slots
+        GenerationJob.objects.create(user=self.power_user, prompt='Power prompt')
+        job = GenerationJob.objects.create(user=self.user, prompt='A beautiful sunset')
+        # Another worker claimed a job of the user but has not committed yet
+        self.assertEqual(acquire_slots(self.power_user.pk), 1)
+
+        claimed = claim_next_job()
+        self.assertEqual(claimed, job)
+        self.assertIsNone(claim_next_job())
+
+        with patch('generator.services.generate_image_from_prompt', side_effect=fake_image_file):
+            run_job(claimed)
+        self.assertEqual(acquire_slots(self.user.pk), 1)
+
+    @override_settings(GENERATION_JOBS_EAGER=True)
+    def test_inline_generation_shares_the_slots(self):
+        """Test that the batch and eager views count against the same limit as the worker"""
+        import json
+        from .jobs import claim_next_job
+        from .scheduling import acquire_slots
+        self.client.login(username='testuser', password='testpass123')
+        GenerationJob.objects.create(user=self.user, prompt='A quiet harbour')
+        self.assertIsNotNone(claim_next_job())
+
+        with patch('generator.services.generate_image_from_prompt') as mock_generate:
+            response = self.client.post(reverse('generate'), {'prompt': 'A beautiful sunset'})
+            self.assertContains(response, 'You already have 1 generations in progress')
+            response = self.client.post(
+                reverse('batch_generate'), json.dumps({'prompt': 'A beautiful sunset', 'count': 3}),
+                content_type='application/json',
+            )
+            self.assertEqual(response.status_code, 400)
+        mock_generate.assert_not_called()
+        self.assertEqual(GenerationJob.objects.count(), 1)
+        self.assertFalse(Generation.objects.exists())
+        self.assertEqual(acquire_slots(self.power_user.pk, 3), 1)
+
+    def test_user_who_waited_longest_goes_first(self):
+        """Test that the next job belongs to the user whose last job started earliest"""
+        from .jobs import claim_next_job
+        now = timezone.now()
+        GenerationJob.objects.create(
+            user=self.power_user, prompt='Earlier', status=GenerationJob.Status.SUCCEEDED,
+            started_at=now - timedelta(seconds=5),
+        )
+        GenerationJob.objects.create(
+            user=self.user, prompt='Earlier', status=GenerationJob.Status.SUCCEEDED,
+            started_at=now - timedelta(seconds=60),
+        )
+        GenerationJob.objects.create(user=self.power_user, prompt='Power prompt')
+        GenerationJob.objects.create(user=self.user, prompt='A beautiful sunset')
+
+        self.assertEqual(claim_next_job().user, self.user)
+
+    @override_settings(GENERATION_USER_DAILY_QUOTA=3)
+    def test_daily_quota_counts_generations_and_pending_jobs(self):
+        """Test that stored generations and queued jobs both count against the quota"""
+        from .jobs import enqueue_generation
+        from .scheduling import QuotaExceeded, usage
+        Generation.objects.create(user=self.user, prompt='Earlier', image='generated_images/test.png')
+        enqueue_generation(self.user, 'A beautiful sunset')
+        enqueue_generation(self.user, 'A quiet harbour')
+
+        with self.assertRaisesMessage(QuotaExceeded, 'Daily limit of 3 images reached'):
+            enqueue_generation(self.user, 'A third prompt')
+        self.assertEqual(usage(self.user), {'active': 2, 'today': 1, 'month': 1})
+        # Other users are unaffected
+        enqueue_generation(self.power_user, 'A beautiful sunset')
+
+    @override_settings(GENERATION_USER_MONTHLY_QUOTA=2)
+    def test_quota_ignores_earlier_months(self):
+        """Test that only the current month counts towards the monthly quota"""
+        from .scheduling import check_quota
+        old = Generation.objects.create(user=self.user, prompt='Old', image='generated_images/test.png')
+        Generation.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=40))
+        Generation.objects.create(user=self.user, prompt='New', image='generated_images/test.png')
+
+        check_quota(self.user)
+        with self.assertRaises(ImageGenerationError):
+            check_quota(self.user, requested=2)
+
+    def test_usage_is_a_single_query(self):
+        """Test that the quota check does not count the user's history in several queries"""
+        from .scheduling import usage
+        with self.assertNumQueries(1):
+            usage(self.user)
+
+    @override_settings(GENERATION_USER_DAILY_QUOTA=1)
+    def test_generate_view_reports_quota(self):
+        """Test that the view explains why the request was refused"""
+        Generation.objects.create(user=self.user, prompt='Earlier', image='generated_images/test.png')
+        self.client.login(username='testuser', password='testpass123')
+
+        response = self.client.post(reverse('generate'), {'prompt': 'A beautiful sunset'})
+
+        self.assertContains(response, 'Daily limit of 1 images reached')
+        self.assertFalse(GenerationJob.objects.exists())
+
+
+@override_settings(GENERATION_BACKEND='generator.backends.local.LocalBackend',
+                   GENERATION_BACKEND_OPTIONS={'size': (64, 48)})
+class GenerationBackendTest(TemporaryMediaMixin, CleanCacheTestCase):
+    media_settings = {'GENERATION_VARIANT_WIDTHS': (32,)}
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+
+    def test_backend_is_configurable(self):
+        """Test that the backend class and options come from settings"""
+        from .backends import get_backend
+        from .backends.local import LocalBackend
+        backend = get_backend()
+
+        self.assertIsInstance(backend, LocalBackend)
+        self.assertEqual(backend.size, (64, 48))
+        self.assertIs(get_backend(), backend)
+
+    def test_local_backend_is_deterministic(self):
+        """Test that identical requests render identical PNGs and different ones do not"""
+        from PIL import Image
+        from .services import generate_images_from_prompt
+        first = generate_images_from_prompt('A beautiful sunset', {'seed': 7})[0]
+        again = generate_images_from_prompt('A beautiful sunset', {'seed': 7})[0]
+        other = generate_images_from_prompt('A beautiful sunset', {'seed': 8})[0]
+
+        self.assertEqual(first.read(), again.read())
+        first.seek(0)
+        self.assertNotEqual(first.read(), other.read())
+        first.seek(0)
+        self.assertEqual(Image.open(first).size, (64, 48))
+        self.assertEqual(first.artifact['seed'], 7)
+
+    def test_local_backend_samples(self):
+        """Test that each sample of one call gets its own seed"""
+        from .services import generate_images_from_prompt
+        images = generate_images_from_prompt('A beautiful sunset', samples=3)
+
+        self.assertEqual(len({image.artifact['seed'] for image in images}), 3)
+        self.assertTrue(all(image.size for image in images))
+
+    def test_full_pipeline_offline(self):
+        """Test the generate view end to end with no API key or network"""
+        self.client.login(username='testuser', password='testpass123')
+        with patch('generator.backends.stability.STABILITY_API_KEY', None):
+            response = self.client.post(reverse('generate'), {'prompt': 'A beautiful sunset'})
+
+        generation = Generation.objects.get(user=self.user)
+        self.assertRedirects(response, reverse('generation_result', kwargs={'pk': generation.pk}))
+        self.assertIn('webp', generation.variants)
+
+    @override_settings(GENERATION_BACKEND_OPTIONS={'size': (16, 16), 'latency': 0.2})
+    def test_local_backend_latency(self):
+        """Test the simulated generation time"""
+        import time
+        from .services import generate_image_from_prompt
+        started = time.monotonic()
+        generate_image_from_prompt('A beautiful sunset')
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+
+class BenchmarkCommandTest(TransactionTestCase):
+    def test_benchmark_writes_json_report(self):
+        """Test that the benchmark command runs the whole flow and reports every view"""
+        import json
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('benchmark_generation', concurrency=1, flows=2, delay=0, backend='local',
+                         output=output.name, stdout=StringIO())
+            with open(output.name) as f:
+                report = json.load(f)
+
+        self.assertEqual(report['flows'], 2)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(set(report['views']), {'login', 'generate', 'result', 'gallery'})
+        self.assertEqual(report['views']['generate']['requests'], 2)
+        self.assertGreater(report['views']['gallery']['queries']['mean'], 0)
+        self.assertGreater(report['workers'][0]['peak_rss_mb'], 0)
+        # Benchmark users and their generations are removed afterwards
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Generation.objects.exists())
+
+
+class MetricsTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        from . import metrics
+        metrics.reset()
+
+    def test_stage_timings_and_error_counters(self):
+        """Test that a generation records each stage and failures by category"""
+        from .client import StabilityClient
+        from .services import create_generation
+        from .testing import StubStabilityServer
+        from . import metrics
+        user = User.objects.create_user(username='testuser', password='testpass123')
+
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root), \
+                StubStabilityServer() as server, \
+                patch('generator.backends.stability.get_client', return_value=StabilityClient(base_url=server.url)), \
+                patch('generator.backends.stability.STABILITY_API_KEY', 'test-key'):
+            create_generation(user, 'A beautiful sunset')
+            server.status = 403
+            with self.assertRaises(ImageGenerationError):
+                create_generation(user, 'A quiet harbour')
+
+        for stage in ('validation', 'upstream', 'decode', 'storage', 'db'):
+            self.assertEqual(metrics.get_histogram('generation_stage_seconds', stage=stage)['count'],
+                             2 if stage in ('validation', 'upstream') else 1, stage)
+        self.assertEqual(metrics.get_histogram('stability_request_seconds', status=200)['count'], 1)
+        self.assertEqual(metrics.get_histogram('generation_image_bytes')['count'], 1)
+        self.assertEqual(metrics.get_counter('stability_errors_total', category='403'), 1)
+
+    def test_prometheus_format(self):
+        """Test the text exposition of each metric type"""
+        from . import metrics
+        metrics.inc('stability_errors_total', category='429')
+        metrics.set_gauge('stability_rate_limit_tokens', 7)
+        metrics.observe('stability_request_seconds', 0.3, buckets=(0.1, 0.5, 1), status=200)
+
+        text = metrics.render_prometheus(metrics.snapshot())
+
+        self.assertIn('# TYPE stability_errors_total counter\nstability_errors_total{category="429"} 1\n', text)
+        self.assertIn('stability_rate_limit_tokens 7\n', text)
+        self.assertIn('stability_request_seconds_bucket{status="200",le="0.1"} 0\n', text)
+        self.assertIn('stability_request_seconds_bucket{status="200",le="0.5"} 1\n', text)
+        self.assertIn('stability_request_seconds_bucket{status="200",le="+Inf"} 1\n', text)
+        self.assertIn('stability_request_seconds_count{status="200"} 1\n', text)
+
+    def test_metrics_aggregated_across_processes(self):
+        """Test that /metrics sums the values written by every worker process, in any container"""
+        import json
+        from . import metrics
+        with tempfile.TemporaryDirectory() as metrics_dir, self.settings(METRICS_DIR=metrics_dir):
+            metrics.inc('stability_errors_total', 2, category='timeout')
+            metrics.observe('stability_request_seconds', 0.3, buckets=(0.1, 0.5), status=200)
+            # Values flushed by another worker, and by one that has exited
+            other = {
+                'counters': [['stability_errors_total', [['category', 'timeout']], 3]],
+                'gauges': [['stability_rate_limit_waiting', [], 4]],
+                'histograms': [['stability_request_seconds', [['status', '200']],
+                                {'buckets': [0.1, 0.5], 'counts': [1, 0], 'count': 1, 'sum': 0.05}]],
+            }
+            # ... and by processes of other containers sharing the directory,
+            # one of which stopped writing long ago
+            names = [f'{metrics.HOST}-{os.getppid()}', f'{metrics.HOST}-999999999', 'worker-1', 'stale-1']
+            for name in names:
+                with open(os.path.join(metrics_dir, f'{name}.json'), 'w') as f:
+                    json.dump(other, f)
+            os.utime(os.path.join(metrics_dir, 'stale-1.json'), (0, 0))
+
+            response = self.client.get(reverse('metrics'))
+
+        text = response.content.decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('stability_errors_total{category="timeout"} 14\n', text)
+        self.assertIn('stability_request_seconds_bucket{status="200",le="0.1"} 4\n', text)
+        self.assertIn('stability_request_seconds_count{status="200"} 5\n', text)
+        # Gauges are per live process
+        self.assertIn(f'stability_rate_limit_waiting{{host="{metrics.HOST}",pid="{os.getppid()}"}} 4\n', text)
+        self.assertIn('stability_rate_limit_waiting{host="worker",pid="1"} 4\n', text)
+        self.assertNotIn('pid="999999999"', text)
+        self.assertNotIn('host="stale"', text)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        """Test that a configured token is required"""
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+class ModerationTest(TestCase):
+    def test_normalisation_and_word_boundaries(self):
+        """Test that case, accents, leetspeak, zero-width characters and punctuation are folded"""
+        from .moderation import Moderator
+        moderator = Moderator(['hack*', 'make a bomb'])
+
+        for prompt in ['HACK the system', 'h4ck3r tools', 'hàcking', 'ha​ck', 'how to make-a  BOMB']:
+            self.assertTrue(moderator.is_blocked(prompt), prompt)
+        for prompt in ['a shack by the lake', 'make a bombastic entrance', 'A beautiful sunset']:
+            self.assertFalse(moderator.is_blocked(prompt), prompt)
+
+        moderator = Moderator(['*malware*'])
+        self.assertTrue(moderator.is_blocked('antimalware software'))
+        self.assertTrue(moderator.is_blocked('MALWARE'))
+
+    def test_table_not_migrated(self):
+        """Test that the built-in list still applies when the terms table cannot be read"""
+        from django.db import OperationalError
+        from . import moderation
+        from .services import validate_prompt
+        moderation._recheck()
+        with patch('generator.moderation.ModerationTerm.objects.aggregate',
+                   side_effect=OperationalError('no such table: generator_moderationterm')), \
+                patch('generator.moderation.ModerationTerm.objects.values_list',
+                      side_effect=OperationalError('no such table: generator_moderationterm')):
+            with self.assertRaises(Exception):
+                validate_prompt('hacking the mainframe')
+            self.assertEqual(validate_prompt('A red dragon'), 'A red dragon')
+        moderation._recheck()
+
+    def test_allowlist(self):
+        """Test that a blocked term inside an allowed phrase is ignored"""
+        from .moderation import Moderator
+        moderator = Moderator(['hack*', 'spam'], ['life hack*'])
+
+        self.assertEqual(moderator.blocked_terms('life hacks for kids'), [])
+        self.assertEqual(moderator.blocked_terms('life hacks and spam'), ['spam'])
+        self.assertEqual(moderator.blocked_terms('hack a life'), ['hack*'])
+
+    def test_terms_from_database_reload(self):
+        """Test that terms added in the admin apply to the next prompt"""
+        from .models import ModerationTerm
+        from .services import validate_prompt
+        self.assertEqual(validate_prompt('A red dragon'), 'A red dragon')
+
+        term = ModerationTerm.objects.create(term='dragon')
+        with self.assertRaises(Exception):
+            validate_prompt('A red dragon')
+
+        term.delete()
+        self.assertEqual(validate_prompt('A red dragon'), 'A red dragon')
+
+    def test_terms_from_file_reload(self):
+        """Test that edits to the list files are picked up"""
+        from .services import validate_prompt
+        with tempfile.TemporaryDirectory() as directory:
+            blocklist = os.path.join(directory, 'blocklist.txt')
+            allowlist = os.path.join(directory, 'allowlist.txt')
+            with open(blocklist, 'w') as f:
+                f.write('# weapons\nsword*\n')
+            with open(allowlist, 'w') as f:
+                f.write('swordfish\n')
+
+            with self.settings(MODERATION_BLOCKLIST_FILE=blocklist, MODERATION_ALLOWLIST_FILE=allowlist,
+                               MODERATION_RELOAD_INTERVAL=0):
+                with self.assertRaises(Exception):
+                    validate_prompt('A knight with two swords')
+                self.assertEqual(validate_prompt('A swordfish'), 'A swordfish')
+
+                with open(blocklist, 'w') as f:
+                    f.write('shield\n')
+                os.utime(blocklist, ns=(0, 0))
+                self.assertEqual(validate_prompt('A knight with two swords'), 'A knight with two swords')
+
+
+class ContentAddressedStorageTest(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+
+    def test_names_by_content_and_deduplicates(self):
+        """Test that files are named by SHA-256 in sharded directories and stored once"""
+        import hashlib
+        from django.core.files.storage import default_storage
+        digest = hashlib.sha256(b'fake image data').hexdigest()
+
+        first = default_storage.save('generated_images/generated.png', ContentFile(b'fake image data'))
+        second = default_storage.save('generated_images/other.PNG', fake_image_file())
+
+        self.assertEqual(first, f'generated_images/{digest[:2]}/{digest[2:4]}/{digest}.png')
+        self.assertEqual(second, first)
+        self.assertEqual(os.listdir(os.path.dirname(default_storage.path(first))), [f'{digest}.png'])
+
+    def test_moves_temporary_files_into_place(self):
+        """Test that a decoded temporary file is renamed rather than copied"""
+        from django.core.files.storage import default_storage
+        from .streaming import temporary_image_file
+        image_file = temporary_image_file()
+        image_file.write(b'streamed image data')
+        image_file.flush()
+        temporary_path = image_file.temporary_file_path()
+
+        name = default_storage.save('generated_images/generated.png', image_file)
+        image_file.close()
+
+        self.assertFalse(os.path.exists(temporary_path))
+        with default_storage.open(name, 'rb') as stored:
+            self.assertEqual(stored.read(), b'streamed image data')
+
+    def test_file_deleted_with_last_reference(self):
+        """Test that shared files are reference counted by generation rows"""
+        from django.core.files.storage import default_storage
+        from .models import StoredFile
+        name = default_storage.save('generated_images/generated.png', fake_image_file())
+        first = Generation.objects.create(user=self.user, prompt='First', image=name)
+        second = Generation.objects.create(user=self.user, prompt='Second', image=name)
+        self.assertEqual(StoredFile.objects.get(name=name).references, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(default_storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(StoredFile.objects.exists())
+
+    def test_file_kept_when_referenced_again_before_commit(self):
+        """Test that a file deduplicated against after its last reference was released is not deleted"""
+        from django.core.files.storage import default_storage
+        from .models import StoredFile
+        name = default_storage.save('generated_images/generated.png', fake_image_file())
+        first = Generation.objects.create(user=self.user, prompt='First', image=name)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.delete()
+        # A concurrent request saved the same bytes and created its row first
+        self.assertEqual(default_storage.save('generated_images/other.png', fake_image_file()), name)
+        Generation.objects.create(user=self.user, prompt='Second', image=name)
+        for callback in callbacks:
+            callback()
+
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(StoredFile.objects.get(name=name).references, 1)
+
+    def test_rehome_images_command(self):
+        """Test that existing files are moved to content-addressed names"""
+        from django.core.files.storage import FileSystemStorage, default_storage
+        from .models import StoredFile
+        legacy = FileSystemStorage(location=self.media_root.name)
+        old_name = legacy.save('generated_images/generated.png', ContentFile(b'fake image data'))
+        Generation.objects.create(user=self.user, prompt='First', image=old_name)
+        Generation.objects.create(user=self.user, prompt='Second', image=old_name)
+        ResultCacheEntry.objects.create(key='cached', image=old_name)
+
+        out = StringIO()
+        call_command('rehome_images', '--delete-old', stdout=out)
+
+        new_names = set(Generation.objects.values_list('image', flat=True))
+        self.assertEqual(len(new_names), 1)
+        new_name = new_names.pop()
+        self.assertNotEqual(new_name, old_name)
+        self.assertEqual(ResultCacheEntry.objects.get(key='cached').image, new_name)
+        self.assertEqual(StoredFile.objects.get(name=new_name).references, 2)
+        self.assertFalse(default_storage.exists(old_name))
+        self.assertIn('Moved 1 image(s)', out.getvalue())
+
+
+@override_settings(GENERATION_COALESCE_POLL_INTERVAL=0.01)
+class CoalescingTest(TemporaryMediaMixin, CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+
+    def run_concurrently(self, count, produce):
+        """Call ``coalesce`` from ``count`` threads at once; returns their results or exceptions"""
+        import threading
+        from .singleflight import coalesce
+        results = [None] * count
+        barrier = threading.Barrier(count)
+
+        def call(index):
+            barrier.wait()
+            try:
+                results[index] = coalesce('same-request', produce, ImageGenerationError)
+            except ImageGenerationError as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_one_result(self):
+        """Test that only one of several identical calls in flight runs"""
+        import time
+        calls = []
+
+        def produce():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'name': 'generated_images/shared.png'}
+
+        results = self.run_concurrently(5, produce)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({result['name'] for result, _ in results}, {'generated_images/shared.png'})
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True, True])
+
+    def test_leader_error_is_shared(self):
+        """Test that followers fail with the leader's error instead of calling again"""
+        import time
+        calls = []
+
+        def produce():
+            calls.append(1)
+            time.sleep(0.2)
+            raise ImageGenerationError('Rate limit exceeded. Please try again later.')
+
+        results = self.run_concurrently(3, produce)
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(str(result) == 'Rate limit exceeded. Please try again later.' for result in results))
+
+    @override_settings(GENERATION_JOBS_EAGER=False)
+    @patch('generator.services.generate_image_from_prompt')
+    def test_follower_job_requeued_when_leader_finds_circuit_open(self, mock_generate):
+        """Test that followers get the leader's CircuitOpenError, so their jobs wait for the API too"""
+        import threading
+        from .circuit_breaker import CircuitOpenError
+        from .jobs import claim_next_job, run_job
+        from .result_cache import cache_key
+        from .services import generation_params
+        from .singleflight import coalesce
+        leading, following = threading.Event(), threading.Event()
+
+        def produce():
+            leading.set()
+            following.wait(5)
+            raise CircuitOpenError(30)
+
+        def lead():
+            try:
+                coalesce(cache_key('A beautiful sunset', generation_params()), produce, ImageGenerationError)
+            except CircuitOpenError:
+                pass
+
+        GenerationJob.objects.create(user=self.user, prompt='A beautiful sunset')
+        thread = threading.Thread(target=lead)
+        thread.start()
+        leading.wait(5)
+        with patch('generator.singleflight.time.sleep', side_effect=lambda seconds: following.set()):
+            job = run_job(claim_next_job())
+        thread.join()
+
+        mock_generate.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.status, GenerationJob.Status.QUEUED)
+        self.assertEqual(job.error, '')
+
+    def test_finished_flights_are_not_reused(self):
+        """Test that a later identical call starts a new flight"""
+        from .singleflight import coalesce
+        self.assertEqual(coalesce('same-request', lambda: 1), (1, False))
+        self.assertEqual(coalesce('same-request', lambda: 2), (2, False))
+
+    @patch('generator.services.generate_image_from_prompt')
+    def test_follower_gets_its_own_generation(self, mock_generate):
+        """Test that a request joining a flight gets its own row for the leader's image"""
+        import threading
+        from django.core.files.storage import default_storage
+        from .models import StoredFile
+        from .result_cache import cache_key
+        from .services import create_generation, generation_params
+        from .singleflight import coalesce
+        name = default_storage.save('generated_images/generated.png', fake_image_file())
+        leader = Generation.objects.create(user=self.user, prompt='A beautiful sunset', image=name)
+        leading, following = threading.Event(), threading.Event()
+
+        def produce():
+            leading.set()
+            following.wait(5)
+            return {'name': name, 'fields': {'image_format': 'png', 'image_size': 15}}
+
+        # The leader thread stands in for a request in another process
+        key = cache_key('A beautiful sunset', generation_params())
+        thread = threading.Thread(target=coalesce, args=(key, produce))
+        thread.start()
+        leading.wait(5)
+        with patch('generator.singleflight.time.sleep', side_effect=lambda seconds: following.set()):
+            follower = create_generation(self.user, 'a  beautiful SUNSET')
+        thread.join()
+
+        mock_generate.assert_not_called()
+        self.assertNotEqual(follower.pk, leader.pk)
+        self.assertEqual(follower.image.name, name)
+        self.assertEqual(follower.image_format, 'png')
+        self.assertEqual(StoredFile.objects.get(name=name).references, 2)
+
+
+@override_settings(GENERATION_JOBS_EAGER=False, PROGRESS_POLL_INTERVAL=0.01, PROGRESS_HEARTBEAT=0.05)
+class ProgressEventsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.job = GenerationJob.objects.create(user=self.user, prompt='A beautiful sunset')
+
+    async def read_events(self, response, count):
+        """Return the first ``count`` events of a stream, skipping keep-alive comments"""
+        import json
+        events = []
+        async for chunk in response.streaming_content:
+            for block in chunk.decode().split('\n\n'):
+                data = [line[6:] for line in block.splitlines() if line.startswith('data: ')]
+                if data:
+                    events.append(json.loads(data[0]))
+            if len(events) >= count:
+                break
+        return events
+
+    async def test_streams_status_changes(self):
+        """Test that a stream follows its job from queued to the result"""
+        from asgiref.sync import sync_to_async
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('generation_job_events', kwargs={'pk': self.job.pk}))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+
+        self.assertEqual(await self.read_events(response, 1), [{'id': self.job.pk, 'status': 'queued'}])
+        await GenerationJob.objects.filter(pk=self.job.pk).aupdate(status=GenerationJob.Status.RUNNING)
+        self.assertEqual((await self.read_events(response, 1))[0]['status'], 'running')
+
+        generation = await sync_to_async(Generation.objects.create)(user=self.user, prompt='A beautiful sunset')
+        await GenerationJob.objects.filter(pk=self.job.pk).aupdate(
+            status=GenerationJob.Status.SUCCEEDED, generation=generation
+        )
+        event = (await self.read_events(response, 1))[0]
+        self.assertEqual(event['result_url'], reverse('generation_result', kwargs={'pk': generation.pk}))
+        self.assertEqual(await self.read_events(response, 1), [])
+
+    async def test_finished_job_sends_one_event(self):
+        """Test that a failed job's stream reports the error and ends"""
+        await GenerationJob.objects.filter(pk=self.job.pk).aupdate(status=GenerationJob.Status.FAILED, error='Boom')
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('generation_job_events', kwargs={'pk': self.job.pk}))
+
+        events = await self.read_events(response, 2)
+        self.assertEqual(events, [{'id': self.job.pk, 'status': 'failed', 'error': 'Boom'}])
+
+    def test_streams_share_one_poll(self):
+        """Test that the hub looks up every watched job in a single query"""
+        from asgiref.sync import async_to_sync
+        from .progress import ProgressHub
+        other = GenerationJob.objects.create(user=self.user, prompt='A quiet lake')
+        job_ids = (self.job.pk, self.job.pk, other.pk)
+        hub = ProgressHub()
+
+        async def subscribe():
+            queues = [hub.subscribe(job_id) for job_id in job_ids]
+            hub._task.cancel()
+            return queues
+
+        queues = async_to_sync(subscribe)()
+        with self.assertNumQueries(1):
+            async_to_sync(hub.poll_once)()
+        self.assertEqual([queue.qsize() for queue in queues], [1, 1, 1])
+        GenerationJob.objects.filter(pk=other.pk).update(status=GenerationJob.Status.RUNNING)
+        async_to_sync(hub.poll_once)()
+        self.assertEqual([queue.qsize() for queue in queues], [1, 1, 2])
+
+        for job_id, queue in zip(job_ids, queues):
+            hub.unsubscribe(job_id, queue)
+        self.assertEqual(hub.streams, 0)
+
+    def test_generate_json_returns_events_url(self):
+        """Test that the generate page gets the job's event stream when queueing with fetch()"""
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('generate'), {'prompt': 'A quiet lake'}, HTTP_ACCEPT='application/json')
+
+        job = GenerationJob.objects.latest('pk')
+        self.assertEqual(response.json()['status'], 'queued')
+        self.assertEqual(response.json()['events_url'], reverse('generation_job_events', kwargs={'pk': job.pk}))
+
+    def test_asgi_handler_routes_event_streams(self):
+        """Test that only event streams skip the per-request thread"""
+        from .progress import ASGIHandler
+        self.assertTrue(ASGIHandler.is_event_stream(reverse('generation_job_events', kwargs={'pk': 1})))
+        self.assertFalse(ASGIHandler.is_event_stream(reverse('generation_job', kwargs={'pk': 1})))
+        self.assertFalse(ASGIHandler.is_event_stream('/missing/'))
+
+    def test_other_users_job_not_found(self):
+        """Test that users cannot follow each other's jobs"""
+        User.objects.create_user(username='otheruser', password='testpass123')
+        self.client.login(username='otheruser', password='testpass123')
+        response = self.client.get(reverse('generation_job_events', kwargs={'pk': self.job.pk}))
+
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(GENERATION_BACKEND='generator.backends.local.LocalBackend',
+                   GENERATION_BACKEND_OPTIONS={'size': (64, 64)}, GENERATION_ENCODE_WORKERS=0)
+class RecompressionTest(TemporaryMediaMixin, CleanCacheTestCase):
+    media_settings = {'GENERATION_VARIANT_WIDTHS': (32,)}
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+
+    def png_file(self, image, **options):
+        from PIL import Image
+        from .streaming import temporary_image_file
+        image_file = temporary_image_file()
+        image.save(image_file, format='PNG', **options)
+        image_file.size = image_file.tell()
+        image_file.seek(0)
+        return image_file
+
+    def test_images_kept_as_returned_by_default(self):
+        """Test that no format setting stores the PNG untouched"""
+        from .services import generate_image_from_prompt
+        image_file = generate_image_from_prompt('A beautiful sunset')
+
+        self.assertEqual(image_file.name, 'generated.png')
+        self.assertEqual((image_file.original_format, image_file.image_format), ('png', 'png'))
+        self.assertEqual(image_file.original_size, image_file.size)
+
+    @override_settings(GENERATION_IMAGE_FORMAT='webp')
+    def test_generation_stored_as_webp(self):
+        """Test that generations are converted and record both sizes"""
+        from PIL import Image
+        self.client.login(username='testuser', password='testpass123')
+        self.client.post(reverse('generate'), {'prompt': 'A beautiful sunset'})
+
+        generation = Generation.objects.get(user=self.user)
+        self.assertTrue(generation.image.name.endswith('.webp'))
+        self.assertEqual((generation.original_format, generation.image_format), ('png', 'webp'))
+        self.assertEqual(generation.image_size, generation.image.size)
+        self.assertLess(generation.image_size, generation.original_size)
+        with generation.image.open() as f:
+            self.assertEqual(Image.open(f).format, 'WEBP')
+
+    @override_settings(GENERATION_IMAGE_FORMAT='png')
+    def test_metadata_stripped(self):
+        """Test that text chunks and EXIF are dropped when re-encoding"""
+        from PIL import Image, PngImagePlugin
+        from .recompression import recompress
+        info = PngImagePlugin.PngInfo()
+        info.add_text('parameters', 'x' * 4096)
+        exif = Image.Exif()
+        exif[0x010E] = 'prompt'
+        image_file = self.png_file(Image.new('RGB', (64, 64), 'red'), pnginfo=info, exif=exif)
+
+        [result] = recompress([image_file])
+
+        self.assertLess(result.size, result.original_size)
+        with Image.open(result) as image:
+            self.assertNotIn('parameters', image.info)
+            self.assertNotIn('exif', image.info)
+
+    @override_settings(GENERATION_IMAGE_FORMAT='png')
+    def test_original_kept_unless_smaller(self):
+        """Test that an encoding no smaller than the original is discarded"""
+        from PIL import Image
+        from .recompression import recompress
+        image_file = self.png_file(Image.new('1', (64, 64)), optimize=True)
+
+        [result] = recompress([image_file])
+
+        self.assertIs(result, image_file)
+        self.assertEqual(result.image_format, 'png')
+
+    @override_settings(GENERATION_IMAGE_FORMAT='webp', GENERATION_ENCODE_WORKERS=1)
+    def test_encodes_in_worker_processes(self):
+        """Test the process pool, sync and async"""
+        from asgiref.sync import async_to_sync
+        from .recompression import arecompress, get_pool, recompress
+        from .services import generate_images_from_prompt
+        self.assertIsNotNone(get_pool())
+        with self.settings(GENERATION_IMAGE_FORMAT=None):
+            images = generate_images_from_prompt('A beautiful sunset', samples=2)
+            more = generate_images_from_prompt('A beautiful sunset', samples=2)
+
+        results = recompress(images) + async_to_sync(arecompress)(more)
+
+        self.assertEqual([result.image_format for result in results], ['webp'] * 4)
+        self.assertTrue(all(result.name == 'generated.webp' for result in results))
+        self.assertTrue(all('seed' in result.artifact for result in results))
+
+
+@unittest.skipUnless(importlib.util.find_spec('boto3'), 'boto3 is not installed')
+class S3StorageTest(TestCase):
+    def setUp(self):
+        from .testing import StubS3Server
+        self.server = StubS3Server().start()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.options = {
+            'bucket_name': 'media',
+            'endpoint_url': self.server.url,
+            'region_name': 'us-east-1',
+            'access_key': 'test',
+            'secret_key': 'test',
+            'addressing_style': 'path',
+            'part_size': 1024,
+            'cache_dir': self.cache_dir.name,
+        }
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+
+    def tearDown(self):
+        self.server.stop()
+        self.cache_dir.cleanup()
+
+    def make_storage(self, **options):
+        from .s3 import S3Storage
+        return S3Storage(**dict(self.options, **options))
+
+    def test_multipart_upload_and_deduplication(self):
+        """Test that large files are uploaded in parts and identical files only once"""
+        storage = self.make_storage()
+        data = b'x' * 2500
+
+        name = storage.save('generated_images/generated.png', ContentFile(data))
+        again = storage.save('generated_images/other.png', ContentFile(data))
+
+        self.assertEqual(again, name)
+        self.assertTrue(name.startswith('generated_images/'))
+        self.assertEqual([request['size'] for request in self.server.operations('upload_part')], [1024, 1024, 452])
+        self.assertEqual(len(self.server.operations('complete_multipart_upload')), 1)
+        self.assertEqual(self.server.objects[name]['body'], data)
+        self.assertEqual(self.server.objects[name]['content_type'], 'image/png')
+        self.assertIn('immutable', self.server.objects[name]['cache_control'])
+
+        storage.save('variants/ab/cd/small.webp', ContentFile(b'small'))
+        self.assertEqual(len(self.server.operations('put_object')), 1)
+
+    def test_urls_point_at_the_bucket(self):
+        """Test presigned and public URLs"""
+        presigned = self.make_storage().url('generated_images/ab/cd/image.png')
+        self.assertTrue(presigned.startswith(f'{self.server.url}/media/generated_images/ab/cd/image.png?'))
+        self.assertIn('X-Amz-Signature=', presigned)
+
+        public = self.make_storage(public_url='https://cdn.example.com/', location='media').url('a b.png')
+        self.assertEqual(public, 'https://cdn.example.com/media/a%20b.png')
+
+    def test_local_cache(self):
+        """Test that recent files are read from the local cache, least recently used evicted first"""
+        storage = self.make_storage(cache_max_bytes=2500)
+        first = storage.save('generated_images/first.png', ContentFile(b'1' * 1000))
+        second = storage.save('generated_images/second.png', ContentFile(b'2' * 1000))
+
+        with storage.open(first) as f:
+            self.assertEqual(f.read(), b'1' * 1000)
+        self.assertEqual(self.server.operations('get_object'), [])
+
+        os.utime(storage.cache.path(second), (0, 0))
+        storage.save('generated_images/third.png', ContentFile(b'3' * 1000))
+        self.assertIsNone(storage.cache.get(second))
+        with storage.open(second) as f:
+            self.assertEqual(f.read(), b'2' * 1000)
+        self.assertEqual(len(self.server.operations('get_object')), 1)
+
+    def test_generation_flow(self):
+        """Test generating an image stored in the bucket and linked directly"""
+        from .models import StoredFile
+        storages = {
+            'default': {'BACKEND': 'generator.s3.S3Storage', 'OPTIONS': self.options},
+            'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+        }
+        self.client.login(username='testuser', password='testpass123')
+        with self.settings(STORAGES=storages, GENERATION_VARIANT_WIDTHS=(32,),
+                           GENERATION_BACKEND='generator.backends.local.LocalBackend',
+                           GENERATION_BACKEND_OPTIONS={'size': (64, 64)}):
+            response = self.client.post(reverse('generate'), {'prompt': 'A beautiful sunset'}, follow=True)
+            generation = Generation.objects.get()
+
+            self.assertIn(generation.image.name, self.server.objects)
+            self.assertContains(response, f'{self.server.url}/media/{generation.image.name}?')
+            self.assertEqual(StoredFile.objects.get(name=generation.image.name).references, 1)
+            # Variants were built from the cached copy, not downloaded
+            self.assertTrue(generation.variants)
+            self.assertEqual(self.server.operations('get_object'), [])
+
+
+class ProtectedMediaTest(TemporaryMediaMixin, TestCase):
+    media_settings = {'GENERATION_VARIANT_WIDTHS': (32,)}
+
+    def setUp(self):
+        super().setUp()
+        from django.core.files.storage import default_storage
+        from .testing import make_png
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        User.objects.create_user(username='otheruser', password='testpass123')
+        self.image_bytes = make_png(size=(64, 64))
+        name = default_storage.save('generated_images/generated.png', ContentFile(self.image_bytes))
+        self.generation = Generation.objects.create(user=self.user, prompt='A beautiful sunset', image=name)
+        self.client.login(username='testuser', password='testpass123')
+
+    @override_settings(MEDIA_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    def test_hands_file_to_nginx(self):
+        """Test that the owner gets an X-Accel-Redirect response carrying no image bytes"""
+        name = self.generation.image.name
+        with patch('django.core.files.storage.FileSystemStorage.open') as storage_open:
+            response = self.client.get(self.generation.image.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{name}')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(response.content, b'')
+        self.assertFalse(response.streaming)
+        storage_open.assert_not_called()
+
+    @override_settings(MEDIA_ACCEL_REDIRECT_PREFIX=None)
+    def test_streams_file_without_nginx(self):
+        """Test that Django sends the file itself when no redirect prefix is configured"""
+        response = self.client.get(self.generation.image.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(b''.join(response.streaming_content), self.image_bytes)
+        response.close()
+
+    @override_settings(MEDIA_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    def test_variants_follow_their_original(self):
+        """Test that variants are served to the owner of the image they were resized from"""
+        from .variants import generate_variants
+        self.assertTrue(generate_variants(self.generation))
+        variant = next(iter(self.generation.variants['webp'].values()))
+
+        response = self.client.get(f'/media/{variant}')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{variant}')
+
+        self.client.login(username='otheruser', password='testpass123')
+        self.assertEqual(self.client.get(f'/media/{variant}').status_code, 404)
+
+    def test_variant_owner_check_matches_exact_names(self):
+        """Test that a variant's original is looked up by its exact name, not a substring"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .media import is_owner
+        from .variants import variant_name
+        other = User.objects.get(username='otheruser')
+        stem = os.path.splitext(os.path.basename(self.generation.image.name))[0]
+        # A name that merely contains the stem does not own its variants
+        Generation.objects.create(user=other, prompt='Unrelated', image=f'generated_images/old/{stem}.png')
+        variant = variant_name(self.generation.image.name, 32, 'webp')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(is_owner(self.user, variant))
+        self.assertFalse(is_owner(other, variant))
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('LIKE', queries[0]['sql'])
+
+    def test_rejects_other_users(self):
+        """Test that other users, anonymous users and paths outside the media root get nothing"""
+        url = self.generation.image.url
+        self.assertEqual(self.client.get('/media/generated_images/../../settings.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/generated_images/missing.png').status_code, 404)
+
+        self.client.login(username='otheruser', password='testpass123')
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.client.logout()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(reverse('login'), response.url)
+
+
+class ConditionalPagesTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.generation = Generation.objects.create(
+            user=self.user, prompt='A beautiful sunset', image='generated_images/sunset.png'
+        )
+        self.client.login(username='testuser', password='testpass123')
+
+    def test_result_not_modified(self):
+        """Test that a matching If-None-Match gets a 304 without rendering the template"""
+        url = reverse('generation_result', kwargs={'pk': self.generation.pk})
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+
+        with patch('generator.views.render') as render:
+            response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        render.assert_not_called()
+
+        # Variants change the page
+        Generation.objects.filter(pk=self.generation.pk).update(variants={'webp': {'320': 'variants/a_320.webp'}})
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_gallery_changes_with_rows(self):
+        """Test that the gallery ETag changes when a generation is added or deleted"""
+        url = reverse('user_gallery')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+        added = Generation.objects.create(user=self.user, prompt='Another', image='generated_images/other.png')
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Another')
+
+        etag = response['ETag']
+        added.delete()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'Another')
+
+    def test_etag_is_per_user(self):
+        """Test that another user's gallery never matches"""
+        url = reverse('user_gallery')
+        etag = self.client.get(url)['ETag']
+        User.objects.create_user(username='otheruser', password='testpass123')
+        self.client.login(username='otheruser', password='testpass123')
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_rendered_while_messages_pending(self):
+        """Test that pending messages are shown rather than answered with a 304"""
+        from django.contrib.messages import constants
+        from django.contrib.messages.storage.cookie import CookieStorage
+        from django.http import HttpRequest, HttpResponse
+        url = reverse('user_gallery')
+        etag = self.client.get(url)['ETag']
+
+        storage = CookieStorage(HttpRequest())
+        storage.add(constants.ERROR, 'Something went wrong')
+        cookie = HttpResponse()
+        storage.update(cookie)
+        self.client.cookies.update(cookie.cookies)
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Something went wrong')
+
+
+@override_settings(GALLERY_PAGE_SIZE=2)
+class GalleryCacheTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        for index in range(3):
+            Generation.objects.create(user=self.user, prompt=f'Image {index}', image='generated_images/test.png')
+        self.client.login(username='testuser', password='testpass123')
+
+    def test_repeat_load_renders_nothing(self):
+        """Test that a cached gallery runs no gallery queries and renders no items"""
+        url = reverse('user_gallery')
+        first = self.client.get(url)
+
+        # Session and user only
+        with self.assertNumQueries(2), patch('generator.gallery_cache.render_to_string') as render_item:
+            second = self.client.get(url)
+        render_item.assert_not_called()
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second.context['stats']['total'], 3)
+
+    def test_signals_invalidate(self):
+        """Test that saving or deleting a generation shows up on the next load"""
+        url = reverse('user_gallery')
+        self.client.get(url)
+
+        added = Generation.objects.create(user=self.user, prompt='Added later', image='generated_images/test.png')
+        self.assertContains(self.client.get(url), 'Added later')
+
+        added.prompt = 'Renamed'
+        added.save()
+        self.assertContains(self.client.get(url), 'Renamed')
+
+        added.delete()
+        self.assertNotContains(self.client.get(url), 'Renamed')
+
+    def test_items_rendered_once(self):
+        """Test that a new generation only renders its own item, including in the next page's fragment"""
+        from django.template.loader import render_to_string
+        self.client.get(reverse('user_gallery'))
+        Generation.objects.create(user=self.user, prompt='Added later', image='generated_images/test.png')
+
+        with patch('generator.gallery_cache.render_to_string', side_effect=render_to_string) as render_item:
+            response = self.client.get(reverse('user_gallery'))
+        self.assertEqual(render_item.call_count, 1)
+
+        fragment = self.client.get(response.context['next_page_url'])
+        self.assertContains(fragment, 'Image 0')
+        with patch('generator.gallery_cache.render_to_string') as render_item:
+            self.assertEqual(self.client.get(response.context['next_page_url']).content, fragment.content)
+        render_item.assert_not_called()
+
+    def test_variants_invalidate(self):
+        """Test that variants recorded with update() replace the cached item"""
+        from . import gallery_cache
+        generation = Generation.objects.filter(user=self.user).latest('created_at')
+        self.assertNotContains(self.client.get(reverse('user_gallery')), 'image/webp')
+
+        Generation.objects.filter(image=generation.image.name).update(
+            variants={'webp': {'320': 'variants/00/00/test_320.webp'}}
+        )
+        gallery_cache.invalidate_image(generation.image.name)
+        self.assertContains(self.client.get(reverse('user_gallery')), 'image/webp')
+
+
+@override_settings(GALLERY_PAGE_SIZE=2)
+class PromptSearchTest(CleanCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        other = User.objects.create_user(username='otheruser', password='testpass123')
+        for prompt in ['A red fox jumping', 'Red sunset over the sea', 'Sunsets and foxes', 'A blue whale',
+                       'Red red red roses']:
+            Generation.objects.create(user=self.user, prompt=prompt, image='generated_images/test.png')
+        Generation.objects.create(user=other, prompt='Red fox in the snow', image='generated_images/test.png')
+        self.client.login(username='testuser', password='testpass123')
+
+    def search_all(self, query):
+        from .search import search
+        found, cursor = [], None
+        while True:
+            generations, cursor = search(self.user, query, cursor, page_size=2)
+            found.extend(generation.prompt for generation in generations)
+            if not cursor:
+                return found
+
+    def test_ranked_and_paginated(self):
+        """Test that matches come best first, each once, across keyset pages"""
+        found = self.search_all('red')
+        self.assertEqual(found[0], 'Red red red roses')
+        self.assertEqual(sorted(found), ['A red fox jumping', 'Red red red roses', 'Red sunset over the sea'])
+
+    @override_settings(SEARCH_MAX_RESULTS=2)
+    def test_ranks_newest_matches_only(self):
+        """Test that only the newest SEARCH_MAX_RESULTS matches are ranked"""
+        self.assertEqual(sorted(self.search_all('red')), ['Red red red roses', 'Red sunset over the sea'])
+
+    def test_stems_and_owner(self):
+        """Test that word forms match, all words of the query, only in the user's own prompts"""
+        self.assertEqual(sorted(self.search_all('fox')), ['A red fox jumping', 'Sunsets and foxes'])
+        self.assertEqual(sorted(self.search_all('red sunsets')), ['Red sunset over the sea'])
+        self.assertEqual(self.search_all('snow'), [])
+        self.assertEqual(self.search_all('" OR user_id : *'), [])
+
+    def test_index_follows_changes(self):
+        """Test that edited and deleted prompts are searched as they are now"""
+        whale = Generation.objects.get(prompt='A blue whale')
+        whale.prompt = 'A grey whale'
+        whale.save()
+        self.assertEqual(self.search_all('blue'), [])
+        self.assertEqual(self.search_all('grey'), ['A grey whale'])
+
+        whale.delete()
+        self.assertEqual(self.search_all('whale'), [])
+
+    def test_search_view(self):
+        """Test the search page, its infinite scroll fragment and JSON"""
+        url = reverse('gallery_search')
+        response = self.client.get(url, {'q': 'red'})
+        self.assertContains(response, 'Images matching')
+        self.assertContains(response, 'Red red red roses')
+        next_url = response.context['next_page_url']
+        self.assertIn('fragment=1', next_url)
+
+        fragment = self.client.get(next_url)
+        self.assertNotContains(fragment, '<html')
+        self.assertEqual(fragment['X-Next-Page'], '')
+
+        data = self.client.get(url, {'q': 'red', 'format': 'json'}).json()
+        self.assertEqual(len(data['items']), 2)
+        self.assertIn('score', data['items'][0])
+
+        self.assertContains(self.client.get(url, {'q': 'nothing'}), 'No Matching Images')
+        self.assertEqual(self.client.get(url, {'q': 'red', 'cursor': 'garbage'}).status_code, 400)
+
+
+@override_settings(EXPORT_BATCH_SIZE=2)
+class GalleryExportTest(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        from django.core.files.storage import default_storage
+        from .testing import make_png
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        other = User.objects.create_user(username='otheruser', password='testpass123')
+        self.images = {}
+        for size, prompt in [(16, 'A red fox'), (24, 'A blue whale'), (32, 'A green forest')]:
+            image_bytes = make_png(size=(size, size))
+            name = default_storage.save('generated_images/generated.png', ContentFile(image_bytes))
+            Generation.objects.create(user=self.user, prompt=prompt, image=name)
+            self.images[prompt] = image_bytes
+        name = default_storage.save('generated_images/generated.png', ContentFile(make_png(size=(40, 40))))
+        Generation.objects.create(user=other, prompt='Not mine', image=name)
+        self.client.login(username='testuser', password='testpass123')
+
+    def download(self, **params):
+        import io
+        import zipfile
+        response = self.client.get(reverse('gallery_export'), params)
+        self.assertTrue(response.streaming)
+        return response, zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def manifest(self, archive):
+        import json
+        parts = sorted(name for name in archive.namelist() if name.startswith('manifest/'))
+        return [json.loads(archive.read(name)) for name in parts]
+
+    def test_streams_images_and_manifest(self):
+        """Test that the archive holds the user's images, stored, with manifest parts per batch"""
+        import zipfile
+        response, archive = self.download()
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertIn('gallery-testuser.zip', response['Content-Disposition'])
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+
+        parts = self.manifest(archive)
+        self.assertEqual(len(parts), 2)
+        self.assertIsNone(parts[-1]['next_cursor'])
+        items = [item for part in parts for item in part['items']]
+        self.assertEqual([item['prompt'] for item in items], ['A green forest', 'A blue whale', 'A red fox'])
+        for item in items:
+            info = archive.getinfo(item['file'])
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.read(info), self.images[item['prompt']])
+        self.assertEqual(len([name for name in archive.namelist() if name.startswith('images/')]), 3)
+        self.assertIsNone(archive.testzip())
+
+    def test_resumes_from_manifest_cursor(self):
+        """Test that the cursor of a manifest part exports only the generations after it"""
+        _, archive = self.download()
+        cursor = self.manifest(archive)[0]['next_cursor']
+
+        response, rest = self.download(cursor=cursor)
+        self.assertIn('gallery-testuser-continued.zip', response['Content-Disposition'])
+        [part] = self.manifest(rest)
+        self.assertEqual([item['prompt'] for item in part['items']], ['A red fox'])
+        self.assertEqual(self.client.get(reverse('gallery_export'), {'cursor': 'garbage'}).status_code, 400)
+
+    def test_missing_image_listed_without_file(self):
+        """Test that an image missing from storage is listed in the manifest but not archived"""
+        from django.core.files.storage import default_storage
+        whale = Generation.objects.get(prompt='A blue whale')
+        default_storage.delete(whale.image.name)
+
+        _, archive = self.download()
+        items = {item['prompt']: item for part in self.manifest(archive) for item in part['items']}
+        self.assertIsNone(items['A blue whale']['file'])
+        self.assertEqual(len([name for name in archive.namelist() if name.startswith('images/')]), 2)
+
+    def test_async_iteration_streams_same_archive(self):
+        """Test that the ASGI path yields the archive chunk by chunk, like the WSGI one"""
+        from asgiref.sync import async_to_sync
+        from .export import aiter_chunks, archive
+
+        async def collect():
+            return [chunk async for chunk in aiter_chunks(archive(self.user))]
+
+        chunks = async_to_sync(collect)()
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(len(b''.join(chunks)), len(b''.join(archive(self.user))))
@@ -0,0 +1,160 @@
+"""
+Derivative images for galleries and result pages.
+
+For every generated image we store WebP (and AVIF, when Pillow supports it)
+copies at a few responsive widths, so pages can ship a ``srcset`` instead of
+the full-size PNG. Variant names are derived from the original's name, which
+makes building them idempotent: rows that share a stored image (result cache
+hits) share its variants, and a re-run only encodes what is missing.
+
+Variants are always built after the generation is reported: by the job
+worker once the job is done, by a background task of the async view, and for
+rows created on a request (batches) by ``generate_variants_later()`` on a
+small thread pool once the rows are committed. Rows whose process exits first
+are left with no variants; ``manage.py generate_variants`` builds them.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import threading
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image, features
+
+from .models import Generation
+from .storage import shard
+from . import gallery_cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIANT_WIDTHS = (320, 640, 1024)
+# Format name -> (file extension, MIME type, Pillow save options)
+VARIANT_FORMATS = {
+    "avif": ("avif", "image/avif", {"quality": 60}),
+    "webp": ("webp", "image/webp", {"quality": 80, "method": 4}),
+}
+
+
+def variant_widths():
+    return tuple(getattr(settings, "GENERATION_VARIANT_WIDTHS", DEFAULT_VARIANT_WIDTHS))
+
+
+def available_formats():
+    """Variant formats this Pillow build can encode, best compression first"""
+    return [name for name in VARIANT_FORMATS if features.check(name)]
+
+
+def variant_name(image_name, width, format_name):
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    extension = VARIANT_FORMATS[format_name][0]
+    # Sharded like the originals so the directory stays small
+    digest = hashlib.sha256(stem.encode("utf-8")).hexdigest()
+    return f"variants/{shard(digest)}/{stem}_{width}.{extension}"
+
+
+def _encode(source, width, format_name):
+    image = source.copy()
+    if image.width > width:
+        height = round(image.height * width / image.width)
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format=format_name.upper(), **VARIANT_FORMATS[format_name][2])
+    return buffer.getvalue()
+
+
+def build_variants(image_name, storage=default_storage):
+    """
+    Make sure every variant of ``image_name`` exists and return their names.
+
+    The original is only opened and decoded when at least one variant is
+    missing from storage.
+    """
+    wanted = {
+        format_name: {str(width): variant_name(image_name, width, format_name) for width in variant_widths()}
+        for format_name in available_formats()
+    }
+    missing = [
+        (format_name, int(width), name)
+        for format_name, names in wanted.items()
+        for width, name in names.items()
+        if not storage.exists(name)
+    ]
+    if missing:
+        with storage.open(image_name, "rb") as original:
+            source = Image.open(original)
+            source.load()
+        if source.mode not in ("RGB", "RGBA"):
+            source = source.convert("RGBA" if "transparency" in source.info else "RGB")
+        for format_name, width, name in missing:
+            saved = storage.save(name, ContentFile(_encode(source, width, format_name)))
+            wanted[format_name][str(width)] = saved
+    return wanted
+
+
+def generate_variants(generation):
+    """Build the variants of ``generation`` and record them on every row sharing its image"""
+    try:
+        variants = build_variants(generation.image.name)
+    except Exception as e:
+        logger.error(f"Could not build variants for generation {generation.pk}: {str(e)}")
+        return False
+
+    rows = Generation.objects.filter(image=generation.image.name).update(variants=variants)
+    gallery_cache.invalidate_image(generation.image.name, rows, generation.user_id)
+    generation.variants = variants
+    return True
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, "GENERATION_VARIANT_THREADS", 2), thread_name_prefix="variants"
+            )
+        return _pool
+
+
+def _generate_in_thread(generation):
+    # Each pool thread opens its own database connection
+    try:
+        return generate_variants(generation)
+    finally:
+        connection.close()
+
+
+def generate_variants_later(generations):
+    """Build the variants of ``generations`` off the calling thread, once per image, after the commit"""
+    by_image = {generation.image.name: generation for generation in generations}
+
+    def submit():
+        for generation in by_image.values():
+            _executor().submit(_generate_in_thread, generation)
+
+    if by_image:
+        transaction.on_commit(submit)
+
+
+async def agenerate_variants(generation):
+    """Async counterpart of ``generate_variants``; encoding runs on a worker thread"""
+    try:
+        variants = await sync_to_async(build_variants, thread_sensitive=False)(generation.image.name)
+    except Exception as e:
+        logger.error(f"Could not build variants for generation {generation.pk}: {str(e)}")
+        return False
+
+    rows = await Generation.objects.filter(image=generation.image.name).aupdate(variants=variants)
+    await sync_to_async(gallery_cache.invalidate_image)(generation.image.name, rows, generation.user_id)
+    generation.variants = variants
+    return True
+
@@ -3,176 +3,389 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib import messages
-from django.core.exceptions import ValidationError
-from django.http import Http404
-from .models import Generation
-from django.core.files.base import ContentFile
-from io import BytesIO
-import requests
-import base64
-import os
+from django.conf import settings
+from django.db.models import Count, Min
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse,
+)
+from django.urls import reverse
+from django.utils.http import content_disposition_header
+from urllib.parse import urlencode
+from .models import Generation, GenerationJob
+from .pagination import InvalidCursor, decode_cursor, keyset_page
+from .services import ImageGenerationError
+from . import (
+    batch, conditional, export, gallery_cache, jobs, media, metrics, progress, scheduling, search, services,
+    variants,
+)
+from asgiref.sync import sync_to_async
+import asyncio
+import hmac
+import json
 import logging
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-STABILITY_API_KEY = os.environ.get("STABILITY_API_KEY")
-# Only raise error in production or if explicitly required
-if not STABILITY_API_KEY and os.environ.get("REQUIRE_STABILITY_API", "false").lower() == "true":
-    raise RuntimeError("STABILITY_API_KEY environment variable not set.")
-
-
-class ImageGenerationError(Exception):
-    """Custom exception for image generation errors"""
-    pass
-
-
-def validate_prompt(prompt):
-    """Validate the prompt before sending to API"""
-    if not prompt or not prompt.strip():
-        raise ValidationError("Prompt cannot be empty")
-    
-    if len(prompt.strip()) < 3:
-        raise ValidationError("Prompt must be at least 3 characters long")
-    
-    if len(prompt) > 1000:
-        raise ValidationError("Prompt is too long (maximum 1000 characters)")
-    
-    # Check for potentially harmful content
-    harmful_words = ['hack', 'exploit', 'virus', 'malware', 'spam']
-    prompt_lower = prompt.lower()
-    for word in harmful_words:
-        if word in prompt_lower:
-            raise ValidationError("Prompt contains inappropriate content")
-    
-    return prompt.strip()
-
-
-# Calls Stability AI API to generate an image from a prompt
-def generate_image_from_prompt(prompt):
-    """Generate image from prompt with comprehensive error handling"""
-    try:
-        # Validate prompt
-        validated_prompt = validate_prompt(prompt)
-        
-        # Check if API key is available
-        if not STABILITY_API_KEY:
-            raise ImageGenerationError("Stability AI API key not configured. Please set STABILITY_API_KEY environment variable.")
-        
-        url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
-        headers = {
-            "Authorization": f"Bearer {STABILITY_API_KEY}",
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "text_prompts": [{"text": validated_prompt}],
-            "cfg_scale": 7,
-            "height": 1024,
-            "width": 1024,
-            "samples": 1,
-            "steps": 30,
-        }
-        
-        # Make API request with timeout
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        
-        # Handle different HTTP status codes
-        if response.status_code == 401:
-            raise ImageGenerationError("Invalid API key. Please check your configuration.")
-        elif response.status_code == 403:
-            raise ImageGenerationError("API access denied. Please check your account status.")
-        elif response.status_code == 429:
-            raise ImageGenerationError("Rate limit exceeded. Please try again later.")
-        elif response.status_code == 500:
-            raise ImageGenerationError("Stability AI service is currently unavailable. Please try again later.")
-        elif response.status_code != 200:
-            raise ImageGenerationError(f"API error: {response.status_code} - {response.text}")
-        
-        response.raise_for_status()
-        data = response.json()
-        
-        # Validate response structure
-        if "artifacts" not in data or not data["artifacts"]:
-            raise ImageGenerationError("Invalid response from API")
-        
-        # The API returns base64-encoded images
-        image_b64 = data["artifacts"][0]["base64"]
-        if not image_b64:
-            raise ImageGenerationError("No image data received from API")
-        
-        image_data = base64.b64decode(image_b64)
-        return image_data
-        
-    except requests.exceptions.Timeout:
-        logger.error(f"Timeout while generating image for prompt: {prompt[:50]}...")
-        raise ImageGenerationError("Request timed out. Please try again.")
-    except requests.exceptions.ConnectionError:
-        logger.error(f"Connection error while generating image for prompt: {prompt[:50]}...")
-        raise ImageGenerationError("Network connection error. Please check your internet connection.")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Request error while generating image: {str(e)}")
-        raise ImageGenerationError(f"Network error: {str(e)}")
-    except ValidationError as e:
-        logger.warning(f"Validation error for prompt: {prompt[:50]}... - {str(e)}")
-        raise ImageGenerationError(str(e))
-    except Exception as e:
-        logger.error(f"Unexpected error while generating image: {str(e)}")
-        raise ImageGenerationError("An unexpected error occurred. Please try again.")
-
 
 @login_required
 def generate(request):
-    """Handle image generation with error handling"""
+    """Queue an image generation and redirect to its status page"""
     if request.method == "POST":
+        prompt = request.POST.get("prompt", "").strip()
+        # The generate page submits with fetch() and follows the job's events
+        wants_json = "application/json" in request.headers.get("Accept", "")
         try:
-            prompt = request.POST.get("prompt", "").strip()
-            
-            # Generate image
-            image_data = generate_image_from_prompt(prompt)
-            
-            # Create file and save to database
-            image_file = ContentFile(image_data, name="generated.png")
-            generation = Generation.objects.create(
-                prompt=prompt, 
-                image=image_file, 
-                user=request.user
-            )
-            
-            messages.success(request, "Image generated successfully!")
-            return redirect("generation_result", pk=generation.pk)
-            
+            params = {}
+            seed = request.POST.get("seed", "").strip()
+            if seed:
+                if not seed.isdigit():
+                    raise ImageGenerationError("Seed must be a positive whole number")
+                params["seed"] = int(seed)
+
+            if jobs.jobs_run_eagerly():
+                # No worker process (development, tests): run the job inline,
+                # in one of the user's slots like a worker would
+                with scheduling.generation_slots(request.user):
+                    job = jobs.enqueue_generation(request.user, prompt, params)
+                    jobs.run_job(job)
+                if job.status == GenerationJob.Status.FAILED:
+                    raise ImageGenerationError(job.error)
+            else:
+                job = jobs.enqueue_generation(request.user, prompt, params)
+
+            if wants_json:
+                return JsonResponse({
+                    **progress.job_event(job),
+                    "status_url": reverse("generation_job", kwargs={"pk": job.pk}),
+                    "events_url": reverse("generation_job_events", kwargs={"pk": job.pk}),
+                })
+            if job.status == GenerationJob.Status.SUCCEEDED:
+                messages.success(request, "Image generated successfully!")
+                return redirect("generation_result", pk=job.generation_id)
+            messages.info(request, "Your image is being generated.")
+            return redirect("generation_job", pk=job.pk)
+
         except ImageGenerationError as e:
+            if wants_json:
+                return JsonResponse({"error": str(e)}, status=400)
             messages.error(request, f"Generation failed: {str(e)}")
-            return render(request, "generator/generate.html", {"error": str(e), "prompt": prompt})
+            return render(request, "generator/generate.html", {"error": str(e), "prompt": prompt, "seed": request.POST.get("seed", "")})
         except Exception as e:
             logger.error(f"Unexpected error in generate view: {str(e)}")
+            if wants_json:
+                return JsonResponse({"error": "An unexpected error occurred"}, status=500)
             messages.error(request, "An unexpected error occurred. Please try again.")
             return render(request, "generator/generate.html", {"error": "An unexpected error occurred"})
     
     return render(request, "generator/generate.html")
 
 
+# Strong references to fire-and-forget tasks so they are not garbage collected
+_background_tasks = set()
+
+
+def _run_in_background(coroutine):
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+@login_required
+async def generate_async(request):
+    """
+    Generate an image inline without holding a thread.
+
+    Under an ASGI server the upstream call waits on the event loop, so this
+    view needs no job queue to keep the process responsive.
+    """
+    if request.method != "POST":
+        return redirect("generate")
+
+    prompt = request.POST.get("prompt", "").strip()
+    wants_json = "application/json" in request.headers.get("Accept", "")
+    user = await request.auser()
+    try:
+        await sync_to_async(scheduling.check_quota)(user)
+        async with scheduling.ageneration_slots(user):
+            generation = await services.acreate_generation(user, prompt)
+    except ImageGenerationError as e:
+        if wants_json:
+            return JsonResponse({"error": str(e)}, status=400)
+        messages.error(request, f"Generation failed: {str(e)}")
+        return await sync_to_async(render)(request, "generator/generate.html", {"error": str(e), "prompt": prompt})
+
+    if jobs.jobs_run_eagerly():
+        await variants.agenerate_variants(generation)
+    else:
+        _run_in_background(variants.agenerate_variants(generation))
+
+    result_url = reverse("generation_result", kwargs={"pk": generation.pk})
+    if wants_json:
+        return JsonResponse({"id": generation.pk, "result_url": result_url})
+    messages.success(request, "Image generated successfully!")
+    return redirect(result_url)
+
+
+@login_required
+def batch_generate(request):
+    """Queue many images at once from a form or a JSON body"""
+    if request.method != "POST":
+        return render(request, "generator/batch.html", {"max_items": batch.batch_limit()})
+
+    wants_json = request.content_type == "application/json"
+    try:
+        if wants_json:
+            try:
+                data = json.loads(request.body or b"{}")
+            except ValueError:
+                raise ImageGenerationError("Request body is not valid JSON")
+            if not isinstance(data, dict):
+                raise ImageGenerationError("Request body must be a JSON object")
+        else:
+            data = {
+                "prompts": request.POST.get("prompts", ""),
+                "prompt": request.POST.get("prompt", ""),
+                "count": request.POST.get("count", ""),
+            }
+        items = batch.parse_batch_request(data)
+        scheduling.check_quota(request.user, len(items))
+        if jobs.jobs_run_eagerly():
+            # No worker process (development, tests): run the batch inline,
+            # in one of the user's slots like a worker would
+            with scheduling.generation_slots(request.user):
+                results, queued = batch.enqueue_batch(request.user, items)
+                if queued:
+                    jobs.run_job(queued[0])
+            batch.update_results(results)
+        else:
+            results, queued = batch.enqueue_batch(request.user, items)
+    except ImageGenerationError as e:
+        if wants_json:
+            return JsonResponse({"error": str(e)}, status=400)
+        messages.error(request, f"Batch failed: {str(e)}")
+        return render(request, "generator/batch.html", {"error": str(e), "max_items": batch.batch_limit()})
+
+    # Queued and running items both count as queued
+    counts = {"succeeded": 0, "failed": 0, "queued": 0}
+    for result in results:
+        if "job_id" in result:
+            result["status_url"] = reverse("generation_job", kwargs={"pk": result["job_id"]})
+        counts[result["status"] if result["status"] in counts else "queued"] += 1
+
+    if wants_json:
+        return JsonResponse({**counts, "results": results})
+
+    if counts["queued"]:
+        messages.info(request, f"{counts['queued']} of {len(results)} images are being generated.")
+    if counts["succeeded"]:
+        messages.success(request, f"{counts['succeeded']} of {len(results)} images generated successfully!")
+    if counts["failed"]:
+        messages.error(request, f"{counts['failed']} of {len(results)} images failed.")
+    return render(request, "generator/batch.html", {"results": results, "max_items": batch.batch_limit()})
+
+
+@login_required
+def generation_job(request, pk):
+    """Display the status of a queued generation, forwarding to the result once done"""
+    try:
+        job = GenerationJob.objects.get(pk=pk, user=request.user)
+    except GenerationJob.DoesNotExist:
+        raise Http404("Generation not found or you don't have permission to view it.")
+
+    if job.status == GenerationJob.Status.SUCCEEDED and job.generation_id:
+        return redirect("generation_result", pk=job.generation_id)
+
+    return render(request, "generator/job_status.html", {"job": job})
+
+
+@login_required
+async def generation_job_events(request, pk):
+    """Stream the progress of a queued generation as server-sent events"""
+    user = await request.auser()
+    try:
+        job = await GenerationJob.objects.aget(pk=pk, user=user)
+    except GenerationJob.DoesNotExist:
+        raise Http404("Generation not found or you don't have permission to view it.")
+
+    response = StreamingHttpResponse(progress.job_events(job), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Tell nginx to pass events on as they are written
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
 @login_required
 def generation_result(request, pk):
     """Display generation result with error handling"""
     try:
         generation = Generation.objects.get(pk=pk, user=request.user)
-        return render(request, "generator/result.html", {"generation": generation})
     except Generation.DoesNotExist:
         raise Http404("Generation not found or you don't have permission to view it.")
 
+    etag = conditional.page_etag(request, generation.pk, generation.created_at, generation.image.name,
+                                 generation.variants)
+    response = conditional.not_modified(request, etag, "result")
+    if response is not None:
+        return response
+    return conditional.cacheable(render(request, "generator/result.html", {"generation": generation}), etag)
+
+
+@login_required
+def protected_media(request, name):
+    """Send a generated image or variant to the user who owns it"""
+    name = media.clean_name(name)
+    if name is None or not media.is_owner(request.user, name):
+        raise Http404("Image not found or you don't have permission to view it.")
+    return media.serve(name)
+
+
+def _gallery_page(request):
+    """The current user's generations after ``?cursor=``, plus the cursor of the next page"""
+    page_size = getattr(settings, "GALLERY_PAGE_SIZE", 24)
+    generations = Generation.objects.filter(user=request.user)
+    return keyset_page(generations, request.GET.get("cursor"), page_size)
+
+
+def _next_page_url(next_cursor):
+    if not next_cursor:
+        return ""
+    return f"{reverse('user_gallery_page')}?{urlencode({'cursor': next_cursor})}"
+
+
+def _gallery_item_json(generation):
+    return {
+        "id": generation.pk,
+        "prompt": generation.prompt,
+        "image_url": generation.image.url,
+        "variants": generation.variants,
+        "result_url": reverse("generation_result", kwargs={"pk": generation.pk}),
+        "created_at": generation.created_at.isoformat(),
+    }
+
 
 @login_required
 def user_gallery(request):
-    """Display user's gallery with error handling"""
+    """Display the first page of the user's gallery with error handling"""
     try:
-        generations = Generation.objects.filter(user=request.user).order_by('-created_at')
-        return render(request, "generator/gallery.html", {"generations": generations})
+        cursor = request.GET.get("cursor")
+        # The version changes with every change to the user's generations,
+        # so it also tags the page
+        version, page = gallery_cache.get_page(request.user.pk, "gallery", cursor)
+        etag = conditional.page_etag(request, version)
+        response = conditional.not_modified(request, etag, "gallery")
+        if response is not None:
+            return response
+
+        if page is None:
+            # Count and date of the first image in a single aggregate query
+            stats = Generation.objects.filter(user=request.user).aggregate(
+                total=Count("pk"),
+                first_created=Min("created_at"),
+            )
+            generations, next_cursor = _gallery_page(request)
+            page = {"html": gallery_cache.render_items(generations), "next_cursor": next_cursor, "stats": stats}
+            gallery_cache.set_page(request.user.pk, "gallery", cursor, version, page)
+
+        return conditional.cacheable(render(request, "generator/gallery.html", {
+            "gallery_items": page["html"],
+            "stats": page["stats"],
+            "next_page_url": _next_page_url(page["next_cursor"]),
+        }), etag)
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid cursor")
     except Exception as e:
         logger.error(f"Error loading gallery for user {request.user.username}: {str(e)}")
         messages.error(request, "Error loading your gallery. Please try again.")
-        return render(request, "generator/gallery.html", {"generations": []})
+        return render(request, "generator/gallery.html", {"gallery_items": ""})
+
+
+@login_required
+def user_gallery_page(request):
+    """Next page of the gallery for infinite scroll, as an HTML fragment or JSON"""
+    as_json = request.GET.get("format") == "json" or "application/json" in request.headers.get("Accept", "")
+    cursor = request.GET.get("cursor")
+    page = None
+    if not as_json:
+        version, page = gallery_cache.get_page(request.user.pk, "fragment", cursor)
+
+    if page is None:
+        try:
+            generations, next_cursor = _gallery_page(request)
+        except InvalidCursor:
+            return HttpResponseBadRequest("Invalid cursor")
+
+        if as_json:
+            return JsonResponse({
+                "items": [_gallery_item_json(generation) for generation in generations],
+                "next_cursor": next_cursor,
+                "next_page_url": _next_page_url(next_cursor),
+            })
+
+        page = {"html": gallery_cache.render_items(generations), "next_cursor": next_cursor}
+        gallery_cache.set_page(request.user.pk, "fragment", cursor, version, page)
+
+    response = HttpResponse(page["html"])
+    response["X-Next-Page"] = _next_page_url(page["next_cursor"])
+    return response
+
+
+@login_required
+def gallery_search(request):
+    """Search the user's prompts: a gallery page, an infinite scroll fragment or JSON"""
+    query = request.GET.get("q", "").strip()
+    page_size = getattr(settings, "GALLERY_PAGE_SIZE", 24)
+    try:
+        generations, next_cursor = search.search(request.user, query, request.GET.get("cursor"), page_size)
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid cursor")
+
+    next_page_url = ""
+    if next_cursor:
+        next_page_url = f"{reverse('gallery_search')}?{urlencode({'q': query, 'cursor': next_cursor, 'fragment': 1})}"
+    if request.GET.get("format") == "json" or "application/json" in request.headers.get("Accept", ""):
+        return JsonResponse({
+            "items": [
+                {**_gallery_item_json(generation), "score": generation.score} for generation in generations
+            ],
+            "next_cursor": next_cursor,
+            "next_page_url": next_page_url,
+        })
+
+    gallery_items = gallery_cache.render_items(generations)
+    if request.GET.get("fragment"):
+        response = HttpResponse(gallery_items)
+        response["X-Next-Page"] = next_page_url
+        return response
+    return render(request, "generator/gallery.html", {
+        "gallery_items": gallery_items,
+        "query": query,
+        "next_page_url": next_page_url,
+    })
+
+
+@login_required
+def gallery_export(request):
+    """Download the user's images, with a manifest of their prompts, as a ZIP archive streamed as it is built"""
+    cursor = request.GET.get("cursor")
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except InvalidCursor:
+            return HttpResponseBadRequest("Invalid cursor")
+
+    chunks = export.archive(request.user, cursor)
+    if isinstance(request, ASGIRequest):
+        # Django would read a synchronous iterator to the end before sending it
+        chunks = export.aiter_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type="application/zip")
+    filename = f"gallery-{request.user.username}{'-continued' if cursor else ''}.zip"
+    response["Content-Disposition"] = content_disposition_header(True, filename)
+    response["Cache-Control"] = "private, no-store"
+    # Tell nginx to pass the archive on as it is written
+    response["X-Accel-Buffering"] = "no"
+    return response
 
 
 def register(request):
@@ -230,3 +443,11 @@ def logout_view(request):
     logout(request)
     messages.success(request, "You have been successfully logged out.")
     return redirect("login")
+
+
+def metrics_view(request):
+    """Expose the metrics of every worker process in the Prometheus text format"""
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden("Invalid metrics token")
+    return HttpResponse(metrics.render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
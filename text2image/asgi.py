@@ -9,8 +9,12 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'text2image.settings')
+django.setup(set_prefix=False)
 
-application = get_asgi_application()
+# Django's handler, except that generation progress streams share one thread
+from generator.progress import ASGIHandler  # noqa: E402
+
+application = ASGIHandler()
@@ -119,6 +119,17 @@ STATIC_URL = "static/"
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
+# Media is only served to the owning user. With a prefix set, Django answers
+# with X-Accel-Redirect to this nginx internal location instead of sending
+# the file itself; None streams files from Django (development)
+MEDIA_ACCEL_REDIRECT_PREFIX = None
+
+# Generated images are stored by content hash in sharded directories and
+# deduplicated; see generator/storage.py
+STORAGES = {
+    "default": {"BACKEND": "generator.storage.ContentAddressedStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -128,3 +139,113 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Authentication settings
 LOGIN_REDIRECT_URL = "/"
 LOGOUT_REDIRECT_URL = "/"
+
+# Generation job queue
+# Run jobs inline in the request during development so no worker process is needed
+GENERATION_JOBS_EAGER = True
+GENERATION_WORKER_CONCURRENCY = 4
+# Fair share per user: jobs running at once, and images per day and month (None = unlimited)
+GENERATION_USER_MAX_CONCURRENT = 2
+GENERATION_USER_DAILY_QUOTA = None
+GENERATION_USER_MONTHLY_QUOTA = None
+# Seconds after which slots left taken by a process that died are freed
+GENERATION_USER_SLOT_TIMEOUT = 600
+
+# Image generation engine; generator.backends.local.LocalBackend works offline
+GENERATION_BACKEND = "generator.backends.stability.StabilityBackend"
+GENERATION_BACKEND_OPTIONS = {}
+
+# Stability AI HTTP client
+STABILITY_API_HOST = "https://api.stability.ai"
+STABILITY_POOL_SIZE = 10
+STABILITY_CONNECT_TIMEOUT = 5
+STABILITY_READ_TIMEOUT = 60
+# Connection cap of the httpx pool shared by async views
+STABILITY_ASYNC_MAX_CONNECTIONS = 200
+
+# Outbound pacing: at most STABILITY_RATE_LIMIT calls per STABILITY_RATE_PERIOD
+# seconds, shared through the default cache. 429s, 5xx and timeouts are retried
+# with jittered exponential backoff.
+STABILITY_RATE_LIMIT = 150
+STABILITY_RATE_PERIOD = 10
+STABILITY_RATE_LIMIT_MAX_WAIT = 30
+STABILITY_MAX_RETRIES = 3
+STABILITY_RETRY_BASE_DELAY = 1
+STABILITY_RETRY_MAX_DELAY = 30
+
+# Circuit breaker: after CIRCUIT_BREAKER_FAILURE_THRESHOLD outage-like
+# failures (timeouts, connection errors, 5xx) within CIRCUIT_BREAKER_WINDOW
+# seconds, API calls fail at once for CIRCUIT_BREAKER_OPEN_SECONDS, then one
+# trial call decides whether to close. State is shared through the cache.
+CIRCUIT_BREAKER_ENABLED = True
+CIRCUIT_BREAKER_CACHE = "default"
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_WINDOW = 60
+CIRCUIT_BREAKER_OPEN_SECONDS = 30
+
+# Result cache for identical prompts and parameters
+GENERATION_CACHE_ENABLED = True
+GENERATION_CACHE_UNSEEDED = False
+GENERATION_CACHE_MAX_ENTRIES = 10000
+GENERATION_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Identical requests in flight at the same time share one API call, through
+# the default cache; a follower gives up waiting after GENERATION_COALESCE_MAX_WAIT
+GENERATION_COALESCE = True
+GENERATION_COALESCE_CACHE = "default"
+GENERATION_COALESCE_MAX_WAIT = 120
+GENERATION_COALESCE_POLL_INTERVAL = 0.2
+
+# Responsive widths of the WebP/AVIF variants built for every generated image
+GENERATION_VARIANT_WIDTHS = (320, 640, 1024)
+# Threads per process building the variants of batch rows after the response
+GENERATION_VARIANT_THREADS = 2
+
+# Re-encode generated images before storing them: None keeps the API's PNG,
+# or "png" (optimised), "webp", "avif". Quality None uses the format default.
+GENERATION_IMAGE_FORMAT = None
+GENERATION_IMAGE_QUALITY = None
+GENERATION_IMAGE_STRIP_METADATA = True
+# Encoder processes per server process; 0 encodes on the request thread
+GENERATION_ENCODE_WORKERS = 2
+
+# Progress events of queued generations (server-sent events, needs ASGI):
+# job lookups per process every PROGRESS_POLL_INTERVAL seconds, a keep-alive
+# comment every PROGRESS_HEARTBEAT seconds, streams closed (and reopened by
+# the browser) after PROGRESS_STREAM_TIMEOUT seconds
+PROGRESS_POLL_INTERVAL = 1.0
+PROGRESS_HEARTBEAT = 15
+PROGRESS_STREAM_TIMEOUT = 300
+
+# Generations per gallery page (keyset pagination)
+GALLERY_PAGE_SIZE = 24
+# Rendered gallery pages and items, cached per user and invalidated when
+# their generations change; see generator/gallery_cache.py
+GALLERY_CACHE = "default"
+GALLERY_CACHE_TIMEOUT = 24 * 3600
+# Newest matches ranked by a prompt search; see generator/search.py
+SEARCH_MAX_RESULTS = 1000
+# Generations read per query, and listed per manifest part, by the ZIP export
+EXPORT_BATCH_SIZE = 100
+
+# Result and gallery pages are revalidated with ETags (304 when unchanged);
+# change PAGE_ETAG_VERSION when a release changes those pages
+PAGE_ETAG_VERSION = ""
+
+# Batch generation
+BATCH_MAX_ITEMS = 50
+BATCH_CONCURRENCY = 4
+
+# Prompt moderation: extra blocked and allowed terms, one per line, on top of
+# the built-in list and the terms managed in the admin. Changes are picked up
+# within MODERATION_RELOAD_INTERVAL seconds.
+MODERATION_BLOCKLIST_FILE = None
+MODERATION_ALLOWLIST_FILE = None
+MODERATION_RELOAD_INTERVAL = 5
+
+# Metrics: with METRICS_DIR set, every process writes its values there and
+# /metrics reports the sum over all of them. METRICS_TOKEN, when set, must be
+# sent as "Authorization: Bearer <token>".
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 1.0
+METRICS_TOKEN = ""
@@ -85,6 +85,24 @@ DATABASES = {
     }
 }
 
+# Shared cache: holds state every worker process must agree on, such as the
+# outbound rate limiter. Redis gives atomic counters; without REDIS_URL the
+# database cache table (`manage.py createcachetable`) is used.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "django_cache",
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -125,6 +143,38 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
+# Media is only served to the owning user: Django checks ownership, then nginx
+# sends the file from this internal location (see nginx.conf). In DEBUG, or
+# with MEDIA_ACCEL_REDIRECT_PREFIX empty, Django streams the file itself.
+MEDIA_ACCEL_REDIRECT_PREFIX = None if DEBUG else (os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/') or None)
+
+# Generated images are stored by content hash in sharded directories and
+# deduplicated; see generator/storage.py
+STORAGES = {
+    "default": {"BACKEND": "generator.storage.ContentAddressedStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+
+# With S3_BUCKET set, media lives in an S3-compatible bucket instead of the
+# shared volume, and pages link to it directly (presigned unless S3_PUBLIC_URL
+# is set). Requires boto3.
+if os.environ.get('S3_BUCKET'):
+    STORAGES["default"] = {
+        "BACKEND": "generator.s3.S3Storage",
+        "OPTIONS": {
+            "bucket_name": os.environ['S3_BUCKET'],
+            "endpoint_url": os.environ.get('S3_ENDPOINT_URL') or None,
+            "region_name": os.environ.get('S3_REGION') or None,
+            "access_key": os.environ.get('S3_ACCESS_KEY_ID') or None,
+            "secret_key": os.environ.get('S3_SECRET_ACCESS_KEY') or None,
+            "location": os.environ.get('S3_LOCATION', ''),
+            "public_url": os.environ.get('S3_PUBLIC_URL') or None,
+            "url_expire": int(os.environ.get('S3_URL_EXPIRE', '3600')),
+            "addressing_style": os.environ.get('S3_ADDRESSING_STYLE', 'auto'),
+            "cache_dir": os.environ.get('S3_CACHE_DIR') or None,
+            "cache_max_bytes": int(os.environ.get('S3_CACHE_MAX_BYTES', str(256 * 1024 * 1024))),
+        },
+    }
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -142,4 +192,107 @@ X_FRAME_OPTIONS = 'DENY'
 
 # Stability AI API settings
 STABILITY_API_KEY = os.environ.get('STABILITY_API_KEY', '')
-REQUIRE_STABILITY_API = os.environ.get('REQUIRE_STABILITY_API', 'false').lower() == 'true' 
\ No newline at end of file
+REQUIRE_STABILITY_API = os.environ.get('REQUIRE_STABILITY_API', 'false').lower() == 'true'
+
+# Generation job queue, drained by `python manage.py generation_worker`
+GENERATION_JOBS_EAGER = os.environ.get('GENERATION_JOBS_EAGER', 'false').lower() == 'true'
+GENERATION_WORKER_CONCURRENCY = int(os.environ.get('GENERATION_WORKER_CONCURRENCY', '4'))
+# Fair share per user: jobs running at once, and images per day and month (0 = unlimited)
+GENERATION_USER_MAX_CONCURRENT = int(os.environ.get('GENERATION_USER_MAX_CONCURRENT', '2'))
+GENERATION_USER_DAILY_QUOTA = int(os.environ.get('GENERATION_USER_DAILY_QUOTA', '100'))
+GENERATION_USER_MONTHLY_QUOTA = int(os.environ.get('GENERATION_USER_MONTHLY_QUOTA', '1000'))
+# Seconds after which slots left taken by a process that died are freed
+GENERATION_USER_SLOT_TIMEOUT = int(os.environ.get('GENERATION_USER_SLOT_TIMEOUT', '600'))
+
+# Image generation engine. The local backend renders deterministic images
+# offline after GENERATION_LOCAL_LATENCY seconds, for load tests.
+GENERATION_BACKEND = os.environ.get('GENERATION_BACKEND', 'generator.backends.stability.StabilityBackend')
+GENERATION_BACKEND_OPTIONS = {}
+if GENERATION_BACKEND.endswith('LocalBackend'):
+    GENERATION_BACKEND_OPTIONS['latency'] = float(os.environ.get('GENERATION_LOCAL_LATENCY', '0'))
+
+# Stability AI HTTP client: one keep-alive pool per worker process
+STABILITY_API_HOST = os.environ.get('STABILITY_API_HOST', 'https://api.stability.ai')
+STABILITY_POOL_SIZE = int(os.environ.get('STABILITY_POOL_SIZE', '10'))
+STABILITY_CONNECT_TIMEOUT = float(os.environ.get('STABILITY_CONNECT_TIMEOUT', '5'))
+STABILITY_READ_TIMEOUT = float(os.environ.get('STABILITY_READ_TIMEOUT', '60'))
+# Async views share one httpx pool per event loop, capped at this many connections
+STABILITY_ASYNC_MAX_CONNECTIONS = int(os.environ.get('STABILITY_ASYNC_MAX_CONNECTIONS', '200'))
+
+# Outbound pacing to the account quota, shared by every process through the cache
+STABILITY_RATE_LIMIT = int(os.environ.get('STABILITY_RATE_LIMIT', '150'))
+STABILITY_RATE_PERIOD = float(os.environ.get('STABILITY_RATE_PERIOD', '10'))
+STABILITY_RATE_LIMIT_MAX_WAIT = float(os.environ.get('STABILITY_RATE_LIMIT_MAX_WAIT', '30'))
+STABILITY_MAX_RETRIES = int(os.environ.get('STABILITY_MAX_RETRIES', '3'))
+STABILITY_RETRY_BASE_DELAY = float(os.environ.get('STABILITY_RETRY_BASE_DELAY', '1'))
+STABILITY_RETRY_MAX_DELAY = float(os.environ.get('STABILITY_RETRY_MAX_DELAY', '30'))
+
+# Circuit breaker around the API, shared by every process through the cache
+CIRCUIT_BREAKER_ENABLED = os.environ.get('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+CIRCUIT_BREAKER_CACHE = os.environ.get('CIRCUIT_BREAKER_CACHE', 'default')
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', '5'))
+CIRCUIT_BREAKER_WINDOW = float(os.environ.get('CIRCUIT_BREAKER_WINDOW', '60'))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.environ.get('CIRCUIT_BREAKER_OPEN_SECONDS', '30'))
+
+# Result cache for identical prompts and parameters. Requests without a seed
+# are only cached when GENERATION_CACHE_UNSEEDED is turned on.
+GENERATION_CACHE_ENABLED = os.environ.get('GENERATION_CACHE_ENABLED', 'true').lower() == 'true'
+GENERATION_CACHE_UNSEEDED = os.environ.get('GENERATION_CACHE_UNSEEDED', 'false').lower() == 'true'
+GENERATION_CACHE_MAX_ENTRIES = int(os.environ.get('GENERATION_CACHE_MAX_ENTRIES', '10000'))
+GENERATION_CACHE_MAX_AGE = int(os.environ.get('GENERATION_CACHE_MAX_AGE', str(30 * 24 * 3600)))
+
+# Identical requests in flight at the same time share one API call; flights
+# are coordinated through the shared cache (Redis) across all processes
+GENERATION_COALESCE = os.environ.get('GENERATION_COALESCE', 'true').lower() == 'true'
+GENERATION_COALESCE_CACHE = os.environ.get('GENERATION_COALESCE_CACHE', 'default')
+GENERATION_COALESCE_MAX_WAIT = float(os.environ.get('GENERATION_COALESCE_MAX_WAIT', '120'))
+GENERATION_COALESCE_POLL_INTERVAL = float(os.environ.get('GENERATION_COALESCE_POLL_INTERVAL', '0.2'))
+
+# Responsive widths of the WebP/AVIF variants built for every generated image
+GENERATION_VARIANT_WIDTHS = (320, 640, 1024)
+# Threads per process building the variants of batch rows after the response
+GENERATION_VARIANT_THREADS = int(os.environ.get('GENERATION_VARIANT_THREADS', '2'))
+
+# Re-encode generated images before storing them ("png", "webp", "avif"),
+# in GENERATION_ENCODE_WORKERS processes per server process
+GENERATION_IMAGE_FORMAT = os.environ.get('GENERATION_IMAGE_FORMAT') or None
+GENERATION_IMAGE_QUALITY = int(os.environ['GENERATION_IMAGE_QUALITY']) if os.environ.get('GENERATION_IMAGE_QUALITY') else None
+GENERATION_IMAGE_STRIP_METADATA = os.environ.get('GENERATION_IMAGE_STRIP_METADATA', 'true').lower() == 'true'
+GENERATION_ENCODE_WORKERS = int(os.environ.get('GENERATION_ENCODE_WORKERS', '2'))
+
+# Progress events of queued generations, served by the ASGI "events" service
+PROGRESS_POLL_INTERVAL = float(os.environ.get('PROGRESS_POLL_INTERVAL', '1'))
+PROGRESS_HEARTBEAT = float(os.environ.get('PROGRESS_HEARTBEAT', '15'))
+PROGRESS_STREAM_TIMEOUT = float(os.environ.get('PROGRESS_STREAM_TIMEOUT', '300'))
+
+# Generations per gallery page (keyset pagination)
+GALLERY_PAGE_SIZE = int(os.environ.get('GALLERY_PAGE_SIZE', '24'))
+# Rendered gallery pages and items, cached per user and invalidated when
+# their generations change; see generator/gallery_cache.py
+GALLERY_CACHE = os.environ.get('GALLERY_CACHE', 'default')
+GALLERY_CACHE_TIMEOUT = int(os.environ.get('GALLERY_CACHE_TIMEOUT', str(24 * 3600)))
+# Newest matches ranked by a prompt search; see generator/search.py
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', '1000'))
+# Generations read per query, and listed per manifest part, by the ZIP export
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '100'))
+
+# Result and gallery pages are revalidated with ETags (304 when unchanged);
+# change PAGE_ETAG_VERSION when a release changes those pages
+PAGE_ETAG_VERSION = os.environ.get('PAGE_ETAG_VERSION', '')
+
+# Batch generation: API calls made in parallel for one batch request
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '50'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+
+# Prompt moderation term lists (one term per line), reloaded when they change
+MODERATION_BLOCKLIST_FILE = os.environ.get('MODERATION_BLOCKLIST_FILE') or None
+MODERATION_ALLOWLIST_FILE = os.environ.get('MODERATION_ALLOWLIST_FILE') or None
+MODERATION_RELOAD_INTERVAL = float(os.environ.get('MODERATION_RELOAD_INTERVAL', '5'))
+
+# Metrics shared by the gunicorn workers, the job worker and the ASGI service
+# through files in METRICS_DIR (a shared volume; empty it on restart); scrape
+# /metrics with "Authorization: Bearer $METRICS_TOKEN"
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '1'))
+METRICS_STALE_AFTER = float(os.environ.get('METRICS_STALE_AFTER', '300'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
@@ -18,17 +18,23 @@ from django.contrib import admin
 from django.urls import path, include
 from generator import views
 from django.conf import settings
-from django.conf.urls.static import static
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.generate, name='generate'),
+    path('generate/async/', views.generate_async, name='generate_async'),
+    path('batch/', views.batch_generate, name='batch_generate'),
+    path('jobs/<int:pk>/', views.generation_job, name='generation_job'),
+    path('jobs/<int:pk>/events/', views.generation_job_events, name='generation_job_events'),
     path('result/<int:pk>/', views.generation_result, name='generation_result'),
     path('gallery/', views.user_gallery, name='user_gallery'),
+    path('gallery/page/', views.user_gallery_page, name='user_gallery_page'),
+    path('gallery/search/', views.gallery_search, name='gallery_search'),
+    path('gallery/export/', views.gallery_export, name='gallery_export'),
     path('register/', views.register, name='register'),
     path('logout/', views.logout_view, name='logout'),
     path('accounts/login/', views.login_view, name='login'),
+    path('metrics', views.metrics_view, name='metrics'),
+    # Only owners may see their images; see generator/media.py
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:name>", views.protected_media, name='protected_media'),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)